@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+asyncio core.
+
+SystemManager variant with one asyncio event loop instead of
+observer, device_handler and stick_messages threads linked by queues:
+    the udev monitor socket is read directly by the loop
+    device events and stick messages are handled in the loop
+    mount / umount / mkfs / fatlabel run as asyncio subprocesses
+    the file copy of every stick runs in a bounded thread pool
+
+select with `./ustick_copy.py --asyncio`.
+"""
+
+import asyncio
+import threading
+import subprocess
+import concurrent.futures
+
+from ustick_copy import SystemManager
+
+
+class Error(Exception):
+    """Base class for exceptions in this module."""
+
+    pass
+
+
+class LoopQueue(object):
+    """Queue stand-in - put() hands the item to a handler in the loop."""
+
+    def __init__(self, manager):
+        """Create new LoopQueue."""
+        super(LoopQueue, self).__init__()
+        self.manager = manager
+
+    def put(self, item):
+        """Handle item in the event loop."""
+        loop = self.manager.loop
+        if loop is None:
+            # not started or already stopped
+            self.manager.handle_stick_message(item)
+        else:
+            loop.call_soon_threadsafe(self.manager.handle_stick_message, item)
+
+
+class AsyncSystemManager(SystemManager):
+    """SystemManager driven by one asyncio event loop."""
+
+    def __init__(self, filename, verbose=False, device_source=None):
+        """Init AsyncSystemManager things."""
+        super(AsyncSystemManager, self).__init__(
+            filename,
+            verbose,
+            device_source
+        )
+        self.loop = None
+        self.loop_thread = None
+        self.executor = None
+        # stick -> concurrent.futures.Future of its job
+        # jobs are started from the loop and from finished job threads.
+        self.futures = {}
+        self.futures_lock = threading.Lock()
+        # sticks post their messages into the loop
+        self.queue_sticks = LoopQueue(self)
+
+    def start(self):
+        """Start event loop and event delivery."""
+        self.loop = asyncio.new_event_loop()
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.config['async_max_workers']
+        )
+        self.loop_thread = threading.Thread(target=self._run_loop)
+        self.loop_thread.start()
+        if self.scheduler:
+            self.scheduler.start_job = self._start_job
+            # more running jobs than workers would only wait in the
+            # executor - and count as writers for the hub limits.
+            max_workers = self.config['async_max_workers']
+            if (
+                self.scheduler.max_jobs <= 0 or
+                self.scheduler.max_jobs > max_workers
+            ):
+                self.scheduler.max_jobs = max_workers
+        self._call_in_loop(
+            self.device_source.start_async,
+            self.loop,
+            self._handle_partition,
+            self.record_filename
+        )
+        print("started system in {} mode (asyncio)".format(self.mode))
+
+    def stop(self):
+        """Stop event delivery, wait for all jobs and stop the loop."""
+        if self.loop is None:
+            return
+        self._call_in_loop(self.device_source.stop)
+        if self.scheduler:
+            # waiting sticks are not started anymore
+            self.scheduler.clear()
+        # jobs need the loop for their subprocesses - so wait first.
+        with self.futures_lock:
+            futures = list(self.futures.values())
+            self.futures = {}
+        concurrent.futures.wait(futures)
+        self.sticks_cancelled = []
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop_thread.join()
+        self.loop.close()
+        self.loop = None
+        self.executor.shutdown()
+        self.executor = None
+        print("stopped system from {} mode".format(self.mode))
+        if self.mode == 'mapping':
+            self.show_mapping()
+        if self.mode == 'copy':
+            self.show_registry()
+        self.mode = None
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def _call_in_loop(self, function, *args):
+        """Call function in the loop thread and wait for the result."""
+        async def call():
+            return function(*args)
+        return asyncio.run_coroutine_threadsafe(call(), self.loop).result()
+
+    # events
+    def wait_for_events(self):
+        """Block until all received partition events are handled."""
+        # events are handled in order - so this call comes last.
+        self._call_in_loop(lambda: None)
+
+    def _handle_partition(self, action, device):
+        """Handle partition event - runs in the loop."""
+        # the action is passed along -
+        # device.action can already belong to a newer event.
+        if device.properties.get('ID_BUS') == 'usb':
+            self.handle_device_event(action, device.device_path)
+
+    # jobs
+    def _start_job(self, stick):
+        """Run the job of stick in the thread pool - scheduler hook."""
+        stick.command_runner = self.run_command
+        with self.futures_lock:
+            # forget finished jobs
+            self.futures = {
+                job: future
+                for job, future in self.futures.items()
+                if not future.done()
+            }
+            self.futures[stick] = self.executor.submit(stick.run)
+
+    def _job_is_running(self, stick):
+        with self.futures_lock:
+            future = self.futures.get(stick)
+        return future is not None and not future.done()
+
+    def run_command(self, command):
+        """
+        Run command as asyncio subprocess - call from a job thread.
+
+        returns the output like subprocess.check_output.
+        """
+        return asyncio.run_coroutine_threadsafe(
+            self.run_command_async(command),
+            self.loop
+        ).result()
+
+    @staticmethod
+    async def run_command_async(command):
+        """Run command and return its output."""
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            stdout=subprocess.PIPE
+        )
+        output, _ = await process.communicate()
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(
+                process.returncode,
+                command,
+                output
+            )
+        return output
@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+Loop device benchmark.
+
+simulates N concurrent USB-Sticks with sparse file backed loop devices
+(each with one FAT32 partition) and runs the full USBStick pipeline
+(format, label, mount, copy, meta cleanup, unmount) against a synthetic
+source folder.
+reports per stick and aggregate MB/s, p50/p99 job time and CPU time
+for every combination of file count, file size and concurrency.
+the copy and the flush (syncfs before unmount) time are shown separately.
+
+needs root (losetup, mount) and the shell tools
+    losetup, sfdisk, udevadm
+
+example:
+`sudo ./benchmark.py --sticks 4,8 --files 10,1000 --file-size 64,4096`
+"""
+
+import sys
+import os
+import time
+import json
+import queue
+import shutil
+import argparse
+import resource
+import itertools
+import subprocess
+
+import configdict
+import fatfs
+from usbstick import USBStick
+from copysession import CopySession
+from scheduler import JobScheduler
+
+
+##########################################
+
+class LoopStick(USBStick):
+    """USBStick on a loop device partition with a simulated port."""
+
+    def __init__(self, device_path, config, port_id, session=None):
+        """Create new LoopStick."""
+        # needed in USBStick.__init__ to build port path and name.
+        self.bench_port_id = port_id
+        # messages are collected but not shown
+        super(LoopStick, self).__init__(
+            device_path,
+            config,
+            queue.Queue(),
+            session
+        )
+        self.time_start = None
+        self.time_end = None
+        self.error = None
+
+    def get_usb_port_path(self):
+        """Get simulated USB-Port full path."""
+        return "/devices/benchmark/{}:1.0".format(self.bench_port_id)
+
+    def run(self):
+        """Run the normal pipeline and measure job time."""
+        self.time_start = time.monotonic()
+        try:
+            super(LoopStick, self).run()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.time_end = time.monotonic()
+
+    def get_job_time(self):
+        """Get duration of the job in seconds."""
+        return self.time_end - self.time_start
+
+
+def run_command(command, input_string=None):
+    """Run command and return output."""
+    if input_string is not None:
+        input_string = input_string.encode()
+    return subprocess.check_output(command, input=input_string).decode()
+
+
+def percentile(values, percent):
+    """Get nearest rank percentile of values."""
+    values = sorted(values)
+    if not values:
+        return 0
+    index = int(round(percent / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+def create_source(path, file_count, file_size):
+    """Create synthetic source folder with some subfolders."""
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+    # 50 files per folder - like a normal media collection
+    for index in range(file_count):
+        folder = os.path.join(path, "folder_{:03d}".format(index // 50))
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        filename = os.path.join(folder, "file_{:05d}.bin".format(index))
+        with open(filename, 'wb') as f:
+            f.write(os.urandom(file_size))
+    # meta files like from a mac - removed by remove_all_meta_files
+    with open(os.path.join(path, ".DS_Store"), 'wb') as f:
+        f.write(os.urandom(4096))
+
+
+def create_loop_stick(path, size_mib):
+    """Create sparse file with one FAT32 partition and attach it as loop."""
+    with open(path, 'wb') as f:
+        f.truncate(size_mib * 1024 * 1024)
+    # one FAT32 (LBA) partition aligned to 1MiB
+    run_command(
+        ["sfdisk", "--quiet", path],
+        "label: dos\nstart=2048, type=c\n"
+    )
+    loop_node = run_command(
+        ["losetup", "--find", "--show", "--partscan", path]
+    ).strip()
+    partition_node = loop_node + "p1"
+    run_command(["udevadm", "settle"])
+    fatfs.format_fat32(partition_node, "BENCH")
+    run_command(["udevadm", "settle"])
+    return loop_node, partition_node
+
+
+def remove_loop_stick(loop_node, path):
+    """Detach loop device and remove backing file."""
+    try:
+        run_command(["losetup", "--detach", loop_node])
+    except subprocess.CalledProcessError as e:
+        print("failed: {}".format(e))
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def get_cpu_time():
+    """Get user + system time of this process and all children."""
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (
+        usage_self.ru_utime + usage_self.ru_stime +
+        usage_children.ru_utime + usage_children.ru_stime
+    )
+
+
+def run_benchmark(workdir, stick_count, concurrency, stick_config, size_mib):
+    """Run one benchmark with stick_count loop sticks."""
+    sticks = []
+    loops = []
+    try:
+        for index in range(stick_count):
+            path = os.path.join(workdir, "stick_{:03d}.img".format(index))
+            loop_node, partition_node = create_loop_stick(path, size_mib)
+            loops.append((loop_node, path))
+        session = CopySession(stick_config, workdir)
+        session.prepare()
+        for index, (loop_node, path) in enumerate(loops):
+            device_path = os.path.realpath(
+                "/sys/class/block/" + os.path.basename(loop_node) + "p1"
+            )
+            sticks.append(LoopStick(
+                device_path,
+                stick_config,
+                # one simulated hub with all sticks
+                "99-1.{}".format(index + 1),
+                session
+            ))
+        scheduler = JobScheduler(concurrency)
+        cpu_start = get_cpu_time()
+        time_start = time.monotonic()
+        for stick in sticks:
+            scheduler.submit(stick)
+        for stick in sticks:
+            # queued sticks are started by the scheduler later
+            while not stick.time_end:
+                time.sleep(0.01)
+            stick.join()
+        wall_time = time.monotonic() - time_start
+        cpu_time = get_cpu_time() - cpu_start
+        source_size = session.get_manifest().total_size
+    finally:
+        for loop_node, path in loops:
+            remove_loop_stick(loop_node, path)
+    job_times = [stick.get_job_time() for stick in sticks]
+    copy_times = [stick.step_times.get('copy', 0) for stick in sticks]
+    flush_times = [stick.step_times.get('flush', 0) for stick in sticks]
+    mb = source_size / (1000 * 1000)
+    return {
+        'sticks': stick_count,
+        'concurrency': concurrency,
+        'errors': sum(
+            1 for stick in sticks
+            if stick.error or stick.result_message != "done"
+        ),
+        'wall_time': wall_time,
+        'cpu_time': cpu_time,
+        'job_p50': percentile(job_times, 50),
+        'job_p99': percentile(job_times, 99),
+        'copy_p50': percentile(copy_times, 50),
+        'flush_p50': percentile(flush_times, 50),
+        'stick_mbs_mean': sum(mb / t for t in job_times) / len(job_times),
+        'aggregate_mbs': mb * stick_count / wall_time,
+    }
+
+
+def parse_list(value):
+    """Parse '1,2,3' to [1, 2, 3]."""
+    return [int(item) for item in value.split(',') if item]
+
+
+def setup_config_parser():
+    """Setup config parser arguments."""
+    parser = argparse.ArgumentParser(
+        description="benchmark the copy pipeline with loop device sticks"
+    )
+    parser.add_argument(
+        "--sticks",
+        help="comma separated list of stick counts (default: 4)",
+        type=parse_list,
+        default=[4]
+    )
+    parser.add_argument(
+        "--concurrency",
+        help="comma separated list of max concurrent jobs - "
+        "0 means all sticks at once (default: 0)",
+        type=parse_list,
+        default=[0]
+    )
+    parser.add_argument(
+        "--files",
+        help="comma separated list of file counts (default: 100)",
+        type=parse_list,
+        default=[100]
+    )
+    parser.add_argument(
+        "--file-size",
+        help="comma separated list of file sizes in KiB (default: 1024)",
+        type=parse_list,
+        default=[1024]
+    )
+    parser.add_argument(
+        "--stick-size",
+        help="size of every simulated stick in MiB (default: 1024)",
+        type=int,
+        default=1024
+    )
+    parser.add_argument(
+        "--workdir",
+        help="folder for source, stick images and mount points",
+        default="/tmp/ustick_benchmark"
+    )
+    parser.add_argument(
+        "--stick-config",
+        help="json with stick_config overrides - "
+        "for example '{\"copy_engine\": \"single\"}'",
+        default="{}"
+    )
+    parser.add_argument(
+        "--output",
+        help="append results as json lines to this file",
+        default=None
+    )
+    return parser.parse_args()
+
+
+##########################################
+if __name__ == '__main__':
+
+    args = setup_config_parser()
+    if os.geteuid() != 0:
+        print("benchmark needs root (losetup / mount).")
+        sys.exit(1)
+
+    workdir = os.path.abspath(args.workdir)
+    if not os.path.exists(workdir):
+        os.makedirs(workdir)
+
+    header = (
+        "{:>6} {:>5} {:>6} {:>8} {:>6} | {:>8} {:>8} {:>8} {:>9} {:>9} {:>4}"
+        "".format(
+            "sticks", "conc", "files", "size_kib", "MB",
+            "wall_s", "p50_s", "p99_s", "stick_MBs", "total_MBs", "err"
+        )
+    )
+    print(header)
+    print("-" * len(header))
+
+    for file_count, file_size_kib, stick_count, concurrency in (
+        itertools.product(
+            args.files, args.file_size, args.sticks, args.concurrency
+        )
+    ):
+        source = os.path.join(workdir, "source")
+        create_source(source, file_count, file_size_kib * 1024)
+        stick_config = configdict.merge_deep(
+            USBStick.default_config,
+            {
+                'source_folder': source,
+                'mount_base': os.path.join(workdir, "mnt"),
+                'disc_label': "BENCH",
+                'auto_run_steps': {
+                    'format_as_fat32': True,
+                    'update_label': True,
+                    'copy_files_to_me': True,
+                    'remove_all_meta_files': True,
+                    'remove_files': True,
+                },
+            }
+        )
+        stick_config = configdict.merge_deep(
+            stick_config,
+            json.loads(args.stick_config)
+        )
+        result = run_benchmark(
+            workdir,
+            stick_count,
+            concurrency,
+            stick_config,
+            args.stick_size
+        )
+        result['files'] = file_count
+        result['file_size_kib'] = file_size_kib
+        result['cpu_time_per_stick'] = result['cpu_time'] / stick_count
+        print(
+            "{sticks:>6} {concurrency:>5} {files:>6} {file_size_kib:>8} "
+            "{mb:>6.0f} | {wall_time:>8.2f} {job_p50:>8.2f} {job_p99:>8.2f} "
+            "{stick_mbs_mean:>9.1f} {aggregate_mbs:>9.1f} {errors:>4}"
+            "".format(
+                mb=file_count * file_size_kib * 1024 / (1000 * 1000),
+                **result
+            )
+        )
+        print("{:>40} cpu: {:.2f}s ({:.2f}s per stick)".format(
+            "", result['cpu_time'], result['cpu_time_per_stick']
+        ))
+        print("{:>40} copy p50: {:.2f}s flush p50: {:.2f}s".format(
+            "", result['copy_p50'], result['flush_p50']
+        ))
+        if args.output:
+            with open(args.output, 'a') as f:
+                f.write(json.dumps(result, sort_keys=True) + "\n")
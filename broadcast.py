@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+Broadcast copy engine.
+
+one reader thread reads every source chunk exactly once
+into a bounded pool of shared buffers.
+every stick (subscriber) writes the same buffers through memoryviews
+- so the data is never copied in memory.
+a buffer goes back to the pool when all subscribers have written it.
+so the slowest stick sets the pace (backpressure).
+
+the reader cycles through the file list like a carousel:
+sticks that are plugged in later join at the next file boundary
+and get the files they missed in the next round.
+a subscriber that stops early (stick pulled) leaves the broadcast
+and hands back all its buffers - the other sticks continue.
+files that are already in the journal of a subscriber are not sent
+to it (resume).
+if the reader fails, every subscriber gets the error and its end marker.
+"""
+
+import os
+import queue
+import threading
+
+import manifest
+import copybackend
+import writeback
+
+
+class Error(Exception):
+    """Base class for exceptions in this module."""
+
+    pass
+
+
+class Chunk(object):
+    """One filled buffer shared by all subscribers."""
+
+    def __init__(self, buffer, size, refcount, pool):
+        """Create new Chunk."""
+        super(Chunk, self).__init__()
+        self.buffer = buffer
+        self.view = memoryview(buffer)[:size]
+        self.refcount = refcount
+        self.pool = pool
+        self.lock = threading.Lock()
+
+    def release(self):
+        """Release chunk - last release gives the buffer back to the pool."""
+        with self.lock:
+            self.refcount -= 1
+            last = self.refcount == 0
+        if last:
+            self.pool.put(self.buffer)
+
+
+class Subscriber(object):
+    """One destination folder receiving the broadcast."""
+
+    def __init__(self, dst, files, progress=None, journal=None):
+        """Create new Subscriber."""
+        super(Subscriber, self).__init__()
+        self.dst = dst
+        self.progress = progress
+        self.journal = journal
+        # names of the files that are already on the stick
+        self.skip = frozenset()
+        if journal:
+            self.skip = frozenset(journal.done)
+        # only used by the reader thread
+        self.remaining = sum(
+            1 for entry in files if entry.name not in self.skip
+        )
+        self.queue = queue.Queue()
+        self.errors = []
+        # set by leave - the reader does not deliver anything anymore
+        self.left = False
+
+
+class BroadcastEngine(object):
+    """Single reader fan-out copy engine."""
+
+    def __init__(
+        self,
+        source_manifest,
+        chunk_size=1024*1024,
+        buffer_count=64,
+        preallocate=False,
+        writeback_window=0
+    ):
+        """Create new BroadcastEngine for source_manifest."""
+        super(BroadcastEngine, self).__init__()
+        self.manifest = source_manifest
+        self.preallocate = preallocate
+        self.writeback_window = writeback_window
+        self.files = source_manifest.files
+        self.chunk_size = chunk_size
+        self.pool = queue.Queue()
+        for index in range(buffer_count):
+            self.pool.put(bytearray(chunk_size))
+        self.condition = threading.Condition()
+        self.joining = []
+        self.active = []
+        self.reader_thread = None
+
+    # reader
+    def _reader(self):
+        """Run the reader - a failed reader ends every subscriber."""
+        try:
+            self._read_files()
+        except BaseException as why:
+            print("broadcast reader failed: {!r}".format(why))
+            self._abort(why)
+
+    def _abort(self, why):
+        # nobody must wait for a reader that is gone
+        with self.condition:
+            subscribers = self.active + self.joining
+            self.active = []
+            self.joining = []
+            self.reader_thread = None
+            for subscriber in subscribers:
+                if not subscriber.left:
+                    subscriber.queue.put(('abort', repr(why)))
+                    subscriber.queue.put(None)
+
+    def _read_files(self):
+        """Cycle through all files while there are subscribers."""
+        index = 0
+        while True:
+            with self.condition:
+                # new subscribers join at file boundaries
+                self.active.extend(self.joining)
+                self.joining = []
+                if not self.active:
+                    self.reader_thread = None
+                    return
+                entry = self.files[index]
+                recipients = [
+                    subscriber
+                    for subscriber in self.active
+                    if entry.name not in subscriber.skip
+                ]
+            if recipients:
+                self._send_file(entry, recipients)
+            with self.condition:
+                for subscriber in recipients:
+                    if subscriber.left:
+                        continue
+                    subscriber.remaining -= 1
+                    if subscriber.remaining == 0:
+                        self.active.remove(subscriber)
+                        subscriber.queue.put(None)
+            index = (index + 1) % len(self.files)
+
+    def _send_file(self, entry, recipients):
+        for subscriber in recipients:
+            self._deliver(subscriber, ('open', entry))
+        srcname = self.manifest.get_src_path(entry)
+        try:
+            with open(srcname, 'rb', buffering=0) as f:
+                while True:
+                    # blocks until the slowest stick has released a buffer
+                    buffer = self.pool.get()
+                    try:
+                        size = f.readinto(buffer)
+                    except Exception:
+                        self.pool.put(buffer)
+                        raise
+                    if not size:
+                        self.pool.put(buffer)
+                        break
+                    chunk = Chunk(buffer, size, len(recipients), self.pool)
+                    for subscriber in recipients:
+                        self._deliver(subscriber, ('data', chunk))
+        except OSError as why:
+            for subscriber in recipients:
+                self._deliver(subscriber, ('error', entry, str(why)))
+        else:
+            for subscriber in recipients:
+                self._deliver(subscriber, ('close', entry))
+
+    def _deliver(self, subscriber, item):
+        with self.condition:
+            if not subscriber.left:
+                subscriber.queue.put(item)
+                return
+        # nobody will write this chunk for the subscriber that has left
+        if item[0] == 'data':
+            item[1].release()
+
+    def _leave(self, subscriber):
+        """Remove subscriber and release all chunks it has not written."""
+        with self.condition:
+            subscriber.left = True
+            if subscriber in self.joining:
+                self.joining.remove(subscriber)
+            if subscriber in self.active:
+                self.active.remove(subscriber)
+        # after left is set nothing new arrives in the queue
+        while True:
+            try:
+                item = subscriber.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None and item[0] == 'data':
+                item[1].release()
+
+    # writer
+    def copy_to(self, dst, progress=None, journal=None):
+        """
+        Copy the complete source to dst - blocks until done.
+
+        progress: optional Progress object - gets every written chunk.
+        journal: optional journal.CopyJournal - its done files are
+            skipped and every written file is added.
+        """
+        subscriber = Subscriber(dst, self.files, progress, journal)
+        self._prepare_destination(subscriber)
+        if subscriber.remaining:
+            with self.condition:
+                self.joining.append(subscriber)
+                if self.reader_thread is None:
+                    self.reader_thread = threading.Thread(
+                        target=self._reader
+                    )
+                    self.reader_thread.start()
+            try:
+                self._write(subscriber)
+            except BaseException:
+                # for example progress.Cancelled - stick was pulled
+                self._leave(subscriber)
+                raise
+        self._finish_destination(subscriber)
+        if subscriber.errors:
+            raise Error(subscriber.errors)
+
+    def _prepare_destination(self, subscriber):
+        for entry in self.manifest.dirs:
+            dstname = os.path.join(subscriber.dst, entry.name)
+            try:
+                os.makedirs(dstname, exist_ok=True)
+            except OSError as why:
+                self._add_error(subscriber, entry, why)
+        for entry in self.manifest.links:
+            try:
+                os.symlink(
+                    entry.link_target,
+                    os.path.join(subscriber.dst, entry.name)
+                )
+            except OSError as why:
+                self._add_error(subscriber, entry, why)
+
+    def _finish_destination(self, subscriber):
+        # deepest directories first - same as the recursive copystat
+        for entry in reversed((self.manifest.root,) + self.manifest.dirs):
+            try:
+                manifest.copy_stat(
+                    entry,
+                    os.path.join(subscriber.dst, entry.name)
+                )
+            except OSError as why:
+                self._add_error(subscriber, entry, why)
+
+    def _write(self, subscriber):
+        """Write all received chunks until the end marker."""
+        fd = None
+        entry = None
+        # one window for all files - the end of every file goes to
+        # the stick while the next file is written.
+        window = writeback.WritebackWindow(
+            self.writeback_window,
+            subscriber.progress
+        )
+        try:
+            while True:
+                item = subscriber.queue.get()
+                if item is None:
+                    break
+                kind = item[0]
+                if kind == 'open':
+                    entry = item[1]
+                    written = 0
+                    try:
+                        fd = os.open(
+                            os.path.join(subscriber.dst, entry.name),
+                            os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                            0o644
+                        )
+                        if self.preallocate:
+                            copybackend.preallocate(fd, entry.size)
+                        window.open_file(fd)
+                    except OSError as why:
+                        self._add_error(subscriber, entry, why)
+                        if fd is not None:
+                            os.close(fd)
+                        fd = None
+                elif kind == 'data':
+                    chunk = item[1]
+                    try:
+                        if fd is not None:
+                            self._write_all(fd, chunk.view)
+                            written += len(chunk.view)
+                            window.add(len(chunk.view))
+                    except OSError as why:
+                        self._add_error(subscriber, entry, why)
+                        window.drop_file()
+                        os.close(fd)
+                        fd = None
+                    finally:
+                        # always release - otherwise all other sticks stall.
+                        chunk.release()
+                elif kind == 'close':
+                    if fd is not None:
+                        try:
+                            try:
+                                if self.preallocate and written < entry.size:
+                                    # source got smaller than the manifest
+                                    os.ftruncate(fd, written)
+                                window.close_file()
+                            finally:
+                                # never closed twice - also on cancel
+                                window.drop_file()
+                                fd_closing, fd = fd, None
+                                os.close(fd_closing)
+                            manifest.copy_stat(
+                                entry,
+                                os.path.join(subscriber.dst, entry.name)
+                            )
+                            if subscriber.journal:
+                                subscriber.journal.add(entry)
+                        except OSError as why:
+                            self._add_error(subscriber, entry, why)
+                        fd = None
+                    if subscriber.progress:
+                        subscriber.progress.add(files_done=1)
+                elif kind == 'error':
+                    self._add_error(subscriber, item[1], item[2])
+                    if fd is not None:
+                        window.drop_file()
+                        os.close(fd)
+                        fd = None
+                elif kind == 'abort':
+                    # the reader failed - the end marker follows
+                    self._add_error(subscriber, self.manifest.root, item[1])
+                    if fd is not None:
+                        window.drop_file()
+                        os.close(fd)
+                        fd = None
+            try:
+                # the end of the last file
+                window.finish()
+            except OSError as why:
+                self._add_error(subscriber, entry, why)
+        finally:
+            window.close()
+            # cancelled in the middle of a file
+            if fd is not None:
+                os.close(fd)
+
+    def _add_error(self, subscriber, entry, why):
+        subscriber.errors.append(
+            (
+                self.manifest.get_src_path(entry),
+                os.path.join(subscriber.dst, entry.name),
+                str(why)
+            )
+        )
+
+    @staticmethod
+    def _write_all(fd, view):
+        pos = 0
+        size = len(view)
+        while pos < size:
+            pos += os.write(fd, view[pos:])
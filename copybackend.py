@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+Copy backends.
+
+different ways to copy the data of one file onto the stick:
+    copy2: shutil.copyfile - the old behavior (small default buffers)
+    buffered: read / write loop with one large reusable buffer
+    zerocopy: os.copy_file_range / os.sendfile -
+        the data never leaves the kernel.
+        falls back to buffered if the kernel does not allow it.
+
+all backends can preallocate the destination with posix_fallocate
+so that the FAT clusters are allocated in one contiguous run.
+buffered and zerocopy write the destination back in windows
+(see writeback.WritebackWindow) - one window for all files of a stick
+if the caller passes it.
+
+use as script to compare the backends:
+`./copybackend.py ~/StickDataToCopy/ ~/ustick_copy/2-1_2_2_4/bench`
+"""
+
+import os
+import sys
+import errno
+import shutil
+import time
+import threading
+
+import writeback
+
+
+class Error(Exception):
+    """Base class for exceptions in this module."""
+
+    pass
+
+
+def preallocate(fd, size):
+    """Preallocate size bytes for fd - ignore if not supported."""
+    if size > 0 and hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except OSError as why:
+            not_supported = (errno.EOPNOTSUPP, errno.ENOSYS, errno.EINVAL)
+            if why.errno not in not_supported:
+                raise
+
+
+class CopyBackend(object):
+    """Copy file content with shutil.copyfile (old behavior)."""
+
+    name = 'copy2'
+
+    def __init__(
+        self,
+        buffer_size=4*1024*1024,
+        preallocate=True,
+        writeback_window=0
+    ):
+        """Create new CopyBackend."""
+        super(CopyBackend, self).__init__()
+        self.buffer_size = buffer_size
+        self.preallocate = preallocate
+        self.writeback_window = writeback_window
+
+    def copy_file(
+        self,
+        srcname,
+        dstname,
+        size,
+        progress=None,
+        window=None
+    ):
+        """
+        Copy content of srcname to dstname - returns bytes copied.
+
+        progress: optional Progress object - gets every written chunk.
+        window: optional writeback.WritebackWindow of the stick -
+            gets the chunks instead of progress and the end of the file
+            is waited for while the next file is copied.
+            without, a window for this file is waited for at the end.
+        """
+        shutil.copyfile(srcname, dstname)
+        if window:
+            # copyfile writes through its own file - nothing to window
+            window.add(size)
+        elif progress:
+            progress.add(size)
+        return size
+
+    def _open_window(self, fd_out, progress, window):
+        """Get (window, window of this file only) for fd_out."""
+        own = window is None
+        if own:
+            window = writeback.WritebackWindow(self.writeback_window, progress)
+        window.open_file(fd_out)
+        return window, own
+
+    @staticmethod
+    def _close_window(window, own):
+        window.close_file()
+        if own:
+            window.finish()
+
+    @staticmethod
+    def _drop_window(window, own):
+        if own:
+            window.close()
+        else:
+            window.drop_file()
+
+    def _open_files(self, srcname, dstname, size):
+        fd_in = os.open(srcname, os.O_RDONLY)
+        try:
+            fd_out = os.open(
+                dstname,
+                os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                0o644
+            )
+        except OSError:
+            os.close(fd_in)
+            raise
+        if self.preallocate:
+            try:
+                preallocate(fd_out, size)
+            except OSError:
+                os.close(fd_in)
+                os.close(fd_out)
+                raise
+        return fd_in, fd_out
+
+    def _truncate(self, fd_out, copied, size):
+        # source got smaller than the manifest -
+        # cut off the preallocated rest.
+        if self.preallocate and copied < size:
+            os.ftruncate(fd_out, copied)
+
+
+class BufferedBackend(CopyBackend):
+    """Copy file content with one large reusable buffer per thread."""
+
+    name = 'buffered'
+
+    def __init__(
+        self,
+        buffer_size=4*1024*1024,
+        preallocate=True,
+        writeback_window=0
+    ):
+        """Create new BufferedBackend."""
+        super(BufferedBackend, self).__init__(
+            buffer_size,
+            preallocate,
+            writeback_window
+        )
+        self.local = threading.local()
+
+    def _get_buffer(self):
+        buffer = getattr(self.local, 'buffer', None)
+        if buffer is None:
+            buffer = bytearray(self.buffer_size)
+            self.local.buffer = buffer
+        return buffer
+
+    def copy_file(
+        self,
+        srcname,
+        dstname,
+        size,
+        progress=None,
+        window=None
+    ):
+        """Copy content of srcname to dstname - returns bytes copied."""
+        fd_in, fd_out = self._open_files(srcname, dstname, size)
+        window, own = self._open_window(fd_out, progress, window)
+        try:
+            copied = self._copy_buffered(fd_in, fd_out, window)
+            self._truncate(fd_out, copied, size)
+            self._close_window(window, own)
+            return copied
+        finally:
+            self._drop_window(window, own)
+            os.close(fd_in)
+            os.close(fd_out)
+
+    def _copy_buffered(self, fd_in, fd_out, progress):
+        buffer = self._get_buffer()
+        view = memoryview(buffer)
+        copied = 0
+        while True:
+            size = os.readv(fd_in, [buffer])
+            if not size:
+                break
+            pos = 0
+            while pos < size:
+                pos += os.write(fd_out, view[pos:size])
+            copied += size
+            if progress:
+                progress.add(size)
+        return copied
+
+
+class ZeroCopyBackend(BufferedBackend):
+    """Copy file content inside the kernel (copy_file_range / sendfile)."""
+
+    name = 'zerocopy'
+
+    def copy_file(
+        self,
+        srcname,
+        dstname,
+        size,
+        progress=None,
+        window=None
+    ):
+        """Copy content of srcname to dstname - returns bytes copied."""
+        fd_in, fd_out = self._open_files(srcname, dstname, size)
+        window, own = self._open_window(fd_out, progress, window)
+        try:
+            copied = 0
+            for function in (self._copy_file_range, self._sendfile):
+                try:
+                    copied += function(fd_in, fd_out, window)
+                    self._truncate(fd_out, copied, size)
+                    self._close_window(window, own)
+                    return copied
+                except OSError as why:
+                    if why.errno not in (
+                        errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                        errno.EOPNOTSUPP
+                    ):
+                        raise
+                    # continue where the failed function has stopped
+                    copied = os.lseek(fd_out, 0, os.SEEK_CUR)
+                    os.lseek(fd_in, copied, os.SEEK_SET)
+                except AttributeError:
+                    pass
+            copied += self._copy_buffered(fd_in, fd_out, window)
+            self._truncate(fd_out, copied, size)
+            self._close_window(window, own)
+            return copied
+        finally:
+            self._drop_window(window, own)
+            os.close(fd_in)
+            os.close(fd_out)
+
+    def _copy_file_range(self, fd_in, fd_out, progress):
+        copied = 0
+        while True:
+            size = os.copy_file_range(fd_in, fd_out, self.buffer_size)
+            if not size:
+                break
+            copied += size
+            if progress:
+                progress.add(size)
+        return copied
+
+    def _sendfile(self, fd_in, fd_out, progress):
+        copied = 0
+        while True:
+            size = os.sendfile(fd_out, fd_in, None, self.buffer_size)
+            if not size:
+                break
+            copied += size
+            if progress:
+                progress.add(size)
+        return copied
+
+
+backends = {
+    CopyBackend.name: CopyBackend,
+    BufferedBackend.name: BufferedBackend,
+    ZeroCopyBackend.name: ZeroCopyBackend,
+}
+
+
+def get_backend(
+    name,
+    buffer_size=4*1024*1024,
+    preallocate=True,
+    writeback_window=0
+):
+    """Get backend object for name."""
+    try:
+        backend_class = backends[name]
+    except KeyError:
+        raise Error(
+            "unknown copy backend '{}' - use one of {}".format(
+                name, sorted(backends)
+            )
+        )
+    return backend_class(buffer_size, preallocate, writeback_window)
+
+
+def benchmark(src, dst, names=None, buffer_size=4*1024*1024):
+    """
+    Copy all files from src to dst with every backend.
+
+    returns dict backend name -> MB/s
+    dst should be on the target filesystem (a mounted stick).
+    """
+    if names is None:
+        names = sorted(backends)
+    files = []
+    for root, dirs, file_names in os.walk(src):
+        for file_name in file_names:
+            srcname = os.path.join(root, file_name)
+            if not os.path.islink(srcname):
+                files.append((srcname, os.path.getsize(srcname)))
+    results = {}
+    for name in names:
+        backend = get_backend(name, buffer_size)
+        dst_backend = os.path.join(dst, name)
+        os.makedirs(dst_backend, exist_ok=True)
+        start = time.monotonic()
+        copied = 0
+        for index, (srcname, size) in enumerate(files):
+            dstname = os.path.join(dst_backend, "{}.bin".format(index))
+            copied += backend.copy_file(srcname, dstname, size)
+        # include the time to get the data to the device
+        os.sync()
+        duration = time.monotonic() - start
+        results[name] = copied / duration / (1000 * 1000)
+        shutil.rmtree(dst_backend)
+    return results
+
+
+##########################################
+if __name__ == '__main__':
+
+    if len(sys.argv) < 3:
+        print("usage: copybackend.py SOURCE_FOLDER DESTINATION_FOLDER")
+        sys.exit(1)
+    results = benchmark(
+        os.path.expanduser(sys.argv[1]),
+        os.path.expanduser(sys.argv[2])
+    )
+    for name, speed in sorted(results.items()):
+        print("{:>10}: {:8.1f} MB/s".format(name, speed))
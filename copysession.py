@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+Copy Session.
+
+holds everything that only needs to be computed once per copy run
+and is shared by all USBStick objects of this run.
+"""
+
+import os
+import glob
+import json
+import hashlib
+import threading
+
+import fatimage
+import fatwriter
+import journal
+import registry
+import broadcast
+import manifest
+import copybackend
+import hashcache
+
+
+class CopySession(object):
+    """Session wide data shared by all sticks of one copy run."""
+
+    def __init__(self, config, path_to_config="."):
+        """Create new CopySession Object."""
+        super(CopySession, self).__init__()
+        self.config = config
+        self.path_to_config = path_to_config
+        self.lock = threading.Lock()
+        # images are built while other sticks go on
+        self.image_lock = threading.Lock()
+        # fatfs.Geometry -> image file for partitions like that
+        self.image_files = {}
+        self.manifest = None
+        self.fat_writer = None
+        # cluster size -> bytes the source needs on the stick
+        self.required_sizes = {}
+        self.source_signature = None
+        self.registry = None
+        self.broadcast = None
+        self.copy_backend = None
+        self.hash_cache = None
+        self.source_digests = None
+
+    def prepare(self):
+        """Compute all session data needed for the configured steps."""
+        self.get_manifest()
+        if self.config['copy_mode'] in ('image', 'raw'):
+            # the image is built for the first stick of every size
+            self.get_fat_writer()
+        if (
+            self.config['copy_mode'] == 'files' and
+            self.config['copy_engine'] == 'broadcast'
+        ):
+            self.get_broadcast()
+        if (
+            self.config['auto_run_steps']['verify_files'] or (
+                self.config['copy_mode'] == 'sync' and
+                self.config['sync_compare'] == 'hash'
+            )
+        ):
+            self.get_source_digests()
+        if self.config['registry_file']:
+            # hashes the source now - not in the first device event
+            self.get_registry()
+
+    def get_source_folder(self):
+        """Get absolute source folder."""
+        return os.path.expanduser(self.config['source_folder'])
+
+    # image
+    def get_image_file(self, geometry):
+        """Get file name of the image for partitions with geometry."""
+        root, ext = os.path.splitext(
+            os.path.expanduser(self.config['image_file'])
+        )
+        return "{}_{}_{}{}".format(root, geometry.size, geometry.start, ext)
+
+    def get_image(self, geometry):
+        """Get FAT32 image for partitions with geometry - built once."""
+        fat_writer = self.get_fat_writer()
+        with self.image_lock:
+            image_file = self.image_files.get(geometry)
+            if image_file is None:
+                image_file = self.get_image_file(geometry)
+                print("build image '{}'...".format(image_file))
+                fatimage.build_image(
+                    fat_writer,
+                    image_file,
+                    geometry,
+                    self.config['disc_label'],
+                    self.config['format_cluster_size'],
+                    self.config['format_alignment']
+                )
+                print("image done.")
+                self.image_files[geometry] = image_file
+        return image_file
+
+    # manifest
+    def get_path_filter(self):
+        """Get the include / exclude rules for the source folder."""
+        auto_run_steps = self.config['auto_run_steps']
+        exclude = list(self.config['source_exclude'])
+        # what the remove steps would delete is not copied at all
+        if auto_run_steps['remove_all_meta_files']:
+            exclude.extend(manifest.meta_files)
+        if auto_run_steps['remove_files']:
+            exclude.extend(
+                "/" + glob.escape(name)
+                for name in self.config['files_to_remove']
+            )
+        return manifest.PathFilter(self.config['source_include'], exclude)
+
+    def get_manifest(self):
+        """Get snapshot of the source folder - scan it on first call."""
+        with self.lock:
+            if self.manifest is None:
+                self.manifest = manifest.SourceManifest(
+                    self.get_source_folder(),
+                    self.get_path_filter()
+                )
+                print(
+                    "source manifest: {} entries, {} bytes, "
+                    "{} excluded".format(
+                        len(self.manifest),
+                        self.manifest.total_size,
+                        self.manifest.excluded_count
+                    )
+                )
+        return self.manifest
+
+    def get_source_signature(self):
+        """Get signature of the source (names, sizes and mtimes)."""
+        source_manifest = self.get_manifest()
+        with self.lock:
+            if self.source_signature is None:
+                self.source_signature = source_manifest.get_signature()
+        return self.source_signature
+
+    # journal
+    def get_journal(self, serial, port_id):
+        """Get CopyJournal for stick serial in port_id (or None)."""
+        if not self.config['journal_folder']:
+            return None
+        return journal.CopyJournal(
+            os.path.join(
+                self.path_to_config,
+                os.path.expanduser(self.config['journal_folder']),
+                journal.get_journal_name(serial, port_id)
+            ),
+            self.get_source_signature()
+        )
+
+    # registry
+    def get_registry(self):
+        """Get the CompletionRegistry of this source (or None)."""
+        if not self.config['registry_file']:
+            return None
+        source_manifest = self.get_manifest()
+        # keyed on the content - a touched or re-checked-out source
+        # is still the same result on the stick.
+        digests = self.get_source_digests()
+        with self.lock:
+            if self.registry is None:
+                # the same files with another label are another result
+                signature = hashlib.sha256(json.dumps([
+                    source_manifest.get_content_signature(digests),
+                    self.config['verify_algorithm'],
+                    self.config['disc_label'],
+                ]).encode()).hexdigest()
+                self.registry = registry.CompletionRegistry(
+                    os.path.join(
+                        self.path_to_config,
+                        os.path.expanduser(self.config['registry_file'])
+                    ),
+                    signature
+                )
+        return self.registry
+
+    def get_required_size(self, cluster_size):
+        """Get bytes the source needs on a FAT stick with cluster_size."""
+        source_manifest = self.get_manifest()
+        with self.lock:
+            size = self.required_sizes.get(cluster_size)
+            if size is None:
+                size = fatwriter.estimate_size(source_manifest, cluster_size)
+                self.required_sizes[cluster_size] = size
+        return size
+
+    # raw
+    def get_fat_writer(self):
+        """Get the FatWriter all sticks of this session share."""
+        source_manifest = self.get_manifest()
+        with self.lock:
+            if self.fat_writer is None:
+                self.fat_writer = fatwriter.FatWriter(
+                    source_manifest,
+                    writeback_window=self.config['writeback_window']
+                )
+        return self.fat_writer
+
+    # broadcast
+    def get_broadcast(self):
+        """Get the one BroadcastEngine all sticks of this session share."""
+        source_manifest = self.get_manifest()
+        with self.lock:
+            if self.broadcast is None:
+                self.broadcast = broadcast.BroadcastEngine(
+                    source_manifest,
+                    self.config['broadcast_chunk_size'],
+                    self.config['broadcast_buffer_count'],
+                    self.config['copy_preallocate'],
+                    self.config['writeback_window']
+                )
+        return self.broadcast
+
+    # copy backend
+    def get_copy_backend(self):
+        """Get the copy backend selected in the config."""
+        with self.lock:
+            if self.copy_backend is None:
+                self.copy_backend = copybackend.get_backend(
+                    self.config['copy_backend'],
+                    self.config['copy_buffer_size'],
+                    self.config['copy_preallocate'],
+                    self.config['writeback_window']
+                )
+        return self.copy_backend
+
+    # digests
+    def get_hash_cache(self):
+        """Get the persistent source hash cache (file is loaded on use)."""
+        if self.hash_cache is None:
+            self.hash_cache = hashcache.HashCache(
+                os.path.join(
+                    self.path_to_config,
+                    self.config['hash_cache_file']
+                ),
+                self.get_source_folder(),
+                self.config['verify_algorithm'],
+                self.config['hash_threads']
+            )
+        return self.hash_cache
+
+    def get_source_digests(self):
+        """Get digests of all source files - only changed files are hashed."""
+        source_manifest = self.get_manifest()
+        with self.lock:
+            if self.source_digests is None:
+                self.source_digests = self.get_hash_cache().get_digests(
+                    source_manifest
+                )
+        return self.source_digests
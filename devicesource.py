@@ -0,0 +1,427 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+Device sources.
+
+abstraction of where the partition events and devices come from.
+    UdevDeviceSource: the real thing - pyudev netlink monitor
+        (observer thread or read directly in an asyncio event loop)
+    FakeDeviceSource: in-memory devices and events -
+        replays recorded or synthetic add / remove events.
+        needs no hardware, no root and no pyudev.
+
+use as script to stress the SystemManager event handling
+with synthetic events and measure the event to job start latency:
+`./devicesource.py --events 10000 --ports 49`
+`./devicesource.py --events 10000 --ports 49 --asyncio`
+"""
+
+import os
+import json
+import time
+import argparse
+import tempfile
+import threading
+import contextlib
+
+try:
+    import pyudev
+except ImportError:
+    # only the FakeDeviceSource works without pyudev
+    pyudev = None
+
+
+class Error(Exception):
+    """Base class for exceptions in this module."""
+
+    pass
+
+
+##########################################
+# udev
+
+class UdevDeviceSource(object):
+    """Partition events and devices from udev."""
+
+    def __init__(self):
+        """Create new UdevDeviceSource."""
+        super(UdevDeviceSource, self).__init__()
+        if pyudev is None:
+            raise Error("UdevDeviceSource needs pyudev.")
+        self.context = pyudev.Context()
+        self.monitor = None
+        self.observer = None
+        self.loop = None
+        self.event_handler = None
+        self.record_file = None
+
+    def get_device(self, device_path):
+        """Get device for device_path."""
+        return pyudev.Devices.from_path(self.context, device_path)
+
+    def list_usb_partitions(self):
+        """Get all currently connected USB partitions."""
+        return [
+            device
+            for device in self.context.list_devices(
+                subsystem='block',
+                DEVTYPE='partition'
+            )
+            if device.properties.get('ID_BUS') == 'usb'
+        ]
+
+    def start(self, event_handler, record_filename=None):
+        """
+        Call event_handler(action, device) for every partition event.
+
+        record_filename: append every event as json line to this file
+            - can be replayed with FakeDeviceSource.
+        """
+        self._setup(event_handler, record_filename)
+        self.observer = pyudev.MonitorObserver(self.monitor, self._handle)
+        self.observer.start()
+
+    def start_async(self, loop, event_handler, record_filename=None):
+        """
+        Call event_handler(action, device) in loop for every partition event.
+
+        the netlink socket is read directly by the asyncio loop
+        - no observer thread. call from the loop thread.
+        """
+        self._setup(event_handler, record_filename)
+        self.monitor.start()
+        self.loop = loop
+        self.loop.add_reader(self.monitor.fileno(), self._read_monitor)
+
+    def _setup(self, event_handler, record_filename):
+        self.event_handler = event_handler
+        if record_filename:
+            self.record_file = open(record_filename, 'a')
+        self.monitor = pyudev.Monitor.from_netlink(self.context)
+        self.monitor.filter_by('block', device_type="partition")
+
+    def _read_monitor(self):
+        # handle all events that are ready - never blocks
+        while True:
+            device = self.monitor.poll(timeout=0)
+            if device is None:
+                break
+            self._handle(device.action, device)
+
+    def _handle(self, action, device):
+        if self.record_file:
+            self.record_file.write(
+                json.dumps(device_to_event(action, device)) + "\n"
+            )
+            self.record_file.flush()
+        self.event_handler(action, device)
+
+    def stop(self):
+        """Stop event delivery - for start_async call from the loop thread."""
+        if self.observer:
+            self.observer.stop()
+            self.observer = None
+        if self.loop:
+            self.loop.remove_reader(self.monitor.fileno())
+            self.loop = None
+        if self.record_file:
+            self.record_file.close()
+            self.record_file = None
+
+
+def device_to_event(action, device):
+    """Get json serializable event for action and device."""
+    usb_device = device.find_parent('usb')
+    event = {
+        'action': action,
+        'device_path': device.device_path,
+        'device_node': device.device_node,
+        'properties': dict(device.properties),
+        'usb_path': None,
+        'time': time.time(),
+    }
+    if usb_device is not None:
+        event['usb_path'] = usb_device.device_path
+    return event
+
+
+##########################################
+# fake
+
+class FakeDevice(object):
+    """Minimal in-memory stand-in for pyudev.Device."""
+
+    def __init__(
+        self,
+        device_path,
+        device_node=None,
+        properties=None,
+        parents=None,
+        action=None
+    ):
+        """
+        Create new FakeDevice.
+
+        parents: dict subsystem -> FakeDevice (for find_parent)
+        """
+        super(FakeDevice, self).__init__()
+        self.device_path = device_path
+        self.device_node = device_node
+        if properties is None:
+            properties = {}
+        self.properties = properties
+        if parents is None:
+            parents = {}
+        self.parents = parents
+        self.action = action
+        # time.monotonic() of the last emitted event for this device
+        self.event_time = None
+
+    def find_parent(self, subsystem, device_type=None):
+        """Get parent device of subsystem."""
+        return self.parents.get(subsystem)
+
+    def __str__(self):
+        """Device as text."""
+        return "FakeDevice('{}')".format(self.device_path)
+
+
+def create_fake_partition(
+    port_id,
+    device_name,
+    label="SUN",
+    bus_path="/devices/pci0000:00/0000:00:1d.0"
+):
+    """
+    Create FakeDevice for partition 1 of a stick in port port_id.
+
+    port_id like 2-1.2.2.4 - device_name like sdc.
+    """
+    bus = port_id.split('-')[0]
+    levels = port_id.split('.')
+    # /devices/pci0000:00/0000:00:1d.0/usb2/2-1/2-1.2/2-1.2.2/2-1.2.2.4
+    usb_hub_path = bus_path + "/usb" + bus
+    for index in range(len(levels)):
+        usb_hub_path += "/" + '.'.join(levels[:index + 1])
+    usb_path = usb_hub_path + "/" + port_id + ":1.0"
+    device_path = (
+        usb_path +
+        "/host0/target0:0:0/0:0:0:0/block/{name}/{name}1".format(
+            name=device_name
+        )
+    )
+    usb_device = FakeDevice(usb_path, properties={'SUBSYSTEM': 'usb'})
+    return FakeDevice(
+        device_path,
+        device_node="/dev/{}1".format(device_name),
+        properties={
+            'ID_BUS': 'usb',
+            'ID_FS_LABEL': label,
+            'ID_FS_TYPE': 'vfat',
+            'ID_SERIAL': "FAKE_{}".format(port_id.replace('.', '_')),
+            'DEVTYPE': 'partition',
+            'SUBSYSTEM': 'block',
+        },
+        parents={'usb': usb_device},
+    )
+
+
+class FakeDeviceSource(object):
+    """In-memory device source with replayable events."""
+
+    def __init__(self):
+        """Create new FakeDeviceSource."""
+        super(FakeDeviceSource, self).__init__()
+        self.devices = {}
+        self.event_handler = None
+
+    def add_device(self, device):
+        """Register device so it can be looked up by device_path."""
+        self.devices[device.device_path] = device
+
+    def get_device(self, device_path):
+        """Get device for device_path."""
+        try:
+            return self.devices[device_path]
+        except KeyError:
+            raise Error("no fake device '{}'".format(device_path))
+
+    def list_usb_partitions(self):
+        """Get all registered USB partitions."""
+        return [
+            device
+            for device in self.devices.values()
+            if device.properties.get('ID_BUS') == 'usb'
+        ]
+
+    def start(self, event_handler, record_filename=None):
+        """Deliver events to event_handler(action, device)."""
+        self.event_handler = event_handler
+
+    def start_async(self, loop, event_handler, record_filename=None):
+        """Deliver events to event_handler(action, device) in loop."""
+        def handler(action, device):
+            # emit can be called from any thread
+            loop.call_soon_threadsafe(event_handler, action, device)
+        self.event_handler = handler
+
+    def stop(self):
+        """Stop event delivery."""
+        self.event_handler = None
+
+    def emit(self, action, device):
+        """Emit one event - like a stick being plugged in or pulled."""
+        if action == 'add':
+            self.add_device(device)
+        device.action = action
+        device.event_time = time.monotonic()
+        if self.event_handler:
+            self.event_handler(action, device)
+
+    def replay(self, events, speed=None):
+        """
+        Replay events (dicts like from device_to_event).
+
+        speed: None replays as fast as possible -
+            1.0 keeps the recorded timing.
+        """
+        time_last = None
+        for event in events:
+            if speed and time_last is not None:
+                time.sleep(max(0, event['time'] - time_last) / speed)
+            time_last = event.get('time')
+            device = self.devices.get(event['device_path'])
+            if device is None:
+                parents = {}
+                if event.get('usb_path'):
+                    parents['usb'] = FakeDevice(event['usb_path'])
+                device = FakeDevice(
+                    event['device_path'],
+                    event.get('device_node'),
+                    dict(event.get('properties', {})),
+                    parents
+                )
+            self.emit(event['action'], device)
+
+    @staticmethod
+    def load_events(filename):
+        """Load recorded events (json lines)."""
+        with open(filename, 'r') as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+
+def synthetic_events(event_count, port_count, hub="2-1"):
+    """
+    Generate add / remove events for port_count ports.
+
+    every port gets alternating add and remove events.
+    """
+    # 7 port hubs - like the usual USB 2.0 towers
+    ports = []
+    for index in range(port_count):
+        hub_index, port_index = divmod(index, 7)
+        ports.append("{}.{}.{}".format(hub, hub_index + 1, port_index + 1))
+    devices = [
+        create_fake_partition(port_id, "sd{}".format(index))
+        for index, port_id in enumerate(ports)
+    ]
+    plugged = [False] * port_count
+    for index in range(event_count):
+        port_index = index % port_count
+        if plugged[port_index]:
+            yield ('remove', devices[port_index])
+        else:
+            yield ('add', devices[port_index])
+        plugged[port_index] = not plugged[port_index]
+
+
+##########################################
+def stress_test(event_count, port_count, use_asyncio=False):
+    """Run synthetic events through a SystemManager in copy mode."""
+    # import here - SystemManager imports this module.
+    from ustick_copy import SystemManager
+    from usbstick import USBStick
+    if use_asyncio:
+        from asynccore import AsyncSystemManager as SystemManager
+
+    latencies = []
+    latencies_lock = threading.Lock()
+
+    class NullStick(USBStick):
+        """Stick job that only measures when it was started."""
+
+        def run(self):
+            with latencies_lock:
+                latencies.append(time.monotonic() - self.device.event_time)
+            try:
+                self.show_port_message("done")
+            finally:
+                if self.job_done_callback:
+                    self.job_done_callback(self)
+
+    device_source = FakeDeviceSource()
+    config_dir = tempfile.mkdtemp()
+    config_filename = os.path.join(config_dir, "config.json")
+    # SystemManager falls back to the script folder for missing files.
+    with open(config_filename, 'w') as f:
+        f.write("{}")
+    manager = SystemManager(config_filename, device_source=device_source)
+    manager.stick_class = NullStick
+    # map all ports so stick_messages_handler has to work for every event
+    events = list(synthetic_events(event_count, port_count))
+    for action, device in events[:port_count]:
+        port_path = device.find_parent('usb').device_path
+        manager.config['port_map'][port_path] = len(manager.config['port_map'])
+    # source is never read by NullStick
+    manager.config['stick_config']['source_folder'] = config_dir
+    manager.config['stick_config']['copy_engine'] = 'single'
+    # the status table is printed for every event - hide it.
+    with open(os.devnull, 'w') as devnull:
+        with contextlib.redirect_stdout(devnull):
+            manager.start_copy()
+            time_start = time.monotonic()
+            for action, device in events:
+                device_source.emit(action, device)
+            manager.wait_for_events()
+            duration = time.monotonic() - time_start
+            manager.stop()
+    latencies.sort()
+    print("events: {} in {:.3f}s ({:.0f} events/s)".format(
+        event_count,
+        duration,
+        event_count / duration
+    ))
+    if latencies:
+        print("jobs started: {}".format(len(latencies)))
+        print("event to job start latency: p50 {:.3f}ms p99 {:.3f}ms".format(
+            latencies[len(latencies) // 2] * 1000,
+            latencies[int(len(latencies) * 0.99)] * 1000
+        ))
+
+
+##########################################
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description="stress SystemManager with fake udev events"
+    )
+    parser.add_argument(
+        "--events",
+        help="count of synthetic events (default: 10000)",
+        type=int,
+        default=10000
+    )
+    parser.add_argument(
+        "--ports",
+        help="count of simulated ports (default: 49)",
+        type=int,
+        default=49
+    )
+    parser.add_argument(
+        "--asyncio",
+        help="use the asyncio core (asynccore.AsyncSystemManager)",
+        action="store_true"
+    )
+    args = parser.parse_args()
+    stress_test(args.events, args.ports, args.asyncio)
@@ -0,0 +1,679 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+FAT filesystem helper.
+
+works directly on the partition node (or an image file) -
+no fatlabel / mkfs.fat process per stick.
+    read_label / write_label: patch the volume label in the boot sector
+        (and its FAT32 backup) and in the root directory entry.
+        works for FAT12 / FAT16 / FAT32.
+    format_fat32: quick format - the data region is aligned to the
+        flash erase blocks (sysfs hints) and the boot sectors, FSInfo
+        and empty FAT are computed only once per partition size.
+
+use as script to show or set the label or to format:
+`./fatfs.py /dev/sdc1`
+`./fatfs.py /dev/sdc1 NEWLABEL`
+`./fatfs.py /dev/sdc1 NEWLABEL --format`
+"""
+
+import os
+import sys
+import time
+import struct
+import threading
+import collections
+
+
+class Error(Exception):
+    """Base class for exceptions in this module."""
+
+    pass
+
+
+##########################################
+# label
+
+label_length_max = 11
+# not allowed in short names and labels
+label_chars_invalid = '"*+,./:;<=>?[\\]|'
+
+
+def check_label(label):
+    """
+    Get label as 11 bytes for the filesystem - raise Error if invalid.
+
+    lowercase letters are converted to uppercase (like fatlabel).
+    """
+    # same length rule as the interactive 'label:' command always used
+    if not (1 < len(label) <= label_length_max):
+        raise Error(
+            "label '{}' must have 2 to {} characters.".format(
+                label, label_length_max
+            )
+        )
+    if label.startswith(' '):
+        raise Error("label '{}' must not start with a space.".format(label))
+    for char in label:
+        if ord(char) < 0x20 or ord(char) > 0x7e or char in label_chars_invalid:
+            raise Error(
+                "label '{}' contains invalid character '{}'.".format(
+                    label, char
+                )
+            )
+    return label.upper().encode('ascii').ljust(label_length_max, b' ')
+
+
+def is_valid_label(label):
+    """Check if label can be used as FAT volume label."""
+    try:
+        check_label(label)
+    except Error:
+        return False
+    return True
+
+
+##########################################
+# boot sector
+
+BootSector = collections.namedtuple(
+    'BootSector',
+    [
+        'bytes_per_sector',
+        'sectors_per_cluster',
+        'reserved_sectors',
+        'fat_count',
+        'root_entries',
+        'total_sectors',
+        'fat_sectors',
+        # FAT32 only - 0 for FAT12 / FAT16
+        'root_cluster',
+        'backup_boot_sector',
+        # 12, 16 or 32
+        'fat_type',
+        'cluster_count',
+        'first_data_sector',
+        # FAT12 / FAT16 fixed root directory
+        'root_dir_sector',
+        'root_dir_sectors',
+        # offset of the extended boot signature (0x29) and the label
+        'boot_signature_offset',
+        'label_offset',
+    ]
+)
+
+
+def parse_boot_sector(data):
+    """Parse and validate boot sector - raise Error if it is no FAT."""
+    if len(data) < 512 or data[510:512] != b'\x55\xaa':
+        raise Error("no boot sector signature - not a FAT filesystem.")
+    (
+        bytes_per_sector,
+        sectors_per_cluster,
+        reserved_sectors,
+        fat_count,
+        root_entries,
+        total_sectors_16,
+        media,
+        fat_sectors_16,
+    ) = struct.unpack_from('<HBHBHHBH', data, 11)
+    total_sectors_32, = struct.unpack_from('<I', data, 32)
+    fat_sectors_32, = struct.unpack_from('<I', data, 36)
+    if bytes_per_sector not in (512, 1024, 2048, 4096):
+        raise Error("invalid bytes per sector {}.".format(bytes_per_sector))
+    if (
+        sectors_per_cluster == 0 or
+        sectors_per_cluster & (sectors_per_cluster - 1)
+    ):
+        raise Error(
+            "invalid sectors per cluster {}.".format(sectors_per_cluster)
+        )
+    if reserved_sectors == 0 or fat_count not in (1, 2):
+        raise Error("invalid reserved sectors or FAT count.")
+    total_sectors = total_sectors_16 or total_sectors_32
+    fat_sectors = fat_sectors_16 or fat_sectors_32
+    root_dir_sectors = (
+        (root_entries * 32 + bytes_per_sector - 1) // bytes_per_sector
+    )
+    root_dir_sector = reserved_sectors + fat_count * fat_sectors
+    first_data_sector = root_dir_sector + root_dir_sectors
+    if fat_sectors == 0 or first_data_sector >= total_sectors:
+        raise Error("invalid FAT size.")
+    cluster_count = (
+        (total_sectors - first_data_sector) // sectors_per_cluster
+    )
+    # the FAT type is defined by the cluster count only
+    if cluster_count < 4085:
+        fat_type = 12
+    elif cluster_count < 65525:
+        fat_type = 16
+    else:
+        fat_type = 32
+    root_cluster = 0
+    backup_boot_sector = 0
+    if fat_type == 32:
+        if fat_sectors_16 != 0 or root_entries != 0:
+            raise Error("invalid FAT32 boot sector.")
+        root_cluster, = struct.unpack_from('<I', data, 44)
+        backup_boot_sector, = struct.unpack_from('<H', data, 50)
+        boot_signature_offset = 66
+        label_offset = 71
+    else:
+        boot_signature_offset = 38
+        label_offset = 43
+    return BootSector(
+        bytes_per_sector=bytes_per_sector,
+        sectors_per_cluster=sectors_per_cluster,
+        reserved_sectors=reserved_sectors,
+        fat_count=fat_count,
+        root_entries=root_entries,
+        total_sectors=total_sectors,
+        fat_sectors=fat_sectors,
+        root_cluster=root_cluster,
+        backup_boot_sector=backup_boot_sector,
+        fat_type=fat_type,
+        cluster_count=cluster_count,
+        first_data_sector=first_data_sector,
+        root_dir_sector=root_dir_sector,
+        root_dir_sectors=root_dir_sectors,
+        boot_signature_offset=boot_signature_offset,
+        label_offset=label_offset,
+    )
+
+
+def read_boot_sector(fd):
+    """Read and parse the boot sector of fd."""
+    return parse_boot_sector(os.pread(fd, 512, 0))
+
+
+##########################################
+# directories
+
+# directory entry attributes
+ATTR_READ_ONLY = 0x01
+ATTR_HIDDEN = 0x02
+ATTR_SYSTEM = 0x04
+ATTR_VOLUME_ID = 0x08
+ATTR_DIRECTORY = 0x10
+ATTR_ARCHIVE = 0x20
+ATTR_LONG_NAME = 0x0f
+
+# FAT32 entries >= this value mark the end of a cluster chain
+fat32_end_of_chain = 0x0ffffff8
+
+
+def get_fat_time(timestamp):
+    """Get FAT (time, date) for a unix timestamp in local time."""
+    t = time.localtime(timestamp)
+    year = min(max(t.tm_year, 1980), 2107)
+    fat_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    fat_date = ((year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    return fat_time, fat_date
+
+
+def _get_root_dir_regions(fd, boot):
+    """Get (offset, size) of all root directory regions."""
+    bps = boot.bytes_per_sector
+    if boot.fat_type != 32:
+        return [(boot.root_dir_sector * bps, boot.root_dir_sectors * bps)]
+    cluster_size = boot.sectors_per_cluster * bps
+    fat_offset = boot.reserved_sectors * bps
+    regions = []
+    cluster = boot.root_cluster
+    while 2 <= cluster < fat32_end_of_chain:
+        if len(regions) > boot.cluster_count:
+            raise Error("root directory cluster chain has a loop.")
+        if cluster >= boot.cluster_count + 2:
+            raise Error("invalid root directory cluster {}.".format(cluster))
+        sector = (
+            boot.first_data_sector +
+            (cluster - 2) * boot.sectors_per_cluster
+        )
+        regions.append((sector * bps, cluster_size))
+        cluster, = struct.unpack(
+            '<I', os.pread(fd, 4, fat_offset + cluster * 4)
+        )
+        cluster &= 0x0fffffff
+    return regions
+
+
+def _find_label_entry(fd, boot):
+    """
+    Get (offset of volume label entry, offset of first free entry).
+
+    each is None if not found.
+    """
+    free_offset = None
+    for region_offset, region_size in _get_root_dir_regions(fd, boot):
+        data = os.pread(fd, region_size, region_offset)
+        for pos in range(0, len(data), 32):
+            first = data[pos]
+            attr = data[pos + 11]
+            if first == 0x00:
+                # end of directory - all following entries are free too
+                if free_offset is None:
+                    free_offset = region_offset + pos
+                return None, free_offset
+            if first == 0xe5:
+                if free_offset is None:
+                    free_offset = region_offset + pos
+                continue
+            if attr == ATTR_LONG_NAME:
+                continue
+            if attr & ATTR_VOLUME_ID and not attr & ATTR_DIRECTORY:
+                return region_offset + pos, free_offset
+    return None, free_offset
+
+
+def read_label(node):
+    """Get volume label of the FAT filesystem on node."""
+    fd = os.open(node, os.O_RDONLY)
+    try:
+        boot = read_boot_sector(fd)
+        label_entry_offset, free_offset = _find_label_entry(fd, boot)
+        if label_entry_offset is not None:
+            label = os.pread(fd, 11, label_entry_offset)
+        else:
+            label = os.pread(fd, 11, boot.label_offset)
+    finally:
+        os.close(fd)
+    return label.decode('ascii', 'replace').rstrip(' ')
+
+
+def read_volume_id(node):
+    """
+    Get volume id (serial number) of the FAT filesystem on node.
+
+    formatted like the udev ID_FS_UUID ('1A2B-3C4D') -
+    None if the boot sector has no extended boot signature.
+    """
+    fd = os.open(node, os.O_RDONLY)
+    try:
+        data = os.pread(fd, 512, 0)
+    finally:
+        os.close(fd)
+    boot = parse_boot_sector(data)
+    if data[boot.boot_signature_offset] != 0x29:
+        return None
+    volume_id, = struct.unpack_from(
+        '<I',
+        data,
+        boot.boot_signature_offset + 1
+    )
+    return "{:04X}-{:04X}".format(volume_id >> 16, volume_id & 0xffff)
+
+
+def write_label(node, label):
+    """Set volume label in boot sector(s) and root directory of node."""
+    label_bytes = check_label(label)
+    fd = os.open(node, os.O_RDWR)
+    try:
+        boot = read_boot_sector(fd)
+        label_entry_offset, free_offset = _find_label_entry(fd, boot)
+        if label_entry_offset is None:
+            if free_offset is None:
+                raise Error("root directory is full - no label entry.")
+            fat_time, fat_date = get_fat_time(time.time())
+            entry = struct.pack(
+                '<11sBBBHHHHHHHI',
+                label_bytes,
+                ATTR_VOLUME_ID,
+                0, 0, 0, 0, 0, 0,
+                fat_time,
+                fat_date,
+                0, 0
+            )
+            os.pwrite(fd, entry, free_offset)
+        else:
+            os.pwrite(fd, label_bytes, label_entry_offset)
+        boot_sectors = [0]
+        if boot.backup_boot_sector:
+            boot_sectors.append(boot.backup_boot_sector)
+        for sector in boot_sectors:
+            offset = sector * boot.bytes_per_sector
+            signature = os.pread(fd, 1, offset + boot.boot_signature_offset)
+            # without extended boot signature there is no label field
+            if signature == b'\x29':
+                os.pwrite(fd, label_bytes, offset + boot.label_offset)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+##########################################
+# format
+
+# flash erase blocks / allocation units are usually 4MiB
+alignment_default = 4 * 1024 * 1024
+# large clusters mean less FAT updates - 32KiB is the usual
+# (SD association) choice for sticks from 2GB to 32GB.
+cluster_sizes = (32768, 16384, 8192, 4096, 2048, 1024, 512)
+# FAT32 needs at least 65525 clusters - keep a margin like mkfs.fat
+fat32_clusters_min = 65525 + 16
+fat32_clusters_max = 0x0ffffff5 - 2
+sector_size = 512
+
+Geometry = collections.namedtuple(
+    'Geometry',
+    [
+        # partition size in bytes
+        'size',
+        # partition start on the disk in bytes
+        'start',
+        # data region alignment in bytes (from the sysfs hints)
+        'alignment',
+    ]
+)
+
+Fat32Layout = collections.namedtuple(
+    'Fat32Layout',
+    [
+        'total_sectors',
+        'sectors_per_cluster',
+        'reserved_sectors',
+        'fat_sectors',
+        'cluster_count',
+        'hidden_sectors',
+    ]
+)
+
+Fat32Skeleton = collections.namedtuple(
+    'Fat32Skeleton',
+    [
+        'layout',
+        # boot sector, FSInfo and their backups - volume id not set
+        'reserved_region',
+        # first FAT sector with the reserved entries and the root cluster
+        'fat_head',
+        # root directory cluster with the volume label entry
+        'root_cluster',
+    ]
+)
+
+_skeleton_cache = {}
+_skeleton_cache_lock = threading.Lock()
+
+
+def _read_sysfs_int(path, default=0):
+    try:
+        with open(path, 'r') as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return default
+
+
+def get_geometry(node):
+    """Get size, start and alignment hints for node from sysfs."""
+    fd = os.open(node, os.O_RDONLY)
+    try:
+        size = os.lseek(fd, 0, os.SEEK_END)
+    finally:
+        os.close(fd)
+    start = 0
+    alignment = 0
+    sys_path = os.path.join(
+        "/sys/class/block",
+        os.path.basename(os.path.realpath(node))
+    )
+    if os.path.exists(sys_path):
+        queue_path = os.path.join(sys_path, "queue")
+        if os.path.exists(os.path.join(sys_path, "partition")):
+            start = _read_sysfs_int(os.path.join(sys_path, "start")) * 512
+            queue_path = os.path.join(sys_path, "..", "queue")
+        start -= _read_sysfs_int(os.path.join(sys_path, "alignment_offset"))
+        # the largest hint is closest to the erase block size
+        alignment = max(
+            _read_sysfs_int(os.path.join(queue_path, name))
+            for name in (
+                "optimal_io_size",
+                "discard_granularity",
+                "minimum_io_size",
+                "physical_block_size",
+            )
+        )
+    alignment = max(alignment, alignment_default)
+    # small partitions - do not waste more than 1/64 for the alignment
+    while alignment > sector_size and alignment * 64 > size:
+        alignment //= 2
+    return Geometry(size=size, start=start, alignment=alignment)
+
+
+def plan_fat32(size, start=0, alignment=alignment_default, cluster_size=0):
+    """
+    Get Fat32Layout for a partition of size bytes at start.
+
+    the first data cluster starts at a multiple of alignment
+    (counted from the start of the disk).
+    cluster_size 0 selects the largest cluster size that is allowed.
+    """
+    total_sectors = min(size // sector_size, 0xffffffff)
+    if cluster_size:
+        candidates = (cluster_size,)
+    else:
+        candidates = cluster_sizes
+    for candidate in candidates:
+        sectors_per_cluster = candidate // sector_size
+        if (
+            sectors_per_cluster < 1 or
+            sectors_per_cluster > 128 or
+            sectors_per_cluster & (sectors_per_cluster - 1)
+        ):
+            raise Error("invalid cluster size {}.".format(candidate))
+        reserved_sectors = 32
+        # upper bound - a few unused FAT entries do not matter
+        clusters = (total_sectors - reserved_sectors) // sectors_per_cluster
+        fat_sectors = ((clusters + 2) * 4 + sector_size - 1) // sector_size
+        data_start = (reserved_sectors + 2 * fat_sectors) * sector_size
+        # move the data region onto the next erase block boundary
+        padding = -(start + data_start) % alignment
+        reserved_sectors += padding // sector_size
+        if reserved_sectors > 0xffff:
+            raise Error("alignment {} is too large.".format(alignment))
+        cluster_count = (
+            (total_sectors - reserved_sectors - 2 * fat_sectors) //
+            sectors_per_cluster
+        )
+        if fat32_clusters_min <= cluster_count <= fat32_clusters_max:
+            return Fat32Layout(
+                total_sectors=total_sectors,
+                sectors_per_cluster=sectors_per_cluster,
+                reserved_sectors=reserved_sectors,
+                fat_sectors=fat_sectors,
+                cluster_count=cluster_count,
+                hidden_sectors=max(start, 0) // sector_size,
+            )
+    raise Error(
+        "no FAT32 layout for {} bytes with cluster size {}.".format(
+            size, cluster_size or "auto"
+        )
+    )
+
+
+def _create_boot_sector(layout, label_bytes):
+    boot = bytearray(sector_size)
+    boot[0:3] = b'\xeb\x58\x90'
+    boot[3:11] = b'MSWIN4.1'
+    struct.pack_into(
+        '<HBHBHHBHHHII',
+        boot,
+        11,
+        sector_size,
+        layout.sectors_per_cluster,
+        layout.reserved_sectors,
+        # FAT count
+        2,
+        # root entries / total sectors 16 - 0 for FAT32
+        0,
+        0,
+        # media: fixed disk
+        0xf8,
+        0,
+        # sectors per track / heads - only for old BIOS
+        63,
+        255,
+        layout.hidden_sectors,
+        layout.total_sectors
+    )
+    struct.pack_into(
+        '<IHHIHH',
+        boot,
+        36,
+        layout.fat_sectors,
+        # ext flags: FAT mirroring / version 0.0
+        0,
+        0,
+        # root directory cluster / FSInfo sector / backup boot sector
+        2,
+        1,
+        6
+    )
+    # drive number / extended boot signature
+    boot[64] = 0x80
+    boot[66] = 0x29
+    # volume id (67) is set per stick
+    boot[71:82] = label_bytes
+    boot[82:90] = b'FAT32   '
+    # not bootable: int 18h (try next boot device) and loop
+    boot[90:94] = b'\xcd\x18\xeb\xfe'
+    boot[510:512] = b'\x55\xaa'
+    return boot
+
+
+def _create_fsinfo(layout):
+    fsinfo = bytearray(sector_size)
+    struct.pack_into('<I', fsinfo, 0, 0x41615252)
+    struct.pack_into(
+        '<III',
+        fsinfo,
+        484,
+        0x61417272,
+        # free clusters (root uses one) / next free cluster
+        layout.cluster_count - 1,
+        3
+    )
+    struct.pack_into('<I', fsinfo, 508, 0xaa550000)
+    return fsinfo
+
+
+def _create_skeleton(layout, label_bytes):
+    boot = _create_boot_sector(layout, label_bytes)
+    fsinfo = _create_fsinfo(layout)
+    reserved_region = bytearray(layout.reserved_sectors * sector_size)
+    for sector in (0, 6):
+        offset = sector * sector_size
+        reserved_region[offset:offset + sector_size] = boot
+        offset += sector_size
+        reserved_region[offset:offset + sector_size] = fsinfo
+        # third boot sector - only the signature
+        offset += sector_size
+        reserved_region[offset + 510:offset + 512] = b'\x55\xaa'
+    fat_head = bytearray(sector_size)
+    # media entry / clean shutdown entry / root directory end of chain
+    struct.pack_into('<III', fat_head, 0, 0x0ffffff8, 0x0fffffff, 0x0fffffff)
+    root_cluster = bytearray(layout.sectors_per_cluster * sector_size)
+    fat_time, fat_date = get_fat_time(time.time())
+    struct.pack_into(
+        '<11sBBBHHHHHHHI',
+        root_cluster,
+        0,
+        label_bytes,
+        ATTR_VOLUME_ID,
+        0, 0, 0, 0, 0, 0,
+        fat_time,
+        fat_date,
+        0, 0
+    )
+    return Fat32Skeleton(
+        layout=layout,
+        reserved_region=bytes(reserved_region),
+        fat_head=bytes(fat_head),
+        root_cluster=bytes(root_cluster),
+    )
+
+
+def get_skeleton(geometry, label, cluster_size=0, alignment=0):
+    """Get cached Fat32Skeleton for geometry and label."""
+    label_bytes = check_label(label)
+    if not alignment:
+        alignment = geometry.alignment
+    key = (geometry.size, geometry.start, alignment, cluster_size, label_bytes)
+    with _skeleton_cache_lock:
+        skeleton = _skeleton_cache.get(key)
+        if skeleton is None:
+            layout = plan_fat32(
+                geometry.size,
+                geometry.start,
+                alignment,
+                cluster_size
+            )
+            skeleton = _create_skeleton(layout, label_bytes)
+            _skeleton_cache[key] = skeleton
+    return skeleton
+
+
+def set_volume_id(reserved_region, volume_id=None):
+    """Set volume id in both boot sectors - random if None."""
+    if volume_id is None:
+        volume_id = os.urandom(4)
+    for sector in (0, 6):
+        offset = sector * sector_size + 67
+        reserved_region[offset:offset + 4] = volume_id
+    return volume_id
+
+
+def _write_zeros(fd, offset, size, chunk_size=1024*1024):
+    zeros = bytes(min(size, chunk_size))
+    end = offset + size
+    while offset < end:
+        offset += os.pwrite(fd, zeros[:end - offset], offset)
+
+
+def format_fat32(node, label, cluster_size=0, alignment=0):
+    """
+    Quick format node as FAT32 - returns the Fat32Layout.
+
+    cluster_size / alignment 0 means automatic.
+    only the reserved region, both FATs and the root directory
+    are written - the data region is not touched.
+    """
+    skeleton = get_skeleton(get_geometry(node), label, cluster_size, alignment)
+    layout = skeleton.layout
+    reserved_region = bytearray(skeleton.reserved_region)
+    # every stick gets its own volume id (serial number)
+    set_volume_id(reserved_region)
+    fd = os.open(node, os.O_WRONLY)
+    try:
+        os.pwrite(fd, reserved_region, 0)
+        fat_size = layout.fat_sectors * sector_size
+        for index in range(2):
+            fat_offset = len(reserved_region) + index * fat_size
+            os.pwrite(fd, skeleton.fat_head, fat_offset)
+            _write_zeros(
+                fd,
+                fat_offset + sector_size,
+                fat_size - sector_size
+            )
+        os.pwrite(
+            fd,
+            skeleton.root_cluster,
+            len(reserved_region) + 2 * fat_size
+        )
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    return layout
+
+
+##########################################
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2:
+        print("usage: fatfs.py NODE [LABEL [--format]]")
+        sys.exit(1)
+    if len(sys.argv) > 3 and sys.argv[3] == '--format':
+        print(format_fat32(sys.argv[1], sys.argv[2]))
+    elif len(sys.argv) > 2:
+        write_label(sys.argv[1], sys.argv[2])
+    print("label: '{}'".format(read_label(sys.argv[1])))
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+FAT32 image.
+
+build one FAT32 filesystem image per partition size from the session
+manifest (with the source filter applied) and clone it block-wise
+onto the sticks.
+this replaces thousands of small FAT writes per stick
+with one big sequential write.
+
+the image is written by the FatWriter into a sparse file exactly as
+large as the partition - so the stick gets a full size volume.
+the free clusters stay holes in the image and are not written:
+    the data segments come first (SEEK_DATA / SEEK_HOLE)
+    then both FATs
+    then the reserved region with a new volume id for every stick -
+        the boot sector is written last, so an interrupted stick
+        never looks like a valid filesystem.
+"""
+
+import os
+import errno
+
+import fatfs
+import writeback
+
+
+class Error(Exception):
+    """Base class for exceptions in this module."""
+
+    pass
+
+
+# 4MiB chunks are large enough to run the flash at full speed.
+chunk_size_default = 4 * 1024 * 1024
+
+
+def build_image(
+    fat_writer,
+    image_file,
+    geometry,
+    label,
+    cluster_size=0,
+    alignment=0
+):
+    """
+    Build sparse FAT32 image for partitions with geometry.
+
+    fat_writer: fatwriter.FatWriter with the source manifest.
+    raises fatwriter.Error if the source does not fit.
+    """
+    image_file = os.path.expanduser(image_file)
+    image_dir = os.path.dirname(image_file)
+    if image_dir and not os.path.exists(image_dir):
+        os.makedirs(image_dir)
+    # create sparse file - an old image must not leave data behind
+    with open(image_file, 'wb') as f:
+        f.truncate(geometry.size)
+    return fat_writer.write(
+        image_file,
+        label,
+        cluster_size,
+        alignment,
+        geometry=geometry
+    )
+
+
+def get_device_size(node):
+    """Get size of block device or file in bytes."""
+    fd = os.open(node, os.O_RDONLY)
+    try:
+        size = os.lseek(fd, 0, os.SEEK_END)
+    finally:
+        os.close(fd)
+    return size
+
+
+def get_data_segments(fd, start, end):
+    """Get (offset, size) of the parts of fd from start to end with data."""
+    if not hasattr(os, 'SEEK_DATA'):
+        return [(start, end - start)]
+    segments = []
+    offset = start
+    while offset < end:
+        try:
+            data = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as why:
+            if why.errno == errno.ENXIO:
+                # only a hole up to the end of the file
+                break
+            # no hole support - everything is data
+            segments.append((offset, end - offset))
+            break
+        if data >= end:
+            break
+        hole = min(os.lseek(fd, data, os.SEEK_HOLE), end)
+        segments.append((data, hole - data))
+        offset = hole
+    return segments
+
+
+def _get_segments(fd):
+    """Get (offset, size) of everything to write - in write order."""
+    boot = fatfs.read_boot_sector(fd)
+    reserved_size = boot.reserved_sectors * boot.bytes_per_sector
+    data_offset = boot.first_data_sector * boot.bytes_per_sector
+    segments = get_data_segments(
+        fd,
+        data_offset,
+        os.lseek(fd, 0, os.SEEK_END)
+    )
+    # the old FATs on the stick have to be overwritten completely
+    segments.append((reserved_size, data_offset - reserved_size))
+    segments.append((0, reserved_size))
+    return segments
+
+
+def get_image_bytes(image_file):
+    """Get bytes write_image writes - for the progress total."""
+    fd = os.open(image_file, os.O_RDONLY)
+    try:
+        return sum(size for offset, size in _get_segments(fd))
+    finally:
+        os.close(fd)
+
+
+def _copy_segment(fd_in, fd_out, offset, size, view, window):
+    end = offset + size
+    while offset < end:
+        part = view[:min(len(view), end - offset)]
+        size_read = os.preadv(fd_in, [part], offset)
+        if not size_read:
+            raise Error("image ends before its last segment.")
+        pos = 0
+        while pos < size_read:
+            pos += os.pwrite(fd_out, part[pos:size_read], offset + pos)
+        offset += size_read
+        window.add(size_read)
+
+
+def write_image(
+    image_file,
+    node,
+    chunk_size=chunk_size_default,
+    progress=None,
+    writeback_window=0
+):
+    """
+    Clone image_file onto node - returns bytes written.
+
+    the holes of the image (free clusters) are skipped.
+    raises Error if the image is larger than node.
+    progress: optional Progress object - gets every written chunk.
+    writeback_window: see writeback.WritebackWindow
+    """
+    image_size = os.path.getsize(image_file)
+    device_size = get_device_size(node)
+    if image_size > device_size:
+        raise Error(
+            "image '{}' ({} bytes) does not fit on '{}' ({} bytes)".format(
+                image_file, image_size, node, device_size
+            )
+        )
+    view = memoryview(bytearray(chunk_size))
+    written = 0
+    fd_in = os.open(image_file, os.O_RDONLY)
+    try:
+        segments = _get_segments(fd_in)
+        reserved_offset, reserved_size = segments.pop()
+        reserved_region = bytearray(
+            os.pread(fd_in, reserved_size, reserved_offset)
+        )
+        # every stick gets its own volume id (serial number)
+        fatfs.set_volume_id(reserved_region)
+        fd_out = os.open(node, os.O_WRONLY)
+        try:
+            # the old filesystem is invalid from now on
+            os.pwrite(fd_out, bytes(fatfs.sector_size), 0)
+            # the end of a segment goes to the stick
+            # while the next segment is written
+            window = writeback.WritebackWindow(writeback_window, progress)
+            try:
+                for offset, size in segments:
+                    window.open_file(fd_out, offset)
+                    _copy_segment(fd_in, fd_out, offset, size, view, window)
+                    window.close_file()
+                    written += size
+                window.finish()
+            finally:
+                window.close()
+            os.fsync(fd_out)
+            os.pwrite(fd_out, reserved_region, reserved_offset)
+            os.fsync(fd_out)
+            written += reserved_size
+            if progress:
+                progress.add(reserved_size)
+        finally:
+            os.close(fd_out)
+    finally:
+        os.close(fd_in)
+    return written
@@ -0,0 +1,543 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+Userspace FAT32 writer.
+
+writes a new FAT32 filesystem with the content of the source manifest
+directly onto the raw partition - no mount and no kernel FAT driver.
+the layout is planned once per partition size:
+    cluster 2...: all directories (root first) in one contiguous run
+    after that: all files in manifest order - every file contiguous
+a stick gets one sequential data stream,
+then one write for all directories and one write per FAT.
+the boot sector is written last - so an interrupted stick never
+looks like a valid filesystem.
+"""
+
+import os
+import sys
+import array
+import struct
+import threading
+import itertools
+
+import fatfs
+import writeback
+
+
+class Error(Exception):
+    """Base class for exceptions in this module."""
+
+    pass
+
+
+##########################################
+# names
+
+short_name_chars = frozenset(
+    "ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789!#$%&'()-@^_`{}~"
+)
+long_name_chars_invalid = '"*/:<>?\\|'
+long_name_length_max = 255
+# NT case flags - lowercase 8.3 names need no long name entries
+CASE_LOWER_BASE = 0x08
+CASE_LOWER_EXT = 0x10
+
+
+def check_long_name(name):
+    """Raise Error if name can not be stored on FAT."""
+    if name.endswith('.') or name.endswith(' '):
+        raise Error("'{}' ends with a dot or space.".format(name))
+    for char in name:
+        if ord(char) < 0x20 or char in long_name_chars_invalid:
+            raise Error("'{}' contains invalid character '{}'.".format(
+                name, char
+            ))
+    if len(name.encode('utf-16-le')) // 2 > long_name_length_max:
+        raise Error("'{}' is too long.".format(name))
+
+
+def _get_case(text):
+    """Get 0 for upper, 1 for lower, None for mixed case text."""
+    if text.upper() == text:
+        return 0
+    if text.lower() == text:
+        return 1
+    return None
+
+
+def _to_short_chars(text):
+    return ''.join(
+        char if char in short_name_chars else '_'
+        for char in text.upper()
+    )
+
+
+def get_short_name(name, used):
+    """
+    Get (short name as 11 bytes, case flags, needs long name).
+
+    used: set of short names already in the directory.
+    """
+    base, dot, ext = name.rpartition('.')
+    if not dot:
+        base, ext = name, ''
+    base_case = _get_case(base)
+    ext_case = _get_case(ext)
+    if (
+        1 <= len(base) <= 8 and
+        len(ext) <= 3 and
+        (ext or not dot) and
+        all(char in short_name_chars for char in (base + ext).upper()) and
+        base_case is not None and
+        ext_case is not None
+    ):
+        short = (base.upper().ljust(8) + ext.upper().ljust(3)).encode('ascii')
+        if short not in used:
+            case = 0
+            if base_case:
+                case |= CASE_LOWER_BASE
+            if ext_case:
+                case |= CASE_LOWER_EXT
+            return short, case, False
+    # numbered basis name like LONGFI~1.TXT
+    stripped = name.replace(' ', '').lstrip('.')
+    base, dot, ext = stripped.rpartition('.')
+    if not dot:
+        base, ext = stripped, ''
+    base = _to_short_chars(base.replace('.', '')) or '_'
+    ext = _to_short_chars(ext)[:3]
+    for number in itertools.count(1):
+        tail = "~{}".format(number)
+        short = (
+            (base[:8 - len(tail)] + tail).ljust(8) + ext.ljust(3)
+        ).encode('ascii')
+        if short not in used:
+            return short, 0, True
+
+
+def get_short_name_checksum(short):
+    """Checksum of the short name stored in every long name entry."""
+    checksum = 0
+    for value in short:
+        checksum = (((checksum & 1) << 7) + (checksum >> 1) + value) & 0xff
+    return checksum
+
+
+def get_long_name_entries(name, short):
+    """Get long name entries for name - in directory order."""
+    data = name.encode('utf-16-le')
+    units = len(data) // 2
+    count = (units + 12) // 13
+    if units < count * 13:
+        # terminated with 0x0000 and padded with 0xffff
+        data += b'\x00\x00'
+        data += b'\xff\xff' * (count * 13 - units - 1)
+    checksum = get_short_name_checksum(short)
+    entries = []
+    # the last part is stored first
+    for index in range(count, 0, -1):
+        part = data[(index - 1) * 26:index * 26]
+        order = index
+        if index == count:
+            order |= 0x40
+        entries.append(struct.pack(
+            '<B10sBBB12sH4s',
+            order,
+            part[0:10],
+            fatfs.ATTR_LONG_NAME,
+            0,
+            checksum,
+            part[10:22],
+            0,
+            part[22:26]
+        ))
+    return entries
+
+
+def pack_entry(short, attr, case, entry, cluster, size):
+    """Get 32 byte directory entry."""
+    mtime = entry.mtime_ns / 1e9
+    write_time, write_date = fatfs.get_fat_time(mtime)
+    access_time, access_date = fatfs.get_fat_time(entry.atime_ns / 1e9)
+    # 10ms units within the 2 seconds of the time field
+    tenth = (entry.mtime_ns // 10000000) % 200
+    return struct.pack(
+        '<11sBBBHHHHHHHI',
+        short,
+        attr,
+        case,
+        tenth,
+        write_time,
+        write_date,
+        access_date,
+        cluster >> 16,
+        write_time,
+        write_date,
+        cluster & 0xffff,
+        size
+    )
+
+
+##########################################
+# plan
+
+def estimate_size(source_manifest, cluster_size):
+    """
+    Get bytes source_manifest needs on a FAT filesystem.
+
+    files are rounded up to full clusters.
+    every entry is counted with long name entries -
+    so the directories are never estimated too small.
+    links are not counted (FAT can not store them).
+    """
+    slots = {"": 1}
+    for entry in source_manifest.dirs:
+        # '.' and '..'
+        slots[entry.name] = 2
+    size = 0
+    for entry in source_manifest.dirs + source_manifest.files:
+        name = os.path.basename(entry.name)
+        slots[os.path.dirname(entry.name)] += 1 + (len(name) + 12) // 13
+        if entry.kind == 'file':
+            size += -(-entry.size // cluster_size) * cluster_size
+    for count in slots.values():
+        size += max(1, -(-count * 32 // cluster_size)) * cluster_size
+    return size
+
+
+class FatPlan(object):
+    """Cluster layout, directories and FAT for one partition layout."""
+
+    def __init__(self, source_manifest, skeleton, label_bytes):
+        """Plan the filesystem - raise Error if the source does not fit."""
+        super(FatPlan, self).__init__()
+        self.manifest = source_manifest
+        self.skeleton = skeleton
+        self.layout = skeleton.layout
+        self.cluster_size = (
+            self.layout.sectors_per_cluster * fatfs.sector_size
+        )
+        self.fat_size = self.layout.fat_sectors * fatfs.sector_size
+        self.data_offset = (
+            self.layout.reserved_sectors * fatfs.sector_size +
+            2 * self.fat_size
+        )
+        # links can not be stored on FAT
+        self.skipped = list(source_manifest.links)
+        self.children = {"": []}
+        for entry in source_manifest.dirs:
+            self.children[entry.name] = []
+        for entry in source_manifest.dirs + source_manifest.files:
+            self.children[os.path.dirname(entry.name)].append(entry)
+        self.dir_entries = (source_manifest.root,) + source_manifest.dirs
+        self._plan_names()
+        self._plan_clusters()
+        self.directory_region = self._create_directory_region(label_bytes)
+        self.fat = self._create_fat()
+        self.reserved_region = self._create_reserved_region()
+
+    def get_cluster_offset(self, cluster):
+        """Get byte offset of cluster on the partition."""
+        return self.data_offset + (cluster - 2) * self.cluster_size
+
+    def _plan_names(self):
+        # entry.name -> (short, case, long name entries)
+        self.names = {}
+        self.slots = {}
+        errors = []
+        for dir_entry in self.dir_entries:
+            used = set()
+            if dir_entry.name:
+                # '.' and '..'
+                slots = 2
+            else:
+                # volume label
+                slots = 1
+            for entry in self.children[dir_entry.name]:
+                name = os.path.basename(entry.name)
+                try:
+                    check_long_name(name)
+                except Error as why:
+                    errors.append((self.manifest.get_src_path(entry), why))
+                    continue
+                if entry.kind == 'file' and entry.size > 0xffffffff:
+                    errors.append((
+                        self.manifest.get_src_path(entry),
+                        "larger than 4GiB"
+                    ))
+                    continue
+                short, case, needs_long_name = get_short_name(name, used)
+                used.add(short)
+                long_name_entries = []
+                if needs_long_name:
+                    long_name_entries = get_long_name_entries(name, short)
+                self.names[entry.name] = (short, case, long_name_entries)
+                slots += 1 + len(long_name_entries)
+            if slots > 65536:
+                errors.append((
+                    self.manifest.get_src_path(dir_entry),
+                    "more than 65536 directory entries"
+                ))
+            self.slots[dir_entry.name] = slots
+        if errors:
+            raise Error(errors)
+
+    def _get_cluster_count(self, size):
+        return (size + self.cluster_size - 1) // self.cluster_size
+
+    def _plan_clusters(self):
+        # entry.name -> first cluster (0 for empty files)
+        self.first_cluster = {}
+        # (first cluster, cluster count) of every chain
+        self.runs = []
+        cluster = 2
+        for dir_entry in self.dir_entries:
+            count = max(1, self._get_cluster_count(
+                self.slots[dir_entry.name] * 32
+            ))
+            self.first_cluster[dir_entry.name] = cluster
+            self.runs.append((cluster, count))
+            cluster += count
+        self.files_cluster = cluster
+        self.files = []
+        for entry in self.manifest.files:
+            if entry.name not in self.names:
+                continue
+            self.files.append(entry)
+            count = self._get_cluster_count(entry.size)
+            if count:
+                self.first_cluster[entry.name] = cluster
+                self.runs.append((cluster, count))
+                cluster += count
+            else:
+                self.first_cluster[entry.name] = 0
+        self.clusters_used = cluster - 2
+        # bytes of the file stream - every file rounded up to clusters
+        self.files_size = (cluster - self.files_cluster) * self.cluster_size
+        if self.clusters_used > self.layout.cluster_count:
+            raise Error(
+                "source needs {} clusters - partition has {}.".format(
+                    self.clusters_used,
+                    self.layout.cluster_count
+                )
+            )
+
+    def _create_directory_region(self, label_bytes):
+        region = bytearray(
+            (self.files_cluster - 2) * self.cluster_size
+        )
+        for dir_entry in self.dir_entries:
+            cluster = self.first_cluster[dir_entry.name]
+            pos = (cluster - 2) * self.cluster_size
+            entries = []
+            if dir_entry.name:
+                parent = os.path.dirname(dir_entry.name)
+                # the root directory is always cluster 0 in '..'
+                parent_cluster = 0
+                if parent:
+                    parent_cluster = self.first_cluster[parent]
+                entries.append(pack_entry(
+                    b'.          ', fatfs.ATTR_DIRECTORY, 0,
+                    dir_entry, cluster, 0
+                ))
+                entries.append(pack_entry(
+                    b'..         ', fatfs.ATTR_DIRECTORY, 0,
+                    dir_entry, parent_cluster, 0
+                ))
+            else:
+                entries.append(pack_entry(
+                    label_bytes, fatfs.ATTR_VOLUME_ID, 0,
+                    dir_entry, 0, 0
+                ))
+            for entry in self.children[dir_entry.name]:
+                if entry.name not in self.names:
+                    continue
+                short, case, long_name_entries = self.names[entry.name]
+                entries.extend(long_name_entries)
+                if entry.kind == 'dir':
+                    attr = fatfs.ATTR_DIRECTORY
+                    size = 0
+                else:
+                    attr = fatfs.ATTR_ARCHIVE
+                    size = entry.size
+                entries.append(pack_entry(
+                    short, attr, case,
+                    entry, self.first_cluster[entry.name], size
+                ))
+            data = b''.join(entries)
+            region[pos:pos + len(data)] = data
+        return bytes(region)
+
+    def _create_fat(self):
+        fat = array.array('I', bytes(self.fat_size))
+        fat[0] = 0x0ffffff8
+        fat[1] = 0x0fffffff
+        for first, count in self.runs:
+            for cluster in range(first, first + count - 1):
+                fat[cluster] = cluster + 1
+            fat[first + count - 1] = 0x0fffffff
+        if sys.byteorder != 'little':
+            fat.byteswap()
+        return fat.tobytes()
+
+    def _create_reserved_region(self):
+        region = bytearray(self.skeleton.reserved_region)
+        for sector in (1, 7):
+            # FSInfo: free clusters / next free cluster
+            struct.pack_into(
+                '<II',
+                region,
+                sector * fatfs.sector_size + 488,
+                self.layout.cluster_count - self.clusters_used,
+                self.clusters_used + 2
+            )
+        return bytes(region)
+
+
+##########################################
+# writer
+
+class FatWriter(object):
+    """Write source_manifest as new FAT32 filesystem onto partitions."""
+
+    def __init__(
+        self,
+        source_manifest,
+        chunk_size=4*1024*1024,
+        writeback_window=0
+    ):
+        """Create new FatWriter."""
+        super(FatWriter, self).__init__()
+        self.manifest = source_manifest
+        self.chunk_size = chunk_size
+        self.writeback_window = writeback_window
+        self.lock = threading.Lock()
+        # plans are cached per partition geometry and label
+        self.plans = {}
+
+    def get_plan(self, geometry, label, cluster_size=0, alignment=0):
+        """Get cached FatPlan for geometry."""
+        key = (geometry, label, cluster_size, alignment)
+        with self.lock:
+            plan = self.plans.get(key)
+            if plan is None:
+                skeleton = fatfs.get_skeleton(
+                    geometry,
+                    label,
+                    cluster_size,
+                    alignment
+                )
+                plan = FatPlan(
+                    self.manifest,
+                    skeleton,
+                    fatfs.check_label(label)
+                )
+                self.plans[key] = plan
+        return plan
+
+    def write(
+        self,
+        node,
+        label,
+        cluster_size=0,
+        alignment=0,
+        progress=None,
+        geometry=None
+    ):
+        """
+        Write filesystem and all files to node - returns bytes written.
+
+        progress: optional Progress object - gets the written stream
+            (plan.files_size bytes) when it is on the device.
+        geometry: fatfs.Geometry to plan for - default is node itself
+            (an image file gets the geometry of its target partition).
+        """
+        if geometry is None:
+            geometry = fatfs.get_geometry(node)
+        plan = self.get_plan(geometry, label, cluster_size, alignment)
+        reserved_region = bytearray(plan.reserved_region)
+        # every stick gets its own volume id (serial number)
+        fatfs.set_volume_id(reserved_region)
+        fd = os.open(node, os.O_WRONLY)
+        try:
+            # the old filesystem is invalid from now on
+            os.pwrite(fd, bytes(fatfs.sector_size), 0)
+            written = self._write_files(fd, plan, progress)
+            os.pwrite(
+                fd,
+                plan.directory_region,
+                plan.get_cluster_offset(2)
+            )
+            for index in range(2):
+                os.pwrite(
+                    fd,
+                    plan.fat,
+                    len(reserved_region) + index * plan.fat_size
+                )
+            os.fsync(fd)
+            os.pwrite(fd, reserved_region, 0)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        return written
+
+    def _write_files(self, fd, plan, progress):
+        """Write all files as one stream - every file cluster aligned."""
+        buffer = bytearray(self.chunk_size)
+        view = memoryview(buffer)
+        zeros = memoryview(bytes(self.chunk_size))
+        fill = 0
+        offset = plan.get_cluster_offset(plan.files_cluster)
+        written = 0
+        # the progress gets the stream with padding like a copied file -
+        # only the bytes that are on the device.
+        window = writeback.WritebackWindow(self.writeback_window, progress)
+        window.open_file(fd, offset)
+
+        def flush():
+            pos = 0
+            while pos < fill:
+                pos += os.pwrite(fd, view[pos:fill], offset + pos)
+            window.add(fill)
+            return fill
+
+        try:
+            for entry in plan.files:
+                # the file and the rest of its last cluster
+                padding = -entry.size % plan.cluster_size
+                remaining = entry.size
+                srcname = plan.manifest.get_src_path(entry)
+                try:
+                    with open(srcname, 'rb', buffering=0) as f:
+                        while remaining or padding:
+                            if fill == len(buffer):
+                                offset += flush()
+                                fill = 0
+                            space = len(buffer) - fill
+                            if remaining:
+                                size = f.readinto(
+                                    view[fill:fill + min(remaining, space)]
+                                )
+                                if not size:
+                                    # source got smaller than the manifest
+                                    size = min(remaining, space)
+                                    view[fill:fill + size] = zeros[:size]
+                                remaining -= size
+                                written += size
+                            else:
+                                size = min(padding, space)
+                                view[fill:fill + size] = zeros[:size]
+                                padding -= size
+                            fill += size
+                except OSError as why:
+                    raise Error([(srcname, str(why))])
+                if progress:
+                    progress.add(files_done=1)
+            flush()
+            window.close_file()
+            window.finish()
+        finally:
+            window.close()
+        return written
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+Source hash cache.
+
+sidecar json file next to the config file.
+maps the relative path of every source file together with
+its size and mtime_ns to its digest.
+so only new or changed files have to be hashed at session start.
+hashing runs in parallel threads - hashlib releases the GIL.
+"""
+
+import os
+import json
+import concurrent.futures
+
+import verify
+
+
+class HashCache(object):
+    """Persistent digests of source files."""
+
+    def __init__(self, filename, src, algorithm='sha256', threads=0):
+        """
+        Create new HashCache for source folder src.
+
+        threads: count of hash threads - 0 means one per cpu.
+        the file is only read on first use.
+        """
+        super(HashCache, self).__init__()
+        self.filename = filename
+        self.src = src
+        self.algorithm = algorithm
+        if threads <= 0:
+            threads = os.cpu_count() or 1
+        self.threads = threads
+        self.entries = None
+
+    def load(self):
+        """Read cache file - invalid or missing files give an empty cache."""
+        self.entries = {}
+        try:
+            with open(self.filename, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if (
+            data.get('algorithm') == self.algorithm and
+            data.get('source_folder') == self.src
+        ):
+            self.entries = data.get('entries', {})
+
+    def save(self):
+        """Write cache file (atomic)."""
+        data = {
+            'algorithm': self.algorithm,
+            'source_folder': self.src,
+            'entries': self.entries,
+        }
+        filename_temp = self.filename + ".tmp"
+        with open(filename_temp, 'w') as f:
+            json.dump(data, f, sort_keys=True, indent=1)
+        os.replace(filename_temp, self.filename)
+
+    def get_digests(self, source_manifest):
+        """Get dict relative file name -> digest for all manifest files."""
+        if self.entries is None:
+            self.load()
+        digests = {}
+        missing = []
+        for entry in source_manifest.files:
+            cached = self.entries.get(entry.name)
+            if (
+                cached and
+                cached[0] == entry.size and
+                cached[1] == entry.mtime_ns
+            ):
+                digests[entry.name] = cached[2]
+            else:
+                missing.append(entry)
+        if missing:
+            print("hash {} of {} source files...".format(
+                len(missing),
+                len(source_manifest.files)
+            ))
+            with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.threads
+            ) as executor:
+                results = executor.map(
+                    lambda entry: verify.hash_file(
+                        source_manifest.get_src_path(entry),
+                        self.algorithm
+                    ),
+                    missing
+                )
+                for entry, digest in zip(missing, results):
+                    digests[entry.name] = digest
+        # only keep files that are still in the source
+        self.entries = {
+            entry.name: [entry.size, entry.mtime_ns, digests[entry.name]]
+            for entry in source_manifest.files
+        }
+        if missing:
+            self.save()
+        return digests
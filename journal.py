@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+Copy journal.
+
+one small append-only file per stick on the host
+(keyed by the stick serial and its port).
+every file that is completely written to the stick is appended.
+after a failed copy, a restart of the tool or a re-plug
+the copy goes on with the files that are not in the journal.
+
+format: first line the source signature (json),
+then one json string per completed file.
+a torn last line (crash while writing it) is ignored.
+the lines are not fsynced - after a power loss of the host
+the last files are just copied again.
+"""
+
+import os
+import re
+import json
+
+
+class Error(Exception):
+    """Base class for exceptions in this module."""
+
+    pass
+
+
+def get_journal_name(serial, port_id):
+    """Get file name of the journal for stick serial in port port_id."""
+    return "{}_{}.journal".format(
+        re.sub(r'[^A-Za-z0-9._-]', '_', serial),
+        re.sub(r'[^A-Za-z0-9._-]', '_', port_id)
+    )
+
+
+class CopyJournal(object):
+    """Names of the files that are completely on one stick."""
+
+    def __init__(self, filename, signature):
+        """
+        Create new CopyJournal.
+
+        signature: text that identifies the source -
+            a journal of another source is not used.
+        """
+        super(CopyJournal, self).__init__()
+        self.filename = filename
+        self.signature = signature
+        self.done = set()
+        self.fd = None
+
+    def load(self):
+        """Read the journal - returns the set of completed file names."""
+        self.done = set()
+        try:
+            with open(self.filename, 'r') as f:
+                lines = f.read().split("\n")
+        except OSError:
+            return self.done
+        try:
+            if json.loads(lines[0]) != self.signature:
+                return self.done
+        except ValueError:
+            return self.done
+        for line in lines[1:]:
+            try:
+                self.done.add(json.loads(line))
+            except ValueError:
+                # empty or torn last line
+                pass
+        return self.done
+
+    def open(self, done=None):
+        """
+        Start writing - the journal is rewritten with done.
+
+        done: the completed names that are still valid
+            (default: all loaded names).
+        """
+        if done is not None:
+            self.done = set(done)
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        lines = [json.dumps(self.signature)]
+        lines.extend(json.dumps(name) for name in sorted(self.done))
+        filename_temp = self.filename + ".tmp"
+        with open(filename_temp, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(filename_temp, self.filename)
+        self.fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND)
+
+    def add(self, entry):
+        """Record entry as completely written."""
+        self.done.add(entry.name)
+        if self.fd is not None:
+            # one write per line - a crash can only tear the last line
+            os.write(self.fd, (json.dumps(entry.name) + "\n").encode())
+
+    def close(self):
+        """Stop writing - the journal file stays."""
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def remove(self):
+        """Delete the journal - the copy is complete."""
+        self.close()
+        try:
+            os.remove(self.filename)
+        except FileNotFoundError:
+            pass
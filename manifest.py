@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+Source manifest.
+
+immutable snapshot of the source folder.
+the source tree is walked only once per session -
+all sticks are copied from this snapshot.
+include / exclude glob rules (PathFilter) are applied while scanning -
+so excluded files are never written to any stick.
+"""
+
+import os
+import re
+import copy
+import stat
+import json
+import fnmatch
+import hashlib
+import collections
+
+
+# files the OS creates on its own - never wanted on the sticks
+meta_files = (
+    '.DS_Store',
+)
+
+ManifestEntry = collections.namedtuple(
+    'ManifestEntry',
+    [
+        # relative path ("" for the source folder itself)
+        'name',
+        # 'dir', 'file' or 'link'
+        'kind',
+        'size',
+        'atime_ns',
+        'mtime_ns',
+        'mode',
+        # only set for links
+        'link_target',
+    ]
+)
+
+
+def _entry_from_stat(name, kind, st, link_target=None):
+    return ManifestEntry(
+        name=name,
+        kind=kind,
+        size=st.st_size,
+        atime_ns=st.st_atime_ns,
+        mtime_ns=st.st_mtime_ns,
+        mode=st.st_mode,
+        link_target=link_target,
+    )
+
+
+def copy_stat(entry, dstname):
+    """Apply times and mode from entry to dstname (like shutil.copystat)."""
+    os.utime(dstname, ns=(entry.atime_ns, entry.mtime_ns))
+    os.chmod(dstname, stat.S_IMODE(entry.mode))
+
+
+def _compile_patterns(patterns):
+    """Compile glob patterns to (name regex, path regex)."""
+    name_patterns = []
+    path_patterns = []
+    for pattern in patterns:
+        if '/' in pattern:
+            path_patterns.append(fnmatch.translate(pattern.strip('/')))
+        else:
+            name_patterns.append(fnmatch.translate(pattern))
+    result = []
+    for translated in (name_patterns, path_patterns):
+        if translated:
+            result.append(re.compile("|".join(translated)))
+        else:
+            result.append(None)
+    return tuple(result)
+
+
+class PathFilter(object):
+    """
+    Include / exclude glob rules for the relative source paths.
+
+    patterns without '/' match the name in every folder
+    (like '.DS_Store' or '*.tmp').
+    patterns with '/' match the whole path from the source folder
+    (like '/example.file' or 'docs/*.pdf' - '*' also matches '/').
+    exclude wins over include.
+    include only selects files and links - folders are always scanned.
+    an empty include list selects everything.
+    """
+
+    def __init__(self, include=(), exclude=()):
+        """Compile the rules."""
+        super(PathFilter, self).__init__()
+        self.include = _compile_patterns(include) if include else None
+        self.exclude = _compile_patterns(exclude)
+
+    @staticmethod
+    def _match(compiled, name):
+        name_regex, path_regex = compiled
+        if name_regex and name_regex.match(os.path.basename(name)):
+            return True
+        if path_regex and path_regex.match(name):
+            return True
+        return False
+
+    def is_excluded(self, name, kind):
+        """Check if the entry with relative name should be left out."""
+        if self._match(self.exclude, name):
+            return True
+        if self.include and kind != 'dir':
+            return not self._match(self.include, name)
+        return False
+
+
+class SourceManifest(object):
+    """Snapshot of all directories, files and links in src."""
+
+    def __init__(self, src, path_filter=None):
+        """
+        Scan src and create manifest.
+
+        path_filter: optional PathFilter - excluded entries are skipped
+            (excluded folders are not scanned at all).
+        """
+        super(SourceManifest, self).__init__()
+        self.src = src
+        self.path_filter = path_filter
+        self.excluded_count = 0
+        self.root = _entry_from_stat("", 'dir', os.stat(src))
+        dirs = []
+        files = []
+        links = []
+        self._scan("", dirs, files, links)
+        # directories in creation order (parents first)
+        self.dirs = tuple(dirs)
+        self.files = tuple(files)
+        self.links = tuple(links)
+        self.total_size = sum(entry.size for entry in self.files)
+
+    def _scan(self, rel_root, dirs, files, links):
+        sub_dirs = []
+        with os.scandir(os.path.join(self.src, rel_root)) as it:
+            dir_entries = sorted(it, key=lambda dir_entry: dir_entry.name)
+        for dir_entry in dir_entries:
+            name = os.path.join(rel_root, dir_entry.name)
+            if dir_entry.is_symlink():
+                kind = 'link'
+            elif dir_entry.is_dir(follow_symlinks=False):
+                kind = 'dir'
+            else:
+                kind = 'file'
+            if (
+                self.path_filter and
+                self.path_filter.is_excluded(name, kind)
+            ):
+                self.excluded_count += 1
+                continue
+            st = dir_entry.stat(follow_symlinks=False)
+            if kind == 'link':
+                links.append(_entry_from_stat(
+                    name, 'link', st, os.readlink(dir_entry.path)
+                ))
+            elif kind == 'dir':
+                dirs.append(_entry_from_stat(name, 'dir', st))
+                sub_dirs.append(name)
+            else:
+                files.append(_entry_from_stat(name, 'file', st))
+        for name in sub_dirs:
+            self._scan(name, dirs, files, links)
+
+    def subset(self, files, links=None):
+        """Get copy of this manifest that only contains the given files."""
+        result = copy.copy(self)
+        result.files = tuple(files)
+        if links is not None:
+            result.links = tuple(links)
+        result.total_size = sum(entry.size for entry in result.files)
+        return result
+
+    def get_signature(self):
+        """
+        Get digest of names, sizes and modification times of all entries.
+
+        changes if anything in the source changes - without reading
+        the file contents.
+        """
+        digest = hashlib.sha256()
+        for entry in self.dirs + self.files + self.links:
+            digest.update(json.dumps([
+                entry.name,
+                entry.kind,
+                entry.size,
+                entry.mtime_ns,
+                entry.link_target,
+            ]).encode())
+        return digest.hexdigest()
+
+    def get_content_signature(self, digests):
+        """
+        Get digest of names, kinds, link targets and file contents.
+
+        digests: dict file name -> content digest.
+        the same content gives the same signature after a touch
+        or a fresh checkout of the source.
+        """
+        digest = hashlib.sha256()
+        for entry in self.dirs + self.files + self.links:
+            digest.update(json.dumps([
+                entry.name,
+                entry.kind,
+                digests.get(entry.name),
+                entry.link_target,
+            ]).encode())
+        return digest.hexdigest()
+
+    def get_src_path(self, entry):
+        """Get absolute source path of entry."""
+        return os.path.join(self.src, entry.name)
+
+    def __len__(self):
+        """Count of all entries."""
+        return len(self.dirs) + len(self.files) + len(self.links)
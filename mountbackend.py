@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+Mount backend.
+
+mount / unmount in-process with the mount(2) and umount2(2) syscalls
+(through ctypes) - no fork and exec of the mount binaries per stick.
+errors are raised as MountError with errno, source and target.
+
+mount options are given as dict:
+    {'noatime': True, 'uid': 1000, 'iocharset': 'utf8', 'flush': False}
+    True adds the option, False / None leaves it out.
+    generic options (noatime, nodev, ...) become mount flags -
+    all others are given to the filesystem (vfat) as data string.
+
+syncfs writes all cached data of one mounted filesystem -
+so the flush can be timed on its own before the unmount.
+"""
+
+import os
+import ctypes
+import ctypes.util
+
+
+class Error(Exception):
+    """Base class for exceptions in this module."""
+
+    pass
+
+
+class MountError(Error):
+    """mount(2) or umount2(2) failed."""
+
+    def __init__(self, operation, errno_value, source, target, options=""):
+        """Create new MountError."""
+        super(MountError, self).__init__(
+            operation, errno_value, source, target, options
+        )
+        self.operation = operation
+        self.errno = errno_value
+        self.source = source
+        self.target = target
+        self.options = options
+
+    def __str__(self):
+        """Error as text."""
+        text = "{} '{}'".format(self.operation, self.source)
+        if self.target != self.source:
+            text += " on '{}'".format(self.target)
+        if self.options:
+            text += " ({})".format(self.options)
+        return "{} failed: [Errno {}] {}".format(
+            text,
+            self.errno,
+            os.strerror(self.errno)
+        )
+
+
+# generic mount flags from <sys/mount.h>
+mount_flags = {
+    'ro': 1,
+    'nosuid': 2,
+    'nodev': 4,
+    'noexec': 8,
+    'sync': 16,
+    'dirsync': 128,
+    'noatime': 1024,
+    'nodiratime': 2048,
+}
+# generic options that only mean 'flag not set'
+mount_flags_unset = (
+    'async', 'rw', 'suid', 'dev', 'exec', 'atime', 'diratime', 'defaults',
+)
+# umount2 flags
+MNT_FORCE = 1
+MNT_DETACH = 2
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        name = ctypes.util.find_library('c')
+        if name is None:
+            raise Error("libc not found.")
+        libc = ctypes.CDLL(name, use_errno=True)
+        libc.mount.argtypes = [
+            ctypes.c_char_p,
+            ctypes.c_char_p,
+            ctypes.c_char_p,
+            ctypes.c_ulong,
+            ctypes.c_char_p,
+        ]
+        libc.umount2.argtypes = [ctypes.c_char_p, ctypes.c_int]
+        libc.syncfs.argtypes = [ctypes.c_int]
+        _libc = libc
+    return _libc
+
+
+def is_available():
+    """Check if the syscalls can be used."""
+    try:
+        _get_libc()
+    except (Error, OSError, AttributeError):
+        return False
+    return True
+
+
+def split_options(options):
+    """Split options dict into mount flags and filesystem data string."""
+    flags = 0
+    data = []
+    for key in sorted(options):
+        value = options[key]
+        if value is None or value is False:
+            continue
+        if key in mount_flags:
+            flags |= mount_flags[key]
+        elif key in mount_flags_unset:
+            pass
+        elif value is True:
+            data.append(key)
+        else:
+            data.append("{}={}".format(key, value))
+    return flags, ",".join(data)
+
+
+def format_options(options):
+    """Get options dict as text for `mount -o`."""
+    words = []
+    for key in sorted(options):
+        value = options[key]
+        if value is None or value is False:
+            continue
+        if value is True:
+            words.append(key)
+        else:
+            words.append("{}={}".format(key, value))
+    return ",".join(words)
+
+
+def mount(source, target, fstype='vfat', options=None):
+    """Mount source on target - raises MountError."""
+    if options is None:
+        options = {}
+    flags, data = split_options(options)
+    result = _get_libc().mount(
+        os.fsencode(source),
+        os.fsencode(target),
+        fstype.encode(),
+        flags,
+        data.encode() if data else None
+    )
+    if result != 0:
+        raise MountError(
+            'mount',
+            ctypes.get_errno(),
+            source,
+            target,
+            format_options(options)
+        )
+
+
+def umount(target, flags=0):
+    """Unmount target - raises MountError."""
+    result = _get_libc().umount2(os.fsencode(target), flags)
+    if result != 0:
+        raise MountError('umount', ctypes.get_errno(), target, target)
+
+
+def syncfs(path):
+    """Write all cached data of the filesystem path is on."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        try:
+            libc = _get_libc()
+        except (Error, OSError, AttributeError):
+            # syncs all filesystems - but still blocks until written
+            os.sync()
+            return
+        if libc.syncfs(fd) != 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+    finally:
+        os.close(fd)
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+Stick probe.
+
+finds fake capacity and slow sticks before the copy with a short
+write test - destroys the data on the partition:
+    the first probe_size bytes are written to measure the
+        sustained write speed (including the writeback).
+    sample regions spread across the reported size
+        (and at every power of two) are written,
+        dropped from the page cache and read back.
+        a fake stick wraps its addresses around the real capacity -
+        so the samples behind the real end overwrite earlier ones.
+
+use as script to probe one partition:
+`./probe.py /dev/sdc1`
+"""
+
+import os
+import sys
+import time
+import struct
+import collections
+
+import writeback
+
+
+class Error(Exception):
+    """Base class for exceptions in this module."""
+
+    pass
+
+
+ProbeResult = collections.namedtuple(
+    'ProbeResult',
+    [
+        # reported size of the partition in bytes
+        'size',
+        # bytes per second over the first probe_size bytes
+        'write_speed',
+        # offsets of the samples that were not read back as written
+        'bad_offsets',
+    ]
+)
+
+sample_magic = b"USTPROBE"
+
+
+def get_sample_offsets(size, sample_count, sample_size, alignment=4096):
+    """
+    Get sample offsets - spread from the start to the end.
+
+    sample_count offsets are evenly spread.
+    in addition every power of two is sampled: most fake sticks
+    ignore the high address bits - so the sample at 2^n behind
+    the real end overwrites the sample at 0.
+    samples never overlap each other.
+    """
+    last = (size - sample_size) // alignment * alignment
+    if last < 0:
+        raise Error("partition smaller than one sample.")
+    offsets = set([0, last])
+    for index in range(1, sample_count - 1):
+        offset = last * index // (sample_count - 1)
+        offsets.add(offset // alignment * alignment)
+    power = alignment
+    while power <= last:
+        offsets.add(power)
+        power *= 2
+    result = []
+    for offset in sorted(offsets):
+        if not result or offset >= result[-1] + sample_size:
+            result.append(offset)
+    return result
+
+
+def _create_sample(offset, sample_size):
+    # the offset in the header - a sample at the wrong place is found
+    # even if the random part would match by chance.
+    header = sample_magic + struct.pack('<Q', offset)
+    return header + os.urandom(sample_size - len(header))
+
+
+def measure_write_speed(
+    fd,
+    size,
+    chunk_size=4*1024*1024,
+    progress=None,
+    writeback_window=8*1024*1024
+):
+    """Write size bytes from the start of fd - returns bytes per second."""
+    chunk = memoryview(os.urandom(chunk_size))
+    window = writeback.WritebackWindow(writeback_window, progress)
+    window.open_file(fd)
+    time_start = time.monotonic()
+    offset = 0
+    try:
+        while offset < size:
+            part = chunk[:min(chunk_size, size - offset)]
+            pos = 0
+            while pos < len(part):
+                pos += os.pwrite(fd, part[pos:], offset + pos)
+            offset += len(part)
+            window.add(len(part))
+        window.close_file()
+        window.finish()
+    finally:
+        window.close()
+    os.fdatasync(fd)
+    duration = time.monotonic() - time_start
+    if duration <= 0:
+        return float('inf')
+    return size / duration
+
+
+def check_samples(fd, offsets, sample_size, progress=None):
+    """Write samples at offsets and read them back - returns bad offsets."""
+    samples = []
+    for offset in offsets:
+        sample = _create_sample(offset, sample_size)
+        os.pwrite(fd, sample, offset)
+        samples.append((offset, sample))
+        if progress:
+            progress.add(sample_size)
+    os.fdatasync(fd)
+    # read from the stick - not from the page cache
+    writeback.drop_cache(fd, 0, 0)
+    bad_offsets = []
+    for offset, sample in samples:
+        if os.pread(fd, sample_size, offset) != sample:
+            bad_offsets.append(offset)
+        if progress:
+            progress.add(sample_size)
+    return bad_offsets
+
+
+def get_probe_bytes(size, probe_size, sample_count, sample_size):
+    """Get bytes probe_device moves - for the progress total."""
+    offsets = get_sample_offsets(size, sample_count, sample_size)
+    return min(probe_size, size) + 2 * len(offsets) * sample_size
+
+
+def probe_device(
+    node,
+    probe_size=256*1024*1024,
+    sample_count=16,
+    sample_size=1024*1024,
+    progress=None,
+    writeback_window=8*1024*1024
+):
+    """
+    Probe write speed and real capacity of node - returns ProbeResult.
+
+    progress: optional Progress object - gets every written / read chunk.
+    """
+    fd = os.open(node, os.O_RDWR)
+    try:
+        size = os.lseek(fd, 0, os.SEEK_END)
+        write_speed = measure_write_speed(
+            fd,
+            min(probe_size, size),
+            progress=progress,
+            writeback_window=writeback_window
+        )
+        bad_offsets = check_samples(
+            fd,
+            get_sample_offsets(size, sample_count, sample_size),
+            sample_size,
+            progress
+        )
+    finally:
+        os.close(fd)
+    return ProbeResult(size, write_speed, bad_offsets)
+
+
+##########################################
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2:
+        print("usage: probe.py NODE")
+        print("    destroys the data on NODE!")
+        sys.exit(1)
+    result = probe_device(sys.argv[1])
+    print("size: {} bytes".format(result.size))
+    print("write speed: {:.1f} MB/s".format(result.write_speed / 1e6))
+    if result.bad_offsets:
+        print("fake capacity - samples not read back at: {}".format(
+            ", ".join(str(offset) for offset in result.bad_offsets)
+        ))
+    else:
+        print("all samples read back.")
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+Progress.
+
+live throughput, progress and ETA of one stick job.
+the copy engines call add() for every written chunk -
+the report is rate limited to a few updates per second.
+add() is also where a cancelled job stops (between two chunks).
+"""
+
+import time
+import collections
+
+
+class Cancelled(Exception):
+    """The job was cancelled - for example the stick was pulled."""
+
+    pass
+
+
+ProgressInfo = collections.namedtuple(
+    'ProgressInfo',
+    [
+        'bytes_done',
+        'bytes_total',
+        'files_done',
+        'files_total',
+        # current speed in bytes/s
+        'speed',
+        # estimated seconds left - None if unknown
+        'eta',
+    ]
+)
+
+
+def get_percent(info):
+    """Get progress in percent."""
+    if info.bytes_total > 0:
+        return 100.0 * info.bytes_done / info.bytes_total
+    if info.files_total > 0:
+        return 100.0 * info.files_done / info.files_total
+    return 100.0
+
+
+def format_speed(info):
+    """Get speed as MB/s text."""
+    return "{:.1f}MB/s".format(info.speed / (1000 * 1000))
+
+
+def format_eta(info):
+    """Get eta as m:ss text."""
+    if info.eta is None:
+        return "?"
+    minutes, seconds = divmod(int(info.eta), 60)
+    return "{}:{:02d}".format(minutes, seconds)
+
+
+def format_progress(info):
+    """Get one line text with percent, speed, files and eta."""
+    return "{:.0f}% {} {}/{} files eta {}".format(
+        get_percent(info),
+        format_speed(info),
+        info.files_done,
+        info.files_total,
+        format_eta(info)
+    )
+
+
+class Progress(object):
+    """Track written bytes and files of one stick job."""
+
+    # weight of the newest speed sample
+    speed_smoothing = 0.3
+
+    def __init__(
+        self,
+        bytes_total,
+        files_total,
+        report=None,
+        interval=0.25,
+        cancel_event=None
+    ):
+        """
+        Create new Progress.
+
+        report: function called with a ProgressInfo
+            - at most every interval seconds.
+        cancel_event: optional threading.Event -
+            once set the next add() raises Cancelled.
+        """
+        super(Progress, self).__init__()
+        self.bytes_total = bytes_total
+        self.files_total = files_total
+        self.report = report
+        self.interval = interval
+        self.cancel_event = cancel_event
+        self.bytes_done = 0
+        self.files_done = 0
+        self.speed = 0.0
+        self.time_start = time.monotonic()
+        self.time_last = self.time_start
+        self.bytes_last = 0
+
+    def add(self, bytes_done=0, files_done=0):
+        """Add written bytes / finished files."""
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise Cancelled()
+        self.bytes_done += bytes_done
+        self.files_done += files_done
+        now = time.monotonic()
+        if now - self.time_last >= self.interval:
+            self._update_speed(now)
+            self._report()
+
+    def finish(self):
+        """Send final report."""
+        now = time.monotonic()
+        duration = now - self.time_start
+        if duration > 0:
+            # mean speed of the whole job
+            self.speed = self.bytes_done / duration
+        self.time_last = now
+        self._report()
+
+    def _update_speed(self, now):
+        speed = (self.bytes_done - self.bytes_last) / (now - self.time_last)
+        if self.speed:
+            self.speed += self.speed_smoothing * (speed - self.speed)
+        else:
+            self.speed = speed
+        self.time_last = now
+        self.bytes_last = self.bytes_done
+
+    def get_info(self):
+        """Get current ProgressInfo."""
+        eta = None
+        if self.speed > 0:
+            eta = max(0, self.bytes_total - self.bytes_done) / self.speed
+        return ProgressInfo(
+            bytes_done=self.bytes_done,
+            bytes_total=self.bytes_total,
+            files_done=self.files_done,
+            files_total=self.files_total,
+            speed=self.speed,
+            eta=eta,
+        )
+
+    def _report(self):
+        if self.report:
+            self.report(self.get_info())
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+Completion registry.
+
+sqlite database next to the config file.
+remembers every stick that was completed - keyed by the stick
+identity (serial and filesystem UUID) and the signature of the
+source content (file digests) and label.
+a stick that is plugged in again is recognized from its udev
+properties - no I/O on the stick and only one query per session.
+also counts the unique sticks that were produced.
+
+use as script to show the counts:
+`./registry.py completed_sticks.sqlite`
+"""
+
+import sys
+import time
+import sqlite3
+import threading
+
+
+class Error(Exception):
+    """Base class for exceptions in this module."""
+
+    pass
+
+
+def get_identity(serial, fs_uuid):
+    """
+    Get identity text of a stick (or None).
+
+    the filesystem UUID (FAT volume id) is needed -
+    cheap sticks often share their serial.
+    the format writes a new volume id to every stick.
+    """
+    if not fs_uuid:
+        return None
+    return "{}/{}".format(serial or "", fs_uuid)
+
+
+class CompletionRegistry(object):
+    """Persistent set of completed sticks for one source signature."""
+
+    def __init__(self, filename, signature):
+        """Create new CompletionRegistry - the file is opened on use."""
+        super(CompletionRegistry, self).__init__()
+        self.filename = filename
+        self.signature = signature
+        # jobs finish in their own threads
+        self.lock = threading.Lock()
+        self.connection = None
+        # identities done with this signature (all sessions)
+        self.done = None
+        # identities done in this session
+        self.done_session = set()
+
+    def _open(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(
+                self.filename,
+                check_same_thread=False
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS sticks ("
+                "identity TEXT NOT NULL, "
+                "signature TEXT NOT NULL, "
+                "serial TEXT, "
+                "fs_uuid TEXT, "
+                "port TEXT, "
+                "time REAL, "
+                "PRIMARY KEY (identity, signature))"
+            )
+            self.connection.commit()
+            self.done = set(
+                row[0]
+                for row in self.connection.execute(
+                    "SELECT identity FROM sticks WHERE signature = ?",
+                    (self.signature,)
+                )
+            )
+
+    def is_done(self, identity):
+        """Check if the stick with identity is completed."""
+        if identity is None:
+            return False
+        with self.lock:
+            self._open()
+            return identity in self.done
+
+    def add(self, identity, serial=None, fs_uuid=None, port=None):
+        """Record the stick with identity as completed."""
+        if identity is None:
+            return
+        with self.lock:
+            self._open()
+            self.connection.execute(
+                "INSERT OR REPLACE INTO sticks "
+                "(identity, signature, serial, fs_uuid, port, time) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (identity, self.signature, serial, fs_uuid, port, time.time())
+            )
+            self.connection.commit()
+            self.done.add(identity)
+            self.done_session.add(identity)
+
+    def get_counts(self):
+        """Get (unique sticks for this source, of these in this session)."""
+        with self.lock:
+            self._open()
+            return len(self.done), len(self.done_session)
+
+    def close(self):
+        """Close the database."""
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+
+##########################################
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2:
+        print("usage: registry.py REGISTRY_FILE")
+        sys.exit(1)
+    connection = sqlite3.connect(sys.argv[1])
+    try:
+        rows = connection.execute(
+            "SELECT signature, COUNT(*), MIN(time), MAX(time) "
+            "FROM sticks GROUP BY signature ORDER BY MAX(time)"
+        ).fetchall()
+    except sqlite3.Error as e:
+        print("no registry: {}".format(e))
+        sys.exit(1)
+    finally:
+        connection.close()
+    for signature, count, time_first, time_last in rows:
+        print("{}: {} sticks ({} - {})".format(
+            signature[:16],
+            count,
+            time.strftime("%Y-%m-%d %H:%M", time.localtime(time_first)),
+            time.strftime("%Y-%m-%d %H:%M", time.localtime(time_last))
+        ))
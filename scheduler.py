@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+Job Scheduler.
+
+limits how many USBStick jobs run at the same time.
+jobs above the limit wait in a queue.
+the queue is FIFO - ports listed in the priority order are served first.
+
+the TopologyScheduler additionally limits the writers per USB hub
+and per root bus - based on the port path (2-1.2.2.4).
+it learns the real throughput ceiling of every hub from the measured
+stick speeds - only the copy step of a job is measured.
+"""
+
+import heapq
+import itertools
+import threading
+import time
+
+
+class JobScheduler(object):
+    """Start USBStick jobs with a limited number of concurrent jobs."""
+
+    def __init__(self, max_jobs=0, priority_order=None):
+        """
+        Create new JobScheduler.
+
+        max_jobs: maximum concurrent jobs - 0 means no limit.
+        priority_order: list of priority keys (port numbers)
+            - earlier entries are started first.
+        """
+        super(JobScheduler, self).__init__()
+        self.max_jobs = max_jobs
+        if priority_order is None:
+            priority_order = []
+        self.priority_order = list(priority_order)
+        self.lock = threading.Lock()
+        self.counter = itertools.count()
+        self.waiting = []
+        self.running = set()
+        # function(job) that runs the job - default is job.start()
+        self.start_job = None
+
+    def get_priority(self, priority_key):
+        """Get sort priority for priority_key - smaller is earlier."""
+        try:
+            return self.priority_order.index(priority_key)
+        except ValueError:
+            return len(self.priority_order)
+
+    def has_free_slot(self):
+        """Check if one more job is allowed to run."""
+        return (self.max_jobs <= 0) or (len(self.running) < self.max_jobs)
+
+    def can_start(self, job):
+        """Check if job is allowed to start now - hook for subclasses."""
+        return True
+
+    def submit(self, job, priority_key=None):
+        """Start job or queue it if the limit is reached."""
+        with self.lock:
+            heapq.heappush(
+                self.waiting,
+                (self.get_priority(priority_key), next(self.counter), job)
+            )
+            self._start_waiting()
+            started = job in self.running
+        if not started:
+            job.show_port_message("queued")
+        return started
+
+    def remove(self, job):
+        """Remove job from the waiting queue (stick was unplugged)."""
+        with self.lock:
+            for item in self.waiting:
+                if item[2] is job:
+                    self.waiting.remove(item)
+                    heapq.heapify(self.waiting)
+                    return True
+        return False
+
+    def job_done(self, job):
+        """Call when job has finished - starts next waiting jobs."""
+        with self.lock:
+            self.running.discard(job)
+            self._job_finished(job)
+            self._start_waiting()
+
+    def job_write_started(self, job):
+        """Call when job starts to write its content (copy step)."""
+        with self.lock:
+            self._job_write_started(job)
+
+    def job_write_finished(self, job, bytes_written):
+        """Call when the copy step of job has written bytes_written."""
+        with self.lock:
+            self._job_write_finished(job, bytes_written)
+
+    def clear(self):
+        """Drop all waiting jobs."""
+        with self.lock:
+            self.waiting = []
+
+    def get_waiting_count(self):
+        """Count of waiting jobs."""
+        return len(self.waiting)
+
+    def _start_waiting(self):
+        # first job in priority / FIFO order that is allowed to run
+        for item in sorted(self.waiting):
+            if not self.has_free_slot():
+                break
+            job = item[2]
+            if self.can_start(job):
+                self.waiting.remove(item)
+                self._start(job)
+        heapq.heapify(self.waiting)
+
+    def _start(self, job):
+        self.running.add(job)
+        self._job_started(job)
+        job.job_done_callback = self.job_done
+        job.write_started_callback = self.job_write_started
+        job.write_finished_callback = self.job_write_finished
+        if self.start_job:
+            self.start_job(job)
+        else:
+            job.start()
+
+    def _job_started(self, job):
+        """Hook for subclasses - called with lock held."""
+        pass
+
+    def _job_finished(self, job):
+        """Hook for subclasses - called with lock held."""
+        pass
+
+    def _job_write_started(self, job):
+        """Hook for subclasses - called with lock held."""
+        pass
+
+    def _job_write_finished(self, job, bytes_written):
+        """Hook for subclasses - called with lock held."""
+        pass
+
+
+def get_hub_ids(port_id):
+    """
+    Get ids of all hubs and the root bus a port is connected through.
+
+    2-1.2.2.4 -> ['usb2', '2-1', '2-1.2', '2-1.2.2']
+    """
+    bus, path = port_id.split('-', 1)
+    levels = path.split('.')
+    hub_ids = ['usb' + bus]
+    for index in range(1, len(levels)):
+        hub_ids.append(bus + '-' + '.'.join(levels[:index]))
+    return hub_ids
+
+
+class HubStats(object):
+    """Concurrency and measured throughput of one hub or root bus."""
+
+    # samples per writer count needed before a ceiling is trusted
+    samples_min = 3
+    # only the samples of the last sample_age_max copy steps are used -
+    # a hub that changed (other sticks, warm controller) is measured
+    # again instead of being held at an old limit.
+    sample_age_max = 50
+
+    def __init__(self, hub_id):
+        """Create new HubStats."""
+        super(HubStats, self).__init__()
+        self.hub_id = hub_id
+        # running jobs - limited by the scheduler
+        self.active = 0
+        # jobs in their copy step
+        self.writing = 0
+        # time integral of writing jobs
+        self.writing_area = 0.0
+        self.last_change = time.monotonic()
+        # number of measured copy steps
+        self.sample_number = 0
+        # writer count -> list of (sample number, aggregate bytes/s)
+        self.throughput = {}
+        self.learned_limit = 0
+
+    def _update_area(self):
+        now = time.monotonic()
+        self.writing_area += self.writing * (now - self.last_change)
+        self.last_change = now
+        return now
+
+    def writer_started(self):
+        """Register one more writing job - returns start marker."""
+        now = self._update_area()
+        self.writing += 1
+        return (now, self.writing_area)
+
+    def writer_finished(self, start_marker, bytes_written):
+        """Unregister writing job and learn from its measured speed."""
+        now = self._update_area()
+        self.writing -= 1
+        start_time, start_area = start_marker
+        duration = now - start_time
+        if duration <= 0 or bytes_written <= 0:
+            return
+        # mean count of writers on this hub while this job was copying
+        writers = max(1, int(round(
+            (self.writing_area - start_area) / duration
+        )))
+        # every writer got about the same share of the hub
+        aggregate = writers * bytes_written / duration
+        self.sample_number += 1
+        self.throughput.setdefault(writers, []).append(
+            (self.sample_number, aggregate)
+        )
+        self._drop_old_samples()
+        self._learn()
+
+    def _drop_old_samples(self):
+        oldest = self.sample_number - self.sample_age_max
+        for writers in list(self.throughput):
+            samples = [
+                sample for sample in self.throughput[writers]
+                if sample[0] > oldest
+            ]
+            if samples:
+                self.throughput[writers] = samples
+            else:
+                del self.throughput[writers]
+
+    def _get_means(self, count_min=1):
+        # writer count -> mean aggregate bytes/s
+        means = {}
+        for writers, samples in self.throughput.items():
+            if len(samples) >= count_min:
+                means[writers] = (
+                    sum(aggregate for number, aggregate in samples) /
+                    len(samples)
+                )
+        return means
+
+    def _learn(self):
+        levels = self._get_means(self.samples_min)
+        if len(levels) < 2:
+            # not enough recent samples - the configured limits apply
+            # and the higher writer counts are measured again.
+            self.learned_limit = 0
+            return
+        best = max(levels.values())
+        # the smallest writer count that reaches the hub ceiling -
+        # more writers only add contention.
+        for writers in sorted(levels):
+            if levels[writers] >= 0.95 * best:
+                self.learned_limit = writers
+                break
+        # allow the scheduler to probe one level above the best known
+        if self.learned_limit == max(levels):
+            self.learned_limit += 1
+
+    def get_ceiling(self):
+        """Best measured aggregate throughput in bytes/s."""
+        means = self._get_means()
+        if not means:
+            return 0
+        return max(means.values())
+
+
+class TopologyScheduler(JobScheduler):
+    """JobScheduler that also limits concurrent writers per hub and bus."""
+
+    def __init__(
+        self,
+        max_jobs=0,
+        priority_order=None,
+        hub_limits=None,
+        bus_limits=None,
+        learn_limits=False
+    ):
+        """
+        Create new TopologyScheduler.
+
+        hub_limits / bus_limits: dict hub id ('2-1.2') or bus ('usb2')
+            to maximum concurrent writers - key 'default' for all others.
+            0 means no limit.
+        learn_limits: lower the limits to the learned hub ceilings.
+        """
+        super(TopologyScheduler, self).__init__(max_jobs, priority_order)
+        if hub_limits is None:
+            hub_limits = {}
+        if bus_limits is None:
+            bus_limits = {}
+        self.hub_limits = hub_limits
+        self.bus_limits = bus_limits
+        self.learn_limits = learn_limits
+        self.hub_stats = {}
+        self.job_markers = {}
+
+    def get_stats(self, hub_id):
+        """Get HubStats for hub_id."""
+        if hub_id not in self.hub_stats:
+            self.hub_stats[hub_id] = HubStats(hub_id)
+        return self.hub_stats[hub_id]
+
+    def get_limit(self, hub_id):
+        """Get effective writer limit for hub_id - 0 means no limit."""
+        if hub_id.startswith('usb'):
+            limits = self.bus_limits
+        else:
+            limits = self.hub_limits
+        limit = limits.get(hub_id, limits.get('default', 0))
+        stats = self.get_stats(hub_id)
+        if self.learn_limits and stats.learned_limit:
+            if limit <= 0:
+                limit = stats.learned_limit
+            else:
+                limit = min(limit, stats.learned_limit)
+        return limit
+
+    def can_start(self, job):
+        """Check hub and bus limits for job."""
+        for hub_id in get_hub_ids(job.get_usb_port_id()):
+            limit = self.get_limit(hub_id)
+            if limit > 0 and self.get_stats(hub_id).active >= limit:
+                return False
+        return True
+
+    def _job_started(self, job):
+        for hub_id in get_hub_ids(job.get_usb_port_id()):
+            self.get_stats(hub_id).active += 1
+
+    def _job_finished(self, job):
+        for hub_id in get_hub_ids(job.get_usb_port_id()):
+            self.get_stats(hub_id).active -= 1
+        # job ended inside its copy step (error / pulled) - not measured
+        self._job_write_finished(job, 0)
+
+    def _job_write_started(self, job):
+        self.job_markers[job] = [
+            (hub_id, self.get_stats(hub_id).writer_started())
+            for hub_id in get_hub_ids(job.get_usb_port_id())
+        ]
+
+    def _job_write_finished(self, job, bytes_written):
+        for hub_id, marker in self.job_markers.pop(job, []):
+            self.get_stats(hub_id).writer_finished(marker, bytes_written)
+
+    def get_hub_report(self):
+        """Get text table of all hubs with limit and learned ceiling."""
+        lines = []
+        with self.lock:
+            for hub_id, stats in sorted(self.hub_stats.items()):
+                lines.append(
+                    "{:<16} active:{:>3} limit:{:>3} ceiling:{:>8.1f}MB/s"
+                    "".format(
+                        hub_id,
+                        stats.active,
+                        self.get_limit(hub_id),
+                        stats.get_ceiling() / (1000 * 1000)
+                    )
+                )
+        return "\n".join(lines)
@@ -0,0 +1,105 @@
+# coding=utf-8
+
+"""
+Minimal FAT32 reader for the tests.
+
+reads directories with long names and file contents straight from
+an image file - no mount needed.
+"""
+
+import os
+import struct
+
+import fatfs
+
+
+# NT case flags of short names (byte 12 of a directory entry)
+CASE_LOWER_BASE = 0x08
+CASE_LOWER_EXT = 0x10
+
+
+class FatReader(object):
+    """Minimal FAT32 reader - directories with long names and files."""
+
+    def __init__(self, path):
+        """Open path and read the FAT."""
+        super(FatReader, self).__init__()
+        self.fd = os.open(path, os.O_RDONLY)
+        self.boot = fatfs.read_boot_sector(self.fd)
+        sector = self.boot.bytes_per_sector
+        self.cluster_size = self.boot.sectors_per_cluster * sector
+        self.data_offset = self.boot.first_data_sector * sector
+        fat = os.pread(
+            self.fd,
+            self.boot.fat_sectors * sector,
+            self.boot.reserved_sectors * sector
+        )
+        self.fat = struct.unpack('<{}I'.format(len(fat) // 4), fat)
+
+    def close(self):
+        """Close the file."""
+        os.close(self.fd)
+
+    def read_chain(self, cluster, size=None):
+        """Get the data of the cluster chain starting at cluster."""
+        parts = []
+        while 2 <= cluster < fatfs.fat32_end_of_chain:
+            parts.append(os.pread(
+                self.fd,
+                self.cluster_size,
+                self.data_offset + (cluster - 2) * self.cluster_size
+            ))
+            cluster = self.fat[cluster] & 0x0fffffff
+        data = b''.join(parts)
+        if size is not None:
+            data = data[:size]
+        return data
+
+    def list_dir(self, cluster=None):
+        """Get dict name -> (attr, first cluster, size)."""
+        if cluster is None:
+            cluster = self.boot.root_cluster
+        data = self.read_chain(cluster)
+        entries = {}
+        long_parts = []
+        for pos in range(0, len(data), 32):
+            raw = data[pos:pos + 32]
+            if raw[0] == 0x00:
+                break
+            attr = raw[11]
+            if attr == fatfs.ATTR_LONG_NAME:
+                # stored last part first
+                long_parts.insert(0, raw[1:11] + raw[14:26] + raw[28:32])
+                continue
+            if long_parts:
+                name = b''.join(long_parts).decode('utf-16-le')
+                name = name.split('\x00')[0]
+            else:
+                base = raw[0:8].decode('ascii').rstrip(' ')
+                ext = raw[8:11].decode('ascii').rstrip(' ')
+                if raw[12] & CASE_LOWER_BASE:
+                    base = base.lower()
+                if raw[12] & CASE_LOWER_EXT:
+                    ext = ext.lower()
+                name = base
+                if ext:
+                    name += '.' + ext
+            long_parts = []
+            high, = struct.unpack_from('<H', raw, 20)
+            low, size = struct.unpack_from('<HI', raw, 26)
+            entries[name] = (attr, high << 16 | low, size)
+        return entries
+
+    def read_tree(self, cluster=None, prefix=""):
+        """Get dict relative path -> file content ('dir' for folders)."""
+        tree = {}
+        for name, (attr, first, size) in self.list_dir(cluster).items():
+            if name in ('.', '..') or attr & fatfs.ATTR_VOLUME_ID:
+                continue
+            path = prefix + name
+            if attr & fatfs.ATTR_DIRECTORY:
+                tree[path] = 'dir'
+                tree.update(self.read_tree(first, path + "/"))
+            else:
+                tree[path] = self.read_chain(first, size)
+        return tree
@@ -0,0 +1,23 @@
+# coding=utf-8
+
+"""Tests for the asyncio subprocess helper of asynccore."""
+
+import asyncio
+import subprocess
+
+import pytest
+
+from asynccore import AsyncSystemManager
+
+
+def test_run_command_output():
+    output = asyncio.run(
+        AsyncSystemManager.run_command_async(["echo", "sun"])
+    )
+    assert output == b"sun\n"
+
+
+def test_run_command_error():
+    with pytest.raises(subprocess.CalledProcessError) as info:
+        asyncio.run(AsyncSystemManager.run_command_async(["false"]))
+    assert info.value.returncode == 1
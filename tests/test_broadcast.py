@@ -0,0 +1,221 @@
+# coding=utf-8
+
+"""Tests for broadcast.BroadcastEngine - temp folders as sticks."""
+
+import os
+import threading
+
+import pytest
+
+import broadcast
+import manifest
+import progress
+
+
+chunk_size = 4096
+buffer_count = 4
+
+
+def _create_source(src):
+    content = {
+        'a.txt': b'hello',
+        'empty': b'',
+        'big.bin': os.urandom(10 * chunk_size + 100),
+        'sub/inner.bin': os.urandom(3 * chunk_size),
+    }
+    for name, data in content.items():
+        path = os.path.join(src, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+    return content
+
+
+def _read_tree(dst):
+    tree = {}
+    for root, dirs, files in os.walk(dst):
+        for name in files:
+            path = os.path.join(root, name)
+            with open(path, 'rb') as f:
+                tree[os.path.relpath(path, dst)] = f.read()
+    return tree
+
+
+def _copy_parallel(engine, dsts, progresses=None):
+    errors = []
+    if progresses is None:
+        progresses = [None] * len(dsts)
+
+    def copy(dst, job_progress):
+        try:
+            engine.copy_to(dst, job_progress)
+        except (broadcast.Error, progress.Cancelled) as e:
+            errors.append(e)
+
+    threads = [
+        threading.Thread(target=copy, args=(dst, job_progress))
+        for dst, job_progress in zip(dsts, progresses)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+        assert not thread.is_alive()
+    return errors
+
+
+def test_fan_out(tmp_path):
+    src = str(tmp_path / "src")
+    content = _create_source(src)
+    engine = broadcast.BroadcastEngine(
+        manifest.SourceManifest(src),
+        chunk_size,
+        buffer_count
+    )
+    dsts = [str(tmp_path / "stick{}".format(index)) for index in range(3)]
+    for dst in dsts:
+        os.makedirs(dst)
+    assert _copy_parallel(engine, dsts) == []
+    for dst in dsts:
+        assert _read_tree(dst) == content
+    # every buffer is back in the pool
+    assert engine.pool.qsize() == buffer_count
+
+
+@pytest.mark.parametrize('writeback_window', [0, 2 * chunk_size])
+def test_progress(tmp_path, writeback_window):
+    src = str(tmp_path / "src")
+    content = _create_source(src)
+    source_manifest = manifest.SourceManifest(src)
+    engine = broadcast.BroadcastEngine(
+        source_manifest,
+        chunk_size,
+        buffer_count,
+        writeback_window=writeback_window
+    )
+    dst = str(tmp_path / "stick")
+    os.makedirs(dst)
+    job_progress = progress.Progress(
+        source_manifest.total_size,
+        len(source_manifest.files)
+    )
+    engine.copy_to(dst, job_progress)
+    assert job_progress.bytes_done == sum(map(len, content.values()))
+    assert job_progress.files_done == len(content)
+
+
+def test_cancelled_stick_leaves(tmp_path):
+    src = str(tmp_path / "src")
+    content = _create_source(src)
+    engine = broadcast.BroadcastEngine(
+        manifest.SourceManifest(src),
+        chunk_size,
+        buffer_count
+    )
+    dsts = [str(tmp_path / "stick{}".format(index)) for index in range(3)]
+    for dst in dsts:
+        os.makedirs(dst)
+    cancel_event = threading.Event()
+    cancel_event.set()
+    # the first stick is pulled before its first chunk is written
+    progresses = [
+        progress.Progress(0, 0, cancel_event=cancel_event),
+        None,
+        None,
+    ]
+    errors = _copy_parallel(engine, dsts, progresses)
+    assert len(errors) == 1
+    assert isinstance(errors[0], progress.Cancelled)
+    for dst in dsts[1:]:
+        assert _read_tree(dst) == content
+    # the chunks of the cancelled stick went back to the pool
+    assert engine.pool.qsize() == buffer_count
+
+
+def test_read_error_goes_to_every_stick(tmp_path):
+    src = str(tmp_path / "src")
+    content = _create_source(src)
+    engine = broadcast.BroadcastEngine(
+        manifest.SourceManifest(src),
+        chunk_size,
+        buffer_count
+    )
+    # vanishes after the scan
+    os.remove(os.path.join(src, 'big.bin'))
+    del content['big.bin']
+    dsts = [str(tmp_path / "stick{}".format(index)) for index in range(2)]
+    for dst in dsts:
+        os.makedirs(dst)
+    errors = _copy_parallel(engine, dsts)
+    assert len(errors) == 2
+    for dst in dsts:
+        tree = _read_tree(dst)
+        # the other files are complete
+        assert {name: tree[name] for name in content} == content
+    assert engine.pool.qsize() == buffer_count
+
+
+def test_late_stick_gets_all_files(tmp_path):
+    src = str(tmp_path / "src")
+    content = _create_source(src)
+    engine = broadcast.BroadcastEngine(
+        manifest.SourceManifest(src),
+        chunk_size,
+        buffer_count
+    )
+    first = str(tmp_path / "first")
+    late = str(tmp_path / "late")
+    os.makedirs(first)
+    os.makedirs(late)
+    engine.copy_to(first)
+    engine.copy_to(late)
+    assert _read_tree(first) == content
+    assert _read_tree(late) == content
+
+
+def test_copy_error_is_raised(tmp_path):
+    src = str(tmp_path / "src")
+    _create_source(src)
+    engine = broadcast.BroadcastEngine(
+        manifest.SourceManifest(src),
+        chunk_size,
+        buffer_count
+    )
+    # a file where the stick folder should be
+    dst = tmp_path / "stick"
+    dst.write_bytes(b'')
+    with pytest.raises(broadcast.Error):
+        engine.copy_to(str(dst))
+    assert engine.pool.qsize() == buffer_count
+
+
+def test_reader_failure_ends_every_stick(tmp_path, monkeypatch):
+    src = str(tmp_path / "src")
+    content = _create_source(src)
+    engine = broadcast.BroadcastEngine(
+        manifest.SourceManifest(src),
+        chunk_size,
+        buffer_count
+    )
+    send_file = engine._send_file
+
+    def fail_big(entry, recipients):
+        if entry.name == 'big.bin':
+            raise RuntimeError("reader bug")
+        send_file(entry, recipients)
+
+    monkeypatch.setattr(engine, '_send_file', fail_big)
+    dsts = [str(tmp_path / "stick{}".format(index)) for index in range(2)]
+    for dst in dsts:
+        os.makedirs(dst)
+    errors = _copy_parallel(engine, dsts)
+    assert len(errors) == 2
+    assert all(isinstance(e, broadcast.Error) for e in errors)
+    assert engine.reader_thread is None
+    assert engine.pool.qsize() == buffer_count
+    # the next stick starts a new reader
+    monkeypatch.setattr(engine, '_send_file', send_file)
+    late = str(tmp_path / "late")
+    os.makedirs(late)
+    engine.copy_to(late)
+    assert _read_tree(late) == content
@@ -0,0 +1,135 @@
+# coding=utf-8
+
+"""Tests for the copybackend backends and their fallbacks."""
+
+import os
+import errno
+
+import pytest
+
+import copybackend
+import progress
+import writeback
+
+
+def _create_source(tmp_path, size=300000):
+    src = str(tmp_path / "src.bin")
+    data = os.urandom(size)
+    with open(src, 'wb') as f:
+        f.write(data)
+    return src, data
+
+
+def _read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _fail_after_first_call(function, error):
+    calls = []
+
+    def fake(*args):
+        calls.append(args)
+        if len(calls) > 1:
+            raise OSError(error, os.strerror(error))
+        # a short first part - the fallback has to go on from there
+        args = list(args)
+        args[2] = 1000
+        return function(*args)
+    return fake
+
+
+@pytest.mark.parametrize('name', sorted(copybackend.backends))
+def test_backends_copy(tmp_path, name):
+    src, data = _create_source(tmp_path)
+    dst = str(tmp_path / "dst.bin")
+    backend = copybackend.get_backend(name, 64 * 1024)
+    assert backend.copy_file(src, dst, len(data)) == len(data)
+    assert _read(dst) == data
+
+
+@pytest.mark.parametrize('writeback_window', [0, 128 * 1024])
+@pytest.mark.parametrize('name', sorted(copybackend.backends))
+def test_backends_report_progress(tmp_path, name, writeback_window):
+    src, data = _create_source(tmp_path)
+    dst = str(tmp_path / "dst.bin")
+    backend = copybackend.get_backend(
+        name,
+        64 * 1024,
+        writeback_window=writeback_window
+    )
+    job_progress = progress.Progress(len(data), 1)
+    backend.copy_file(src, dst, len(data), job_progress)
+    assert job_progress.bytes_done == len(data)
+
+
+@pytest.mark.parametrize('name', sorted(copybackend.backends))
+def test_backends_share_stick_window(tmp_path, name):
+    src, data = _create_source(tmp_path)
+    backend = copybackend.get_backend(name, 64 * 1024)
+    job_progress = progress.Progress(2 * len(data), 2)
+    window = writeback.WritebackWindow(128 * 1024, job_progress)
+    try:
+        for index in range(2):
+            dst = str(tmp_path / "dst{}.bin".format(index))
+            backend.copy_file(src, dst, len(data), window=window)
+        window.finish()
+    finally:
+        window.close()
+    assert job_progress.bytes_done == 2 * len(data)
+    assert _read(str(tmp_path / "dst1.bin")) == data
+
+
+def test_preallocated_rest_is_cut_off(tmp_path):
+    src, data = _create_source(tmp_path)
+    dst = str(tmp_path / "dst.bin")
+    backend = copybackend.get_backend('buffered', 64 * 1024)
+    # the source got smaller since the scan
+    assert backend.copy_file(src, dst, len(data) + 100000) == len(data)
+    assert os.path.getsize(dst) == len(data)
+
+
+def test_zerocopy_falls_back_to_sendfile(tmp_path, monkeypatch):
+    src, data = _create_source(tmp_path)
+    dst = str(tmp_path / "dst.bin")
+    monkeypatch.setattr(
+        os,
+        'copy_file_range',
+        _fail_after_first_call(os.copy_file_range, errno.EXDEV)
+    )
+    backend = copybackend.get_backend('zerocopy', 64 * 1024)
+    assert backend.copy_file(src, dst, len(data)) == len(data)
+    assert _read(dst) == data
+
+
+def test_zerocopy_falls_back_to_buffered(tmp_path, monkeypatch):
+    src, data = _create_source(tmp_path)
+    dst = str(tmp_path / "dst.bin")
+    monkeypatch.setattr(
+        os,
+        'copy_file_range',
+        _fail_after_first_call(os.copy_file_range, errno.ENOSYS)
+    )
+
+    def sendfile(fd_out, fd_in, offset, count):
+        raise OSError(errno.EINVAL, os.strerror(errno.EINVAL))
+    monkeypatch.setattr(os, 'sendfile', sendfile)
+    backend = copybackend.get_backend('zerocopy', 64 * 1024)
+    assert backend.copy_file(src, dst, len(data)) == len(data)
+    assert _read(dst) == data
+
+
+def test_zerocopy_raises_other_errors(tmp_path, monkeypatch):
+    src, data = _create_source(tmp_path)
+
+    def copy_file_range(fd_in, fd_out, count):
+        raise OSError(errno.EIO, os.strerror(errno.EIO))
+    monkeypatch.setattr(os, 'copy_file_range', copy_file_range)
+    backend = copybackend.get_backend('zerocopy')
+    with pytest.raises(OSError):
+        backend.copy_file(src, str(tmp_path / "dst.bin"), len(data))
+
+
+def test_unknown_backend():
+    with pytest.raises(copybackend.Error):
+        copybackend.get_backend('rsync')
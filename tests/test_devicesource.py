@@ -0,0 +1,232 @@
+# coding=utf-8
+
+"""
+Tests for devicesource.FakeDeviceSource with the SystemManager.
+
+synthetic events are replayed like a recorded udev session -
+no hardware, no root and no pyudev needed.
+"""
+
+import json
+import time
+
+import pytest
+
+import devicesource
+from usbstick import USBStick
+from ustick_copy import SystemManager
+from asynccore import AsyncSystemManager
+
+
+managers = pytest.mark.parametrize(
+    'manager_class',
+    [SystemManager, AsyncSystemManager]
+)
+
+
+class RecordingStick(USBStick):
+    """Stick job that only records that it was started."""
+
+    started = None
+
+    def run(self):
+        try:
+            self.started.append(self.device.device_path)
+        finally:
+            if self.job_done_callback:
+                self.job_done_callback(self)
+
+
+class BlockingStick(USBStick):
+    """Stick job that runs until it is cancelled."""
+
+    def run(self):
+        try:
+            self.cancel_event.wait(10)
+        finally:
+            if self.job_done_callback:
+                self.job_done_callback(self)
+
+
+def _create_manager(tmp_path, manager_class=SystemManager):
+    config_filename = tmp_path / "config.json"
+    config_filename.write_text("{}")
+    device_source = devicesource.FakeDeviceSource()
+    manager = manager_class(
+        str(config_filename),
+        device_source=device_source
+    )
+    manager.stick_class = RecordingStick
+    stick_config = manager.config['stick_config']
+    stick_config['source_folder'] = str(tmp_path)
+    stick_config['copy_engine'] = 'single'
+    return manager, device_source
+
+
+def _wait_until(check, timeout=5):
+    time_end = time.monotonic() + timeout
+    while not check():
+        assert time.monotonic() < time_end
+        time.sleep(0.01)
+
+
+def _get_events(event_count, port_count):
+    return [
+        devicesource.device_to_event(action, device)
+        for action, device in devicesource.synthetic_events(
+            event_count,
+            port_count
+        )
+    ]
+
+
+def test_synthetic_events():
+    events = list(devicesource.synthetic_events(20, 9))
+    assert [action for action, device in events[:9]] == ['add'] * 9
+    assert [action for action, device in events[9:18]] == ['remove'] * 9
+    # 7 port hubs
+    port_ids = [
+        device.find_parent('usb').device_path.split('/')[-2]
+        for action, device in events[:9]
+    ]
+    assert port_ids[0] == '2-1.1.1'
+    assert port_ids[7] == '2-1.2.1'
+
+
+def test_fake_partition_properties():
+    device = devicesource.create_fake_partition('2-1.2.4', 'sdc', "SUN")
+    assert device.device_node == "/dev/sdc1"
+    assert device.properties['ID_BUS'] == 'usb'
+    assert device.properties.get('ID_FS_LABEL') == "SUN"
+    assert 'ID_SERIAL' in device.properties
+    # like pyudev 0.21+ - no mapping on the device itself
+    assert not hasattr(device, 'get')
+    assert device.find_parent('usb').device_path.endswith(
+        "/usb2/2-1/2-1.2/2-1.2.4/2-1.2.4:1.0"
+    )
+
+
+def test_recorded_events_replay(tmp_path):
+    events = _get_events(6, 3)
+    filename = tmp_path / "events.jsonl"
+    with open(str(filename), 'w') as f:
+        for event in events:
+            f.write(json.dumps(event) + "\n")
+    device_source = devicesource.FakeDeviceSource()
+    received = []
+    device_source.start(
+        lambda action, device: received.append((action, device))
+    )
+    device_source.replay(device_source.load_events(str(filename)))
+    device_source.stop()
+    assert [action for action, device in received] == (
+        ['add'] * 3 + ['remove'] * 3
+    )
+    # a removed device is the same object as the added one
+    assert received[0][1] is received[3][1]
+    assert received[0][1].properties == events[0]['properties']
+    assert received[0][1].find_parent('usb').device_path == (
+        events[0]['usb_path']
+    )
+
+
+@managers
+def test_replay_maps_ports(tmp_path, manager_class):
+    manager, device_source = _create_manager(tmp_path, manager_class)
+    events = _get_events(30, 10)
+    manager.start_mapping()
+    device_source.replay(events)
+    manager.wait_for_events()
+    manager.stop()
+    usb_paths = []
+    for event in events:
+        if event['usb_path'] not in usb_paths:
+            usb_paths.append(event['usb_path'])
+    # ports are numbered in the order the sticks were plugged in
+    assert manager.config['port_map'] == {
+        usb_path: index for index, usb_path in enumerate(usb_paths)
+    }
+
+
+@managers
+def test_copy_mode_starts_every_stick(tmp_path, manager_class):
+    manager, device_source = _create_manager(tmp_path, manager_class)
+    RecordingStick.started = []
+    events = list(devicesource.synthetic_events(40, 10))
+    manager.start_copy()
+    try:
+        for action, device in events:
+            device_source.emit(action, device)
+        manager.wait_for_events()
+    finally:
+        manager.stop()
+    added = [
+        device.device_path
+        for action, device in events
+        if action == 'add'
+    ]
+    assert sorted(RecordingStick.started) == sorted(added)
+    # every stick was removed again
+    assert manager.stick_dict == {}
+
+
+@managers
+def test_remove_cancels_running_job(tmp_path, manager_class):
+    manager, device_source = _create_manager(tmp_path, manager_class)
+    manager.stick_class = BlockingStick
+    devices = [
+        devicesource.create_fake_partition(port_id, name)
+        for port_id, name in (('2-1.1', 'sdb'), ('2-1.2', 'sdc'))
+    ]
+    manager.start_copy()
+    try:
+        for device in devices:
+            device_source.emit('add', device)
+        manager.wait_for_events()
+        sticks = [
+            manager.stick_dict[device.device_path] for device in devices
+        ]
+        assert all(manager._job_is_running(stick) for stick in sticks)
+
+        device_source.emit('remove', devices[0])
+        manager.wait_for_events()
+        assert devices[0].device_path not in manager.stick_dict
+        assert sticks[0].is_cancelled()
+        # the other port goes on
+        assert not sticks[1].is_cancelled()
+        _wait_until(lambda: not manager._job_is_running(sticks[0]))
+        assert manager._job_is_running(sticks[1])
+    finally:
+        for stick in manager.stick_dict.values():
+            stick.cancel()
+        manager.stop()
+
+
+@managers
+def test_remove_drops_queued_job(tmp_path, manager_class):
+    manager, device_source = _create_manager(tmp_path, manager_class)
+    manager.stick_class = BlockingStick
+    manager.config['max_concurrent_jobs'] = 1
+    devices = [
+        devicesource.create_fake_partition(port_id, name)
+        for port_id, name in (('2-1.1', 'sdb'), ('2-1.2', 'sdc'))
+    ]
+    manager.start_copy()
+    try:
+        for device in devices:
+            device_source.emit('add', device)
+        manager.wait_for_events()
+        queued = manager.stick_dict[devices[1].device_path]
+        assert manager.scheduler.get_waiting_count() == 1
+
+        device_source.emit('remove', devices[1])
+        manager.wait_for_events()
+        assert manager.scheduler.get_waiting_count() == 0
+        assert queued.is_cancelled()
+        # the queued job never started
+        assert not manager._job_is_running(queued)
+        assert queued.ident is None
+    finally:
+        for stick in manager.stick_dict.values():
+            stick.cancel()
+        manager.stop()
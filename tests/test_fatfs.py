@@ -0,0 +1,219 @@
+# coding=utf-8
+
+"""
+Tests for the label and quick format functions of fatfs.
+
+the FAT16 and FAT32 filesystems are handcrafted sparse temp files -
+format_fat32 is read back with the small FAT32 reader (fatreader.py).
+"""
+
+import os
+import struct
+
+import pytest
+
+import fatfs
+import fatreader
+
+
+sector_size = 512
+
+
+def _write(path, offset, data):
+    with open(path, 'r+b') as f:
+        f.seek(offset)
+        f.write(data)
+
+
+def _read(path, offset, size):
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        return f.read(size)
+
+
+def _create_file(path, size):
+    with open(path, 'wb') as f:
+        f.truncate(size)
+
+
+def _create_fat16(path, label=b'OLD        '):
+    # 16MiB - 4 sectors per cluster gives about 8000 clusters
+    total_sectors = 32768
+    boot = bytearray(sector_size)
+    boot[0:3] = b'\xeb\x3c\x90'
+    boot[3:11] = b'MSWIN4.1'
+    struct.pack_into(
+        '<HBHBHHBH', boot, 11,
+        sector_size, 4, 1, 2, 512, total_sectors, 0xf8, 32
+    )
+    boot[38] = 0x29
+    boot[43:54] = label
+    boot[54:62] = b'FAT16   '
+    boot[510:512] = b'\x55\xaa'
+    _create_file(path, total_sectors * sector_size)
+    _write(path, 0, bytes(boot))
+    # root directory behind the two FATs
+    return (1 + 2 * 32) * sector_size
+
+
+def _create_fat32(path):
+    # 64MiB - 1 sector per cluster gives more than 65525 clusters
+    total_sectors = 131072
+    reserved_sectors = 32
+    fat_sectors = 1024
+    boot = bytearray(sector_size)
+    boot[0:3] = b'\xeb\x58\x90'
+    boot[3:11] = b'MSWIN4.1'
+    struct.pack_into(
+        '<HBHBHHBH', boot, 11,
+        sector_size, 1, reserved_sectors, 2, 0, 0, 0xf8, 0
+    )
+    struct.pack_into('<I', boot, 32, total_sectors)
+    # FAT sectors, flags, version, root cluster, fsinfo, backup boot
+    struct.pack_into('<IHHIHH', boot, 36, fat_sectors, 0, 0, 2, 1, 6)
+    boot[66] = 0x29
+    boot[71:82] = b'NO NAME    '
+    boot[82:90] = b'FAT32   '
+    boot[510:512] = b'\x55\xaa'
+    _create_file(path, total_sectors * sector_size)
+    _write(path, 0, bytes(boot))
+    _write(path, 6 * sector_size, bytes(boot))
+    # cluster 2 (root directory) is the end of its chain
+    fat = struct.pack('<3I', 0x0ffffff8, 0x0fffffff, 0x0fffffff)
+    _write(path, reserved_sectors * sector_size, fat)
+    # root directory = cluster 2 = first data sector
+    return (reserved_sectors + 2 * fat_sectors) * sector_size
+
+
+def _entry(name, attr):
+    return struct.pack('<11sB20x', name, attr)
+
+
+def test_check_label():
+    assert fatfs.check_label("sun") == b'SUN        '
+    assert fatfs.check_label("ABCDEFGHIJK") == b'ABCDEFGHIJK'
+    for label in ("A", "ABCDEFGHIJKL", " SUN", "S.N", "SüN"):
+        assert not fatfs.is_valid_label(label)
+        with pytest.raises(fatfs.Error):
+            fatfs.check_label(label)
+
+
+def test_boot_sector_types(tmp_path):
+    fat16 = str(tmp_path / "fat16.img")
+    _create_fat16(fat16)
+    fat32 = str(tmp_path / "fat32.img")
+    _create_fat32(fat32)
+    for path, fat_type in ((fat16, 16), (fat32, 32)):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            assert fatfs.read_boot_sector(fd).fat_type == fat_type
+        finally:
+            os.close(fd)
+    with pytest.raises(fatfs.Error):
+        fatfs.parse_boot_sector(bytes(sector_size))
+
+
+def test_fat16_label_entry_is_patched(tmp_path):
+    path = str(tmp_path / "fat16.img")
+    root_offset = _create_fat16(path)
+    # a file first - then the label entry
+    _write(path, root_offset, _entry(b'README  TXT', fatfs.ATTR_ARCHIVE))
+    _write(path, root_offset + 32, _entry(b'OLD        ', 0x08))
+    assert fatfs.read_label(path) == "OLD"
+    fatfs.write_label(path, "new label")
+    assert fatfs.read_label(path) == "NEW LABEL"
+    assert _read(path, root_offset + 32, 11) == b'NEW LABEL  '
+    assert _read(path, 43, 11) == b'NEW LABEL  '
+    # the file entry is untouched
+    assert _read(path, root_offset, 11) == b'README  TXT'
+
+
+def test_fat16_label_entry_is_created(tmp_path):
+    path = str(tmp_path / "fat16.img")
+    root_offset = _create_fat16(path)
+    deleted = bytearray(_entry(b'XOLD    TXT', fatfs.ATTR_ARCHIVE))
+    deleted[0] = 0xe5
+    _write(path, root_offset, bytes(deleted))
+    fatfs.write_label(path, "SUN")
+    # the deleted entry is reused
+    entry = _read(path, root_offset, 32)
+    assert entry[:11] == b'SUN        '
+    assert entry[11] == fatfs.ATTR_VOLUME_ID
+    assert fatfs.read_label(path) == "SUN"
+
+
+def test_fat32_label(tmp_path):
+    path = str(tmp_path / "fat32.img")
+    root_offset = _create_fat32(path)
+    assert fatfs.read_label(path) == "NO NAME"
+    fatfs.write_label(path, "SUN")
+    assert _read(path, root_offset, 12) == b'SUN        \x08'
+    # boot sector and its backup
+    assert _read(path, 71, 11) == b'SUN        '
+    assert _read(path, 6 * sector_size + 71, 11) == b'SUN        '
+    assert fatfs.read_label(path) == "SUN"
+
+
+def test_plan_fat32_cluster_size():
+    gib = 1024 * 1024 * 1024
+    layout = fatfs.plan_fat32(8 * gib)
+    assert layout.sectors_per_cluster * sector_size == 32768
+    # too few clusters for 32KiB - the largest that still fits
+    layout = fatfs.plan_fat32(1 * gib)
+    assert layout.sectors_per_cluster * sector_size == 8192
+    assert layout.cluster_count >= fatfs.fat32_clusters_min
+    with pytest.raises(fatfs.Error):
+        fatfs.plan_fat32(1 * gib, cluster_size=65536)
+    with pytest.raises(fatfs.Error):
+        # too small for FAT32
+        fatfs.plan_fat32(16 * 1024 * 1024)
+
+
+def test_plan_fat32_alignment():
+    alignment = 4 * 1024 * 1024
+    for start in (0, 1024 * 1024, 32256):
+        layout = fatfs.plan_fat32(
+            2 * 1024 * 1024 * 1024,
+            start,
+            alignment
+        )
+        data_start = (
+            layout.reserved_sectors + 2 * layout.fat_sectors
+        ) * sector_size
+        assert (start + data_start) % alignment == 0
+        assert layout.hidden_sectors == start // sector_size
+
+
+def test_format_fat32(tmp_path):
+    path = str(tmp_path / "stick.img")
+    # old data in the FAT region has to go
+    _create_file(path, 256 * 1024 * 1024)
+    _write(path, 4 * 1024 * 1024, b'\xff' * 65536)
+    layout = fatfs.format_fat32(path, "sun", alignment=1024 * 1024)
+    reader = fatreader.FatReader(path)
+    try:
+        assert reader.boot.fat_type == 32
+        assert reader.boot.cluster_count == layout.cluster_count
+        assert reader.data_offset % (1024 * 1024) == 0
+        # only the root directory is used
+        assert reader.fat[:3] == (0x0ffffff8, 0x0fffffff, 0x0fffffff)
+        assert not any(reader.fat[3:])
+        assert reader.read_tree() == {}
+    finally:
+        reader.close()
+    assert fatfs.read_label(path) == "SUN"
+    # backup boot sector
+    assert _read(path, 6 * sector_size, sector_size) == (
+        _read(path, 0, sector_size)
+    )
+
+
+def test_format_gets_own_volume_id(tmp_path):
+    paths = [str(tmp_path / "stick{}.img".format(i)) for i in range(2)]
+    for path in paths:
+        _create_file(path, 128 * 1024 * 1024)
+        fatfs.format_fat32(path, "SUN")
+    first, second = [_read(path, 0, sector_size) for path in paths]
+    # the same skeleton - only the volume id differs
+    assert first[67:71] != second[67:71]
+    assert first[:67] + first[71:] == second[:67] + second[71:]
@@ -0,0 +1,154 @@
+# coding=utf-8
+
+"""
+Tests for fatimage.build_image and fatimage.write_image.
+
+the images and sticks are sparse temp files -
+the FAT32 volumes are created with fatfs.format_fat32 and fatwriter.
+"""
+
+import os
+
+import pytest
+
+import fatfs
+import fatimage
+import fatreader
+import fatwriter
+import manifest
+import progress
+
+
+volume_size = 64 * 1024 * 1024
+alignment = 1024 * 1024
+used_offset = 16 * 1024 * 1024
+
+
+def _create_image(path, size=volume_size):
+    with open(path, 'wb') as f:
+        f.truncate(size)
+    layout = fatfs.format_fat32(path, "IMAGE", alignment=alignment)
+    data_offset = (
+        layout.reserved_sectors + 2 * layout.fat_sectors
+    ) * fatfs.sector_size
+    # one used cluster in the middle of the free space
+    with open(path, 'r+b') as f:
+        f.seek(data_offset + used_offset)
+        f.write(b'\x02' * 4096)
+    return layout, data_offset
+
+
+def _create_stick(path, size=volume_size):
+    # old content that the clone has to replace
+    with open(path, 'wb') as f:
+        f.write(b'\xee' * size)
+
+
+def _read(path, offset, size):
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        return f.read(size)
+
+
+def test_write_image_skips_holes(tmp_path):
+    image = str(tmp_path / "image.img")
+    layout, data_offset = _create_image(image)
+    fats_offset = layout.reserved_sectors * fatfs.sector_size
+    fats_size = 2 * layout.fat_sectors * fatfs.sector_size
+    image_bytes = fatimage.get_image_bytes(image)
+    # reserved region, both FATs, the root cluster and the used cluster
+    # (holes are found in blocks of the temp filesystem)
+    cluster_size = layout.sectors_per_cluster * fatfs.sector_size
+    assert data_offset + cluster_size + 4096 <= image_bytes
+    assert image_bytes <= data_offset + 2 * 4096
+    sticks = [str(tmp_path / "stick{}.img".format(i)) for i in range(2)]
+    for stick in sticks:
+        _create_stick(stick)
+        assert fatimage.write_image(image, stick) == image_bytes
+        assert _read(stick, data_offset + used_offset, 4096) == (
+            b'\x02' * 4096
+        )
+        # the free clusters are not written
+        assert _read(stick, data_offset + 4096, 4096) == b'\xee' * 4096
+        # the FATs are overwritten completely
+        assert _read(stick, fats_offset, fats_size) == (
+            _read(image, fats_offset, fats_size)
+        )
+        assert fatfs.read_label(stick) == "IMAGE"
+    # every stick gets its own volume id - in both boot sectors
+    volume_ids = []
+    for stick in sticks:
+        ids = set(
+            _read(stick, sector * fatfs.sector_size + 67, 4)
+            for sector in (0, 6)
+        )
+        assert len(ids) == 1
+        volume_ids.append(ids.pop())
+    assert volume_ids[0] != volume_ids[1]
+
+
+def test_write_image_progress(tmp_path):
+    image = str(tmp_path / "image.img")
+    _create_image(image)
+    stick = str(tmp_path / "stick.img")
+    _create_stick(stick)
+    image_bytes = fatimage.get_image_bytes(image)
+    job_progress = progress.Progress(image_bytes, 0)
+    fatimage.write_image(image, stick, progress=job_progress)
+    assert job_progress.bytes_done == image_bytes
+
+
+def test_image_larger_than_partition(tmp_path):
+    image = str(tmp_path / "image.img")
+    _create_image(image, 2 * volume_size)
+    stick = str(tmp_path / "stick.img")
+    _create_stick(stick)
+    with pytest.raises(fatimage.Error):
+        fatimage.write_image(image, stick)
+    # nothing written
+    assert _read(stick, 0, 512) == b'\xee' * 512
+
+
+def test_image_without_boot_sector(tmp_path):
+    image = str(tmp_path / "image.img")
+    with open(image, 'wb') as f:
+        f.truncate(volume_size)
+    stick = str(tmp_path / "stick.img")
+    _create_stick(stick)
+    with pytest.raises(fatfs.Error):
+        fatimage.write_image(image, stick)
+
+
+def test_build_image(tmp_path):
+    src = tmp_path / "src"
+    (src / "sub").mkdir(parents=True)
+    (src / "readme.txt").write_bytes(b'hello')
+    (src / "sub" / "Long Name.bin").write_bytes(os.urandom(70000))
+    image = str(tmp_path / "images" / "image.img")
+    geometry = fatfs.Geometry(
+        size=volume_size,
+        start=0,
+        alignment=alignment
+    )
+    fatimage.build_image(
+        fatwriter.FatWriter(manifest.SourceManifest(str(src))),
+        image,
+        geometry,
+        "CLONE"
+    )
+    # sparse - exactly as large as the partition
+    assert os.path.getsize(image) == volume_size
+    assert fatimage.get_image_bytes(image) < volume_size // 4
+    stick = str(tmp_path / "stick.img")
+    _create_stick(stick)
+    fatimage.write_image(image, stick)
+    assert fatfs.read_label(stick) == "CLONE"
+    reader = fatreader.FatReader(stick)
+    try:
+        assert reader.read_tree() == {
+            'readme.txt': b'hello',
+            'sub': 'dir',
+            'sub/Long Name.bin': (src / "sub" / "Long Name.bin").read_bytes(),
+        }
+    finally:
+        reader.close()
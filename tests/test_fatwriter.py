@@ -0,0 +1,125 @@
+# coding=utf-8
+
+"""
+Tests for fatwriter.FatWriter.
+
+the filesystems are written to sparse temp files and read back
+with tests/fatreader.py - no mount needed.
+"""
+
+import os
+
+import pytest
+
+import fatfs
+import fatreader
+import fatwriter
+import manifest
+import progress
+
+
+volume_size = 64 * 1024 * 1024
+
+
+def _create_file(path, size):
+    with open(path, 'wb') as f:
+        f.truncate(size)
+
+
+def _create_source(src):
+    content = {
+        'short.txt': b'hello',
+        'Long File Name.data': os.urandom(5000),
+        'empty': b'',
+        'sub/inner.bin': os.urandom(70000),
+        'sub/deeper/UPPER.TXT': b'upper',
+    }
+    for name, data in content.items():
+        path = os.path.join(src, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+    tree = dict(content)
+    tree['sub'] = 'dir'
+    tree['sub/deeper'] = 'dir'
+    return tree
+
+
+def test_short_names():
+    used = set()
+    assert fatwriter.get_short_name("UPPER.TXT", used) == (
+        b'UPPER   TXT', 0, False
+    )
+    assert fatwriter.get_short_name("short.txt", used) == (
+        b'SHORT   TXT',
+        fatwriter.CASE_LOWER_BASE | fatwriter.CASE_LOWER_EXT,
+        False
+    )
+    # numbered basis name - the next free number
+    used.add(b'LONGFI~1DAT')
+    assert fatwriter.get_short_name("Long File Name.data", used) == (
+        b'LONGFI~2DAT', 0, True
+    )
+
+
+def test_fat_writer(tmp_path):
+    src = str(tmp_path / "src")
+    tree = _create_source(src)
+    image = str(tmp_path / "stick.img")
+    _create_file(image, volume_size)
+    fat_writer = fatwriter.FatWriter(manifest.SourceManifest(src))
+    written = fat_writer.write(image, "RAW TEST")
+    assert written == sum(
+        len(data) for data in tree.values() if data != 'dir'
+    )
+    assert fatfs.read_label(image) == "RAW TEST"
+    reader = fatreader.FatReader(image)
+    try:
+        assert reader.boot.fat_type == 32
+        assert reader.read_tree() == tree
+        # lowercase 8.3 names need no long name entries
+        assert 'short.txt' in reader.list_dir()
+    finally:
+        reader.close()
+
+
+@pytest.mark.parametrize('writeback_window', [0, 64 * 1024])
+def test_fat_writer_progress(tmp_path, writeback_window):
+    src = str(tmp_path / "src")
+    _create_source(src)
+    image = str(tmp_path / "stick.img")
+    _create_file(image, volume_size)
+    fat_writer = fatwriter.FatWriter(
+        manifest.SourceManifest(src),
+        writeback_window=writeback_window
+    )
+    plan = fat_writer.get_plan(fatfs.get_geometry(image), "RAW TEST")
+    job_progress = progress.Progress(plan.files_size, len(plan.files))
+    fat_writer.write(image, "RAW TEST", progress=job_progress)
+    # the stream with the padding of every last cluster
+    assert job_progress.bytes_done == plan.files_size
+
+
+def test_estimate_size_covers_plan(tmp_path):
+    src = str(tmp_path / "src")
+    _create_source(src)
+    fat_writer = fatwriter.FatWriter(manifest.SourceManifest(src))
+    plan = fat_writer.get_plan(
+        fatfs.Geometry(size=volume_size, start=0, alignment=1024**2),
+        "RAW TEST"
+    )
+    required = fatwriter.estimate_size(fat_writer.manifest, plan.cluster_size)
+    assert required >= plan.clusters_used * plan.cluster_size
+    # only the long name entries of 8.3 names are counted too much
+    assert required <= (plan.clusters_used + 4) * plan.cluster_size
+
+
+def test_fat_writer_rejects_too_large_source(tmp_path):
+    src = str(tmp_path / "src")
+    os.makedirs(src)
+    _create_file(os.path.join(src, "big"), volume_size)
+    image = str(tmp_path / "stick.img")
+    _create_file(image, volume_size)
+    fat_writer = fatwriter.FatWriter(manifest.SourceManifest(src))
+    with pytest.raises(fatwriter.Error):
+        fat_writer.write(image, "RAW TEST")
@@ -0,0 +1,81 @@
+# coding=utf-8
+
+"""Tests for hashcache.HashCache."""
+
+import os
+
+import verify
+import manifest
+import hashcache
+
+
+def _write(path, data, mtime=None):
+    with open(path, 'wb') as f:
+        f.write(data)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+
+def _count_hashes(monkeypatch):
+    hashed = []
+    hash_file = verify.hash_file
+
+    def counting_hash_file(filename, algorithm='sha256'):
+        hashed.append(os.path.basename(filename))
+        return hash_file(filename, algorithm)
+    monkeypatch.setattr(verify, 'hash_file', counting_hash_file)
+    return hashed
+
+
+def _get_digests(cache_file, src, algorithm='sha256'):
+    cache = hashcache.HashCache(cache_file, src, algorithm, threads=2)
+    return cache.get_digests(manifest.SourceManifest(src))
+
+
+def test_only_changed_files_are_hashed(tmp_path, monkeypatch):
+    src = str(tmp_path / "src")
+    os.makedirs(src)
+    for name in ('a', 'b', 'c'):
+        _write(os.path.join(src, name), name.encode() * 100, 1000000)
+    cache_file = str(tmp_path / "source_hashes.json")
+    hashed = _count_hashes(monkeypatch)
+    digests = _get_digests(cache_file, src)
+    assert sorted(hashed) == ['a', 'b', 'c']
+    assert digests['a'] == verify.hash_file(os.path.join(src, 'a'))
+
+    # next session - nothing changed
+    del hashed[:]
+    assert _get_digests(cache_file, src) == digests
+    assert hashed == []
+
+    # same size, other mtime / other size, same mtime / removed
+    _write(os.path.join(src, 'a'), b'x' * 100, 2000000)
+    _write(os.path.join(src, 'b'), b'b' * 101, 1000000)
+    os.remove(os.path.join(src, 'c'))
+    digests = _get_digests(cache_file, src)
+    assert sorted(hashed) == ['a', 'b']
+    assert digests['a'] == verify.hash_file(os.path.join(src, 'a'))
+    assert sorted(digests) == ['a', 'b']
+
+
+def test_other_algorithm_or_source_is_not_used(tmp_path, monkeypatch):
+    src = str(tmp_path / "src")
+    os.makedirs(src)
+    _write(os.path.join(src, 'a'), b'a')
+    cache_file = str(tmp_path / "source_hashes.json")
+    hashed = _count_hashes(monkeypatch)
+    _get_digests(cache_file, src)
+    _get_digests(cache_file, src, 'md5')
+    other_src = str(tmp_path / "other")
+    os.rename(src, other_src)
+    _get_digests(cache_file, other_src, 'md5')
+    assert hashed == ['a', 'a', 'a']
+
+
+def test_broken_cache_file(tmp_path):
+    src = str(tmp_path / "src")
+    os.makedirs(src)
+    _write(os.path.join(src, 'a'), b'a')
+    cache_file = str(tmp_path / "source_hashes.json")
+    _write(cache_file, b'{"entries": ')
+    assert list(_get_digests(cache_file, src)) == ['a']
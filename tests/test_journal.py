@@ -0,0 +1,95 @@
+# coding=utf-8
+
+"""Tests for journal.CopyJournal and the resume of the broadcast copy."""
+
+import os
+import collections
+
+import broadcast
+import journal
+import manifest
+
+
+Entry = collections.namedtuple('Entry', ['name'])
+
+
+def test_journal_resume(tmp_path):
+    filename = str(tmp_path / "copy_journal" / "SERIAL_2-1.1.journal")
+    copy_journal = journal.CopyJournal(filename, "source-a")
+    assert copy_journal.load() == set()
+    copy_journal.open()
+    copy_journal.add(Entry('a.txt'))
+    copy_journal.add(Entry('sub/b.txt'))
+    copy_journal.close()
+    # crash while the next line was written
+    with open(filename, 'a') as f:
+        f.write('"sub/c.t')
+
+    resumed = journal.CopyJournal(filename, "source-a")
+    assert resumed.load() == {'a.txt', 'sub/b.txt'}
+    # only what is still valid on the stick is kept
+    resumed.open(['a.txt'])
+    resumed.add(Entry('sub/c.txt'))
+    resumed.close()
+    assert journal.CopyJournal(filename, "source-a").load() == {
+        'a.txt',
+        'sub/c.txt',
+    }
+
+
+def test_journal_of_other_source_is_ignored(tmp_path):
+    filename = str(tmp_path / "x.journal")
+    copy_journal = journal.CopyJournal(filename, "source-a")
+    copy_journal.open()
+    copy_journal.add(Entry('a.txt'))
+    copy_journal.close()
+    assert journal.CopyJournal(filename, "source-b").load() == set()
+
+
+def test_journal_remove(tmp_path):
+    filename = str(tmp_path / "x.journal")
+    copy_journal = journal.CopyJournal(filename, "source-a")
+    copy_journal.open()
+    copy_journal.remove()
+    assert not os.path.exists(filename)
+    # a second remove is no error
+    copy_journal.remove()
+
+
+def test_journal_name():
+    assert journal.get_journal_name("Kingston DT/1", "2-1.2") == (
+        "Kingston_DT_1_2-1.2.journal"
+    )
+
+
+def test_broadcast_skips_journaled_files(tmp_path):
+    src = tmp_path / "src"
+    src.mkdir()
+    (src / "a.txt").write_bytes(b'a' * 100)
+    (src / "b.txt").write_bytes(b'b' * 100)
+    source_manifest = manifest.SourceManifest(str(src))
+    dst = tmp_path / "stick"
+    dst.mkdir()
+    copy_journal = journal.CopyJournal(
+        str(tmp_path / "x.journal"),
+        source_manifest.get_signature()
+    )
+    copy_journal.open(['a.txt'])
+    engine = broadcast.BroadcastEngine(source_manifest, 4096, 4)
+    engine.copy_to(str(dst), journal=copy_journal)
+    copy_journal.close()
+    # a.txt is already on the stick - it is not written again
+    assert sorted(os.listdir(str(dst))) == ['b.txt']
+    assert copy_journal.done == {'a.txt', 'b.txt'}
+
+
+def test_signature_changes_with_the_source(tmp_path):
+    (tmp_path / "a.txt").write_bytes(b'a')
+    signature = manifest.SourceManifest(str(tmp_path)).get_signature()
+    assert manifest.SourceManifest(str(tmp_path)).get_signature() == (
+        signature
+    )
+    (tmp_path / "b.txt").write_bytes(b'b')
+    assert manifest.SourceManifest(str(tmp_path)).get_signature() != (
+        signature
+    )
@@ -0,0 +1,104 @@
+# coding=utf-8
+
+"""Tests for manifest.SourceManifest and manifest.PathFilter."""
+
+import os
+
+import configdict
+import manifest
+from copysession import CopySession
+from usbstick import USBStick
+
+
+def test_manifest_scan(tmp_path):
+    for name in ('b.txt', 'a/c.txt', 'a/deeper/d.txt'):
+        path = tmp_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b'x' * 10)
+    os.symlink('b.txt', str(tmp_path / 'link'))
+    source_manifest = manifest.SourceManifest(str(tmp_path))
+    # parents before their children
+    assert [entry.name for entry in source_manifest.dirs] == [
+        'a',
+        os.path.join('a', 'deeper'),
+    ]
+    assert [entry.name for entry in source_manifest.files] == [
+        'b.txt',
+        os.path.join('a', 'c.txt'),
+        os.path.join('a', 'deeper', 'd.txt'),
+    ]
+    assert [
+        (entry.name, entry.link_target) for entry in source_manifest.links
+    ] == [('link', 'b.txt')]
+    assert source_manifest.total_size == 30
+    assert len(source_manifest) == 6
+
+
+def test_exclude_name_in_every_folder():
+    path_filter = manifest.PathFilter(exclude=['.DS_Store', '*.tmp'])
+    assert path_filter.is_excluded('.DS_Store', 'file')
+    assert path_filter.is_excluded('sub/deeper/.DS_Store', 'file')
+    assert path_filter.is_excluded('sub/x.tmp', 'file')
+    assert not path_filter.is_excluded('sub/x.txt', 'file')
+
+
+def test_exclude_path_from_source_root():
+    path_filter = manifest.PathFilter(exclude=['/example.file', 'docs/*.pdf'])
+    assert path_filter.is_excluded('example.file', 'file')
+    assert not path_filter.is_excluded('sub/example.file', 'file')
+    assert path_filter.is_excluded('docs/a.pdf', 'file')
+    # '*' also matches '/'
+    assert path_filter.is_excluded('docs/old/a.pdf', 'file')
+    assert not path_filter.is_excluded('a.pdf', 'file')
+
+
+def test_include_selects_files_only():
+    path_filter = manifest.PathFilter(include=['*.mp3'])
+    assert not path_filter.is_excluded('music/a.mp3', 'file')
+    assert path_filter.is_excluded('music/a.txt', 'file')
+    # folders are always scanned
+    assert not path_filter.is_excluded('music', 'dir')
+
+
+def test_exclude_wins_over_include():
+    path_filter = manifest.PathFilter(
+        include=['*.mp3'],
+        exclude=['/private']
+    )
+    assert path_filter.is_excluded('private', 'dir')
+    assert not path_filter.is_excluded('public/a.mp3', 'file')
+
+
+def test_manifest_skips_excluded_entries(tmp_path):
+    for name in ('a.txt', '.DS_Store', 'skip/b.txt', 'keep/c.txt'):
+        path = tmp_path / name
+        path.parent.mkdir(exist_ok=True)
+        path.write_bytes(b'x' * 10)
+    source_manifest = manifest.SourceManifest(
+        str(tmp_path),
+        manifest.PathFilter(exclude=['.DS_Store', '/skip'])
+    )
+    assert [entry.name for entry in source_manifest.files] == [
+        'a.txt',
+        os.path.join('keep', 'c.txt'),
+    ]
+    assert [entry.name for entry in source_manifest.dirs] == ['keep']
+    # the excluded folder is not scanned - its file is not counted
+    assert source_manifest.excluded_count == 2
+    assert source_manifest.total_size == 20
+
+
+def test_remove_steps_extend_the_filter(tmp_path):
+    config = configdict.merge_deep(USBStick.default_config, {
+        'source_folder': str(tmp_path),
+        'files_to_remove': ['example.file'],
+        'auto_run_steps': {
+            'remove_all_meta_files': True,
+            'remove_files': True,
+        },
+    })
+    path_filter = CopySession(config).get_path_filter()
+    assert path_filter.is_excluded('sub/.DS_Store', 'file')
+    # files_to_remove are relative to the stick root
+    assert path_filter.is_excluded('example.file', 'file')
+    assert not path_filter.is_excluded('sub/example.file', 'file')
@@ -0,0 +1,72 @@
+# coding=utf-8
+
+"""Tests for the mount option handling of mountbackend."""
+
+import errno
+
+import mountbackend
+
+
+options = {
+    'noatime': True,
+    'nodev': True,
+    'uid': 1000,
+    'iocharset': 'utf8',
+    'flush': False,
+    'codepage': None,
+    'shortname': True,
+}
+
+
+def test_split_options():
+    flags, data = mountbackend.split_options(options)
+    assert flags == (
+        mountbackend.mount_flags['noatime'] |
+        mountbackend.mount_flags['nodev']
+    )
+    # sorted - generic flags are not in the data string
+    assert data == "iocharset=utf8,shortname,uid=1000"
+
+
+def test_unset_flags_are_left_out():
+    flags, data = mountbackend.split_options(
+        {'async': True, 'rw': True, 'noatime': True, 'flush': True}
+    )
+    assert flags == mountbackend.mount_flags['noatime']
+    assert data == "flush"
+
+
+def test_syncfs(tmp_path):
+    (tmp_path / "data").write_bytes(b"sun")
+    mountbackend.syncfs(str(tmp_path))
+
+
+def test_split_options_empty():
+    assert mountbackend.split_options({}) == (0, "")
+    assert mountbackend.split_options({'flush': False}) == (0, "")
+
+
+def test_format_options():
+    assert mountbackend.format_options(options) == (
+        "iocharset=utf8,noatime,nodev,shortname,uid=1000"
+    )
+    assert mountbackend.format_options({'codepage': None}) == ""
+
+
+def test_mount_error_text():
+    error = mountbackend.MountError(
+        'mount',
+        errno.EBUSY,
+        "/dev/sdb1",
+        "/mnt/2-1",
+        "noatime"
+    )
+    assert error.errno == errno.EBUSY
+    assert str(error) == (
+        "mount '/dev/sdb1' on '/mnt/2-1' (noatime) "
+        "failed: [Errno 16] Device or resource busy"
+    )
+    error = mountbackend.MountError('umount', errno.EINVAL, "/mnt", "/mnt")
+    assert str(error) == (
+        "umount '/mnt' failed: [Errno 22] Invalid argument"
+    )
@@ -0,0 +1,68 @@
+# coding=utf-8
+
+"""Tests for probe.py - the partition is a temp file."""
+
+import pytest
+
+import probe
+import progress
+
+
+sample_size = 64 * 1024
+
+
+def _create_file(path, size):
+    with open(path, 'wb') as f:
+        f.truncate(size)
+
+
+def test_sample_offsets():
+    size = 100 * 1024 * 1024
+    offsets = probe.get_sample_offsets(size, 16, sample_size)
+    assert offsets[0] == 0
+    assert offsets[-1] == size - sample_size
+    # every power of two up to the end
+    assert 64 * 1024 * 1024 in offsets
+    assert all(offset % 4096 == 0 for offset in offsets)
+    # sorted and never overlapping
+    for first, second in zip(offsets, offsets[1:]):
+        assert second >= first + sample_size
+
+
+def test_partition_smaller_than_sample():
+    with pytest.raises(probe.Error):
+        probe.get_sample_offsets(sample_size // 2, 16, sample_size)
+
+
+def test_probe_device(tmp_path):
+    node = str(tmp_path / "sdb1.img")
+    size = 8 * 1024 * 1024
+    _create_file(node, size)
+    probe_bytes = probe.get_probe_bytes(size, size // 2, 8, sample_size)
+    job_progress = progress.Progress(probe_bytes, 0)
+    result = probe.probe_device(
+        node,
+        size // 2,
+        8,
+        sample_size,
+        job_progress,
+        writeback_window=1024 * 1024
+    )
+    assert result.size == size
+    assert result.write_speed > 0
+    assert result.bad_offsets == []
+    assert job_progress.bytes_done == probe_bytes
+
+
+def test_overwritten_sample_is_found(tmp_path):
+    node = str(tmp_path / "sdb1.img")
+    _create_file(node, 1024 * 1024)
+    with open(node, 'r+b') as f:
+        # like a fake stick that wraps 4096 around to 0:
+        # the second sample overwrites the end of the first
+        bad_offsets = probe.check_samples(
+            f.fileno(),
+            [0, 4096],
+            8192
+        )
+    assert bad_offsets == [0]
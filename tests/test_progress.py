@@ -0,0 +1,92 @@
+# coding=utf-8
+
+"""Tests for the progress reports."""
+
+import threading
+
+import pytest
+
+import progress
+
+
+class FakeClock(object):
+    """Replacement for time.monotonic."""
+
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_rate_limited_reports(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(progress.time, 'monotonic', clock)
+    reports = []
+    job_progress = progress.Progress(1000, 4, reports.append, interval=1.0)
+    job_progress.add(100)
+    clock.now += 0.5
+    job_progress.add(100, files_done=1)
+    assert reports == []
+    clock.now += 0.5
+    job_progress.add(100)
+    assert len(reports) == 1
+    info = reports[0]
+    assert info.bytes_done == 300
+    assert info.files_done == 1
+    assert info.speed == 300.0
+    assert info.eta == 700 / 300.0
+
+
+def test_speed_is_smoothed(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(progress.time, 'monotonic', clock)
+    job_progress = progress.Progress(10000, 0, interval=1.0)
+    clock.now += 1
+    job_progress.add(1000)
+    assert job_progress.speed == 1000.0
+    clock.now += 1
+    job_progress.add(2000)
+    assert job_progress.speed == 1000.0 + 0.3 * (2000 - 1000)
+
+
+def test_finish_reports_mean_speed(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(progress.time, 'monotonic', clock)
+    reports = []
+    job_progress = progress.Progress(4000, 2, reports.append, interval=10)
+    job_progress.add(4000, files_done=2)
+    clock.now += 2
+    job_progress.finish()
+    info = reports[-1]
+    assert info.speed == 2000.0
+    assert info.eta == 0
+    assert progress.get_percent(info) == 100.0
+
+
+def test_format():
+    info = progress.ProgressInfo(
+        bytes_done=250 * 1000 * 1000,
+        bytes_total=1000 * 1000 * 1000,
+        files_done=3,
+        files_total=12,
+        speed=12.5 * 1000 * 1000,
+        eta=125,
+    )
+    assert progress.format_progress(info) == (
+        "25% 12.5MB/s 3/12 files eta 2:05"
+    )
+    assert progress.format_eta(info._replace(eta=None)) == "?"
+    # without bytes the files count
+    empty = info._replace(bytes_total=0, bytes_done=0)
+    assert progress.get_percent(empty) == 25.0
+
+
+def test_cancel_stops_add():
+    cancel_event = threading.Event()
+    job_progress = progress.Progress(1000, 1, cancel_event=cancel_event)
+    job_progress.add(100)
+    cancel_event.set()
+    with pytest.raises(progress.Cancelled):
+        job_progress.add(100)
+    assert job_progress.bytes_done == 100
@@ -0,0 +1,114 @@
+# coding=utf-8
+
+"""Tests for registry.CompletionRegistry and the registry keys."""
+
+import os
+
+import configdict
+import fatfs
+import manifest
+import registry
+from copysession import CopySession
+from usbstick import USBStick
+
+
+def test_registry_round_trip(tmp_path):
+    filename = str(tmp_path / "completed_sticks.sqlite")
+    identity = registry.get_identity("SERIAL", "1A2B-3C4D")
+    completion_registry = registry.CompletionRegistry(filename, "sig-a")
+    assert not completion_registry.is_done(identity)
+    completion_registry.add(identity, "SERIAL", "1A2B-3C4D", "2-1.1")
+    assert completion_registry.is_done(identity)
+    assert completion_registry.get_counts() == (1, 1)
+    completion_registry.close()
+
+    # next session
+    completion_registry = registry.CompletionRegistry(filename, "sig-a")
+    assert completion_registry.is_done(identity)
+    assert completion_registry.get_counts() == (1, 0)
+    completion_registry.close()
+
+    # other source
+    completion_registry = registry.CompletionRegistry(filename, "sig-b")
+    assert not completion_registry.is_done(identity)
+    completion_registry.close()
+
+
+def test_registry_needs_filesystem_uuid(tmp_path):
+    assert registry.get_identity("SERIAL", None) is None
+    completion_registry = registry.CompletionRegistry(
+        str(tmp_path / "completed_sticks.sqlite"),
+        "sig-a"
+    )
+    completion_registry.add(None)
+    assert not completion_registry.is_done(None)
+    assert completion_registry.get_counts() == (0, 0)
+    completion_registry.close()
+
+
+def test_content_signature_ignores_mtime(tmp_path):
+    path = tmp_path / "a.txt"
+    path.write_bytes(b'a')
+    digests = {'a.txt': 'digest-a'}
+    signature = manifest.SourceManifest(
+        str(tmp_path)
+    ).get_content_signature(digests)
+    # touched - same content
+    os.utime(str(path), (0, 0))
+    assert manifest.SourceManifest(
+        str(tmp_path)
+    ).get_content_signature(digests) == signature
+    # other content
+    assert manifest.SourceManifest(
+        str(tmp_path)
+    ).get_content_signature({'a.txt': 'digest-b'}) != signature
+
+
+def test_read_volume_id(tmp_path):
+    path = str(tmp_path / "stick.img")
+    with open(path, 'wb') as f:
+        f.truncate(64 * 1024 * 1024)
+    fatfs.format_fat32(path, "SUN")
+    volume_id = fatfs.read_volume_id(path)
+    assert volume_id is not None
+    fatfs.format_fat32(path, "SUN")
+    # every format gets a new volume id
+    assert fatfs.read_volume_id(path) != volume_id
+
+
+def _create_session(tmp_path, config=None):
+    src = tmp_path / "src"
+    src.mkdir(parents=True)
+    (src / "a.txt").write_bytes(b'a')
+    stick_config = {'source_folder': str(src)}
+    stick_config.update(config or {})
+    return CopySession(
+        configdict.merge_deep(USBStick.default_config, stick_config),
+        str(tmp_path)
+    )
+
+
+def test_registry_is_opt_in(tmp_path):
+    session = _create_session(tmp_path)
+    session.prepare()
+    assert session.get_registry() is None
+    assert not os.path.exists(str(tmp_path / "completed_sticks.sqlite"))
+
+
+def test_session_registry(tmp_path):
+    session = _create_session(
+        tmp_path,
+        {'registry_file': "completed_sticks.sqlite"}
+    )
+    completion_registry = session.get_registry()
+    identity = registry.get_identity("SERIAL", "1A2B-3C4D")
+    completion_registry.add(identity, "SERIAL", "1A2B-3C4D", "2-1.1")
+    completion_registry.close()
+    assert os.path.exists(str(tmp_path / "completed_sticks.sqlite"))
+    # the same source in the next session
+    completion_registry = _create_session(
+        tmp_path / "next",
+        {'registry_file': "../completed_sticks.sqlite"}
+    ).get_registry()
+    assert completion_registry.is_done(identity)
+    completion_registry.close()
@@ -0,0 +1,209 @@
+# coding=utf-8
+
+"""Tests for the schedulers with jobs that only record calls."""
+
+import scheduler
+
+
+class FakeJob(object):
+    """Job that is started but never runs."""
+
+    def __init__(self, name, start_log=None, port_id='2-1'):
+        self.name = name
+        self.start_log = start_log
+        self.port_id = port_id
+        self.started = False
+        self.messages = []
+        self.job_done_callback = None
+        self.write_started_callback = None
+        self.write_finished_callback = None
+
+    def get_usb_port_id(self):
+        return self.port_id
+
+    def show_port_message(self, message):
+        self.messages.append(message)
+
+    def start(self):
+        self.started = True
+        if self.start_log is not None:
+            self.start_log.append(self)
+
+    def finish(self):
+        self.job_done_callback(self)
+
+
+def test_limit_and_queue():
+    job_scheduler = scheduler.JobScheduler(max_jobs=2)
+    jobs = [FakeJob(index) for index in range(4)]
+    for job in jobs:
+        job_scheduler.submit(job)
+    assert [job.started for job in jobs] == [True, True, False, False]
+    assert jobs[2].messages == ['queued']
+    assert job_scheduler.get_waiting_count() == 2
+    jobs[0].finish()
+    assert [job.started for job in jobs] == [True, True, True, False]
+    jobs[1].finish()
+    jobs[2].finish()
+    assert jobs[3].started
+    assert job_scheduler.get_waiting_count() == 0
+
+
+def test_no_limit():
+    job_scheduler = scheduler.JobScheduler()
+    jobs = [FakeJob(index) for index in range(20)]
+    for job in jobs:
+        assert job_scheduler.submit(job)
+    assert all(job.started for job in jobs)
+
+
+def test_priority_ports_first():
+    job_scheduler = scheduler.JobScheduler(max_jobs=1, priority_order=[7, 3])
+    start_log = []
+    for port in (1, 3, 2, 7, 5):
+        job_scheduler.submit(FakeJob(port, start_log), port)
+    while len(start_log) < 5:
+        start_log[-1].finish()
+    # listed ports first - the others in insertion order
+    assert [job.name for job in start_log] == [1, 7, 3, 2, 5]
+
+
+def test_remove_and_clear():
+    job_scheduler = scheduler.JobScheduler(max_jobs=1)
+    jobs = [FakeJob(index) for index in range(3)]
+    for job in jobs:
+        job_scheduler.submit(job)
+    assert job_scheduler.remove(jobs[1])
+    # a running job is not in the queue
+    assert not job_scheduler.remove(jobs[0])
+    jobs[0].finish()
+    assert not jobs[1].started
+    assert jobs[2].started
+    job_scheduler.submit(FakeJob('next'))
+    job_scheduler.clear()
+    assert job_scheduler.get_waiting_count() == 0
+
+
+class FakeClock(object):
+    """time.monotonic replacement that only moves on request."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def _measure(stats, clock, writers, bytes_each):
+    # writers copy at the same time for one second
+    markers = [stats.writer_started() for index in range(writers)]
+    clock.now += 1.0
+    for marker in markers:
+        stats.writer_finished(marker, bytes_each)
+
+
+def test_hub_ids():
+    assert scheduler.get_hub_ids('2-1.2.2.4') == [
+        'usb2', '2-1', '2-1.2', '2-1.2.2'
+    ]
+    assert scheduler.get_hub_ids('3-4') == ['usb3']
+
+
+def test_hub_limit():
+    job_scheduler = scheduler.TopologyScheduler(hub_limits={'2-1.1': 1})
+    start_log = []
+    first = FakeJob('first', start_log, '2-1.1.1')
+    same_hub = FakeJob('same hub', start_log, '2-1.1.2')
+    other_hub = FakeJob('other hub', start_log, '2-1.2.1')
+    for job in (first, same_hub, other_hub):
+        job_scheduler.submit(job)
+    # the waiting stick does not block the stick on the other hub
+    assert start_log == [first, other_hub]
+    assert same_hub.messages == ['queued']
+    first.finish()
+    assert start_log == [first, other_hub, same_hub]
+
+
+def test_bus_limit_and_default():
+    job_scheduler = scheduler.TopologyScheduler(
+        bus_limits={'default': 1, 'usb3': 0}
+    )
+    jobs = [
+        FakeJob(port_id, port_id=port_id)
+        for port_id in ('2-1.1', '2-1.2', '3-1', '3-2')
+    ]
+    for job in jobs:
+        job_scheduler.submit(job)
+    assert [job.started for job in jobs] == [True, False, True, True]
+    jobs[0].finish()
+    assert jobs[1].started
+
+
+def test_hub_stats_learn(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(scheduler.time, 'monotonic', clock)
+    stats = scheduler.HubStats('2-1')
+    mb = 1000 * 1000
+    for index in range(stats.samples_min):
+        _measure(stats, clock, 1, 10 * mb)
+    # one trusted level is not enough
+    assert stats.learned_limit == 0
+    for index in range(stats.samples_min):
+        _measure(stats, clock, 2, 10 * mb)
+        _measure(stats, clock, 3, 7 * mb)
+    # 3 writers do not get more than 2 - the hub is saturated
+    assert stats.learned_limit == 2
+    assert stats.get_ceiling() == 21 * mb
+
+
+def test_hub_stats_probe_next_level(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(scheduler.time, 'monotonic', clock)
+    stats = scheduler.HubStats('2-1')
+    for index in range(stats.samples_min):
+        _measure(stats, clock, 1, 10)
+        _measure(stats, clock, 2, 10)
+    # still scaling - the next writer count gets measured
+    assert stats.learned_limit == 3
+
+
+def test_hub_stats_forget_old_samples(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(scheduler.time, 'monotonic', clock)
+    stats = scheduler.HubStats('2-1')
+    for index in range(stats.samples_min):
+        _measure(stats, clock, 1, 10)
+        _measure(stats, clock, 2, 5)
+    assert stats.learned_limit == 1
+    for index in range(stats.sample_age_max):
+        _measure(stats, clock, 1, 10)
+    # only one writer count left - the configured limits apply again
+    assert list(stats.throughput) == [1]
+    assert stats.learned_limit == 0
+
+
+def test_only_write_step_is_measured(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(scheduler.time, 'monotonic', clock)
+    job_scheduler = scheduler.TopologyScheduler(learn_limits=True)
+    job = FakeJob('job', port_id='2-1.1')
+    job_scheduler.submit(job)
+    # format / mount
+    clock.now += 100.0
+    job.write_started_callback(job)
+    clock.now += 1.0
+    job.write_finished_callback(job, 1000)
+    job.finish()
+    stats = job_scheduler.get_stats('2-1')
+    assert stats.throughput == {1: [(1, 1000.0)]}
+    assert stats.active == 0
+    assert stats.writing == 0
+
+    # pulled while writing - not measured
+    job = FakeJob('pulled', port_id='2-1.1')
+    job_scheduler.submit(job)
+    job.write_started_callback(job)
+    clock.now += 1.0
+    job.finish()
+    assert stats.sample_number == 1
+    assert stats.writing == 0
@@ -0,0 +1,96 @@
+# coding=utf-8
+
+"""Tests for the sync mode - a temp folder plays the mounted stick."""
+
+import os
+import shutil
+
+import devicesource
+import usbstick
+from copysession import CopySession
+
+
+def _write(path, data, mtime):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+    os.utime(path, (mtime, mtime))
+
+
+def _create_stick(tmp_path, sync_compare):
+    src = str(tmp_path / "src")
+    _write(os.path.join(src, 'same.txt'), b'same', 1000000)
+    _write(os.path.join(src, 'sub', 'newer.txt'), b'new!', 2000000)
+    _write(os.path.join(src, 'sub', 'content.txt'), b'new!', 1000000)
+    _write(os.path.join(src, 'added.txt'), b'added', 1000000)
+    dst = str(tmp_path / "stick")
+    _write(os.path.join(dst, 'same.txt'), b'same', 1000000)
+    _write(os.path.join(dst, 'sub', 'newer.txt'), b'old!', 1000000)
+    _write(os.path.join(dst, 'sub', 'content.txt'), b'old!', 1000000)
+    _write(os.path.join(dst, 'stale.txt'), b'stale', 1000000)
+    _write(os.path.join(dst, 'stale', 'deeper', 'x'), b'x', 1000000)
+    _write(
+        os.path.join(dst, 'System Volume Information', 'IndexerVolumeGuid'),
+        b'keep',
+        1000000
+    )
+    config = {
+        'source_folder': src,
+        'copy_mode': 'sync',
+        'sync_compare': sync_compare,
+        'copy_engine': 'single',
+    }
+    device_source = devicesource.FakeDeviceSource()
+    device = devicesource.create_fake_partition('2-1.1', 'sdb')
+    device_source.add_device(device)
+    stick = usbstick.USBStick(
+        device.device_path,
+        config,
+        device_source=device_source
+    )
+    stick.session = CopySession(stick.config, str(tmp_path))
+    stick.mount_point = dst
+    return stick, src, dst
+
+
+def _read_tree(folder):
+    tree = {}
+    for root, dirs, files in os.walk(folder):
+        for name in dirs + files:
+            path = os.path.join(root, name)
+            if os.path.isdir(path):
+                tree[os.path.relpath(path, folder)] = 'dir'
+            else:
+                with open(path, 'rb') as f:
+                    tree[os.path.relpath(path, folder)] = f.read()
+    return tree
+
+
+def test_sync_by_mtime(tmp_path):
+    stick, src, dst = _create_stick(tmp_path, 'mtime')
+    stick.sync_files_to_me()
+    expected = _read_tree(src)
+    # same size and time - not compared by content
+    expected['sub/content.txt'] = b'old!'
+    expected['System Volume Information'] = 'dir'
+    expected['System Volume Information/IndexerVolumeGuid'] = b'keep'
+    assert _read_tree(dst) == expected
+    # only the new and the changed file
+    assert stick.bytes_written == len(b'new!') + len(b'added')
+
+
+def test_sync_by_hash(tmp_path):
+    stick, src, dst = _create_stick(tmp_path, 'hash')
+    stick.sync_files_to_me()
+    tree = _read_tree(dst)
+    del tree['System Volume Information']
+    del tree['System Volume Information/IndexerVolumeGuid']
+    assert tree == _read_tree(src)
+    assert stick.bytes_written == 2 * len(b'new!') + len(b'added')
+
+
+def test_sync_needs_mounted_stick(tmp_path):
+    stick, src, dst = _create_stick(tmp_path, 'mtime')
+    shutil.rmtree(dst)
+    stick.sync_files_to_me()
+    assert stick.bytes_written == 0
@@ -0,0 +1,262 @@
+# coding=utf-8
+
+"""
+Tests for the step handling and the capacity checks of USBStick.
+
+no hardware needed - sparse temp files are the partitions.
+"""
+
+import os
+import subprocess
+
+import pytest
+
+import devicesource
+import fatfs
+import mountbackend
+import probe
+import progress
+import usbstick
+import writeback
+
+
+stick_size = 64 * 1024 * 1024
+
+
+def _create_file(path, size):
+    with open(path, 'wb') as f:
+        f.truncate(size)
+
+
+def _create_stick(tmp_path, config=None):
+    device_source = devicesource.FakeDeviceSource()
+    device = devicesource.create_fake_partition('2-1.1', 'sdb')
+    device_source.add_device(device)
+    stick_config = {
+        'source_folder': str(tmp_path),
+        'copy_engine': 'single',
+    }
+    stick_config.update(config or {})
+    return usbstick.USBStick(
+        device.device_path,
+        stick_config,
+        device_source=device_source
+    )
+
+
+def test_steps_are_timed(tmp_path):
+    stick = _create_stick(tmp_path)
+    stick._start_step("start")
+    stick._start_step("fat32")
+    stick._begin_step("flush")
+    stick._end_step()
+    assert sorted(stick.step_times) == ['fat32', 'flush', 'start']
+    assert all(duration >= 0 for duration in stick.step_times.values())
+    assert stick.step_name is None
+
+
+def test_only_write_steps_call_back(tmp_path):
+    stick = _create_stick(tmp_path)
+    calls = []
+    stick.write_started_callback = lambda job: calls.append('started')
+    stick.write_finished_callback = (
+        lambda job, bytes_written: calls.append(bytes_written)
+    )
+    stick._start_step("fat32")
+    stick.bytes_written += 100
+    stick._start_step("copy")
+    stick.bytes_written += 4000
+    stick._start_step("verify")
+    stick.bytes_written += 7
+    stick._end_step()
+    # only the bytes of the copy step count
+    assert calls == ['started', 4000]
+
+
+def test_cancelled_step(tmp_path):
+    stick = _create_stick(tmp_path)
+    messages = []
+    stick.show_port_message = messages.append
+    stick._start_step("copy")
+    stick.cancel()
+    with pytest.raises(progress.Cancelled):
+        stick._start_step("verify")
+    assert messages == ["copy"]
+
+
+def _create_partition_stick(tmp_path, source_size, config=None):
+    src = tmp_path / "src"
+    src.mkdir()
+    # sparse - only the size is read
+    _create_file(str(src / "data.bin"), source_size)
+    stick_config = {'source_folder': str(src)}
+    stick_config.update(config or {})
+    stick = _create_stick(tmp_path, stick_config)
+    stick.node = str(tmp_path / "sdb1.img")
+    _create_file(stick.node, stick_size)
+    return stick
+
+
+def test_partition_capacity(tmp_path):
+    stick = _create_partition_stick(tmp_path, stick_size // 2)
+    assert stick.check_partition_capacity()
+
+
+def test_partition_too_small(tmp_path):
+    stick = _create_partition_stick(tmp_path, stick_size)
+    assert not stick.check_partition_capacity()
+
+
+def test_image_larger_than_partition(tmp_path):
+    stick = _create_partition_stick(tmp_path, 1024, {
+        'copy_mode': 'image',
+        'image_size': 2 * stick_size // (1024 * 1024),
+    })
+    assert not stick.check_partition_capacity()
+
+
+def test_image_too_small_for_source(tmp_path):
+    stick = _create_partition_stick(tmp_path, 40 * 1024 * 1024, {
+        'copy_mode': 'image',
+        'image_size': 36,
+    })
+    assert not stick.check_partition_capacity()
+
+
+def test_formatted_capacity(tmp_path, monkeypatch):
+    stick = _create_partition_stick(tmp_path, 1024, {
+        'format_backend': 'mkfs.fat',
+    })
+    # mkfs.fat picked another cluster size than the builtin format
+    fatfs.format_fat32(stick.node, "STICK", 512)
+    cluster_sizes = []
+    monkeypatch.setattr(
+        stick.session,
+        'get_required_size',
+        lambda cluster_size: cluster_sizes.append(cluster_size) or 0
+    )
+    assert stick.check_partition_capacity()
+    assert cluster_sizes == [512]
+
+
+def test_formatted_too_small(tmp_path):
+    stick = _create_partition_stick(tmp_path, stick_size, {
+        'format_backend': 'mkfs.fat',
+    })
+    fatfs.format_fat32(stick.node, "STICK", 512)
+    assert not stick.check_partition_capacity()
+
+
+def test_mounted_capacity(tmp_path, monkeypatch):
+    stick = _create_partition_stick(tmp_path, 1024)
+    stick.mount_point = str(tmp_path)
+    assert stick.check_mounted_capacity()
+    st = os.statvfs(str(tmp_path))
+    monkeypatch.setattr(
+        stick.session,
+        'get_required_size',
+        lambda cluster_size: st.f_blocks * st.f_frsize + 1
+    )
+    assert not stick.check_mounted_capacity()
+
+
+@pytest.mark.parametrize('result, message, accepted', [
+    (probe.ProbeResult(stick_size, 20e6, []), "probe 20.0MB/s", True),
+    (probe.ProbeResult(stick_size, 20e6, [4096]), "fake!", False),
+    (probe.ProbeResult(stick_size, 2e6, []), "slow 2.0MB/s", False),
+])
+def test_probe_rejects_sticks(tmp_path, result, message, accepted):
+    stick = _create_stick(tmp_path, {'probe_min_speed': 5})
+    messages = []
+    stick.show_port_message = messages.append
+    stick.probe_me = lambda: result
+    assert stick._run_probe() == accepted
+    assert messages[-1] == message
+
+
+@pytest.mark.parametrize('content_written, verify, verified, completed', [
+    (False, False, False, False),
+    (True, False, False, True),
+    (True, True, False, False),
+    (True, True, True, True),
+])
+def test_only_written_sticks_are_completed(
+    tmp_path,
+    content_written,
+    verify,
+    verified,
+    completed
+):
+    stick = _create_stick(tmp_path, {
+        'auto_run_steps': {'verify_files': verify},
+    })
+    stick.content_written = content_written
+    stick.verified = verified
+    assert stick._is_completed() == completed
+    stick.result_message = "verify!"
+    assert not stick._is_completed()
+
+
+def test_every_job_gets_own_mount_point(tmp_path):
+    config = {'mount_base': str(tmp_path / "mnt")}
+    # the same stick re-plugged in the same port
+    first = _create_stick(tmp_path, config)
+    second = _create_stick(tmp_path, config)
+    first._create_mount_point()
+    second._create_mount_point()
+    assert first.mount_point != second.mount_point
+    assert os.path.isdir(first.mount_point)
+    second._remove_mount_point()
+    # the mount point of the first job is not touched
+    assert os.path.isdir(first.mount_point)
+
+
+@pytest.mark.parametrize('cancelled', [False, True])
+def test_writeback_limits_are_restored(tmp_path, monkeypatch, cancelled):
+    bdi_path = tmp_path / "bdi"
+    bdi_path.mkdir()
+    (bdi_path / "max_bytes").write_text("1073741824\n")
+    (bdi_path / "max_ratio").write_text("100\n")
+    (bdi_path / "strict_limit").write_text("0\n")
+    monkeypatch.setattr(
+        writeback,
+        'get_bdi_path',
+        lambda node: str(bdi_path)
+    )
+    stick = _create_stick(tmp_path, {
+        'writeback_max_bytes': 64 * 1024 * 1024,
+        'writeback_strict_limit': True,
+    })
+    stick.limit_writeback()
+    assert (bdi_path / "strict_limit").read_text() == "1\n"
+    if cancelled:
+        stick.cancel()
+    stick.restore_writeback()
+    # a pulled stick is not touched - the device may be another one
+    assert (bdi_path / "strict_limit").read_text() == (
+        "1\n" if cancelled else "0\n"
+    )
+
+
+def _fail_command(command):
+    raise subprocess.CalledProcessError(32, command)
+
+
+def test_mount_command_raises_mount_error(tmp_path):
+    stick = _create_stick(tmp_path, {
+        'mount_backend': 'command',
+        'mount_base': str(tmp_path / "mnt"),
+        'mount_options': {'noatime': True},
+    })
+    stick.command_runner = _fail_command
+    with pytest.raises(mountbackend.MountError) as info:
+        stick.mount()
+    assert info.value.operation == 'mount'
+    assert info.value.source == stick.node
+    assert info.value.target == stick.mount_point
+    assert info.value.options == "noatime"
+    with pytest.raises(mountbackend.MountError) as info:
+        stick.unmount()
+    assert info.value.operation == 'umount'
+    # the mount point is still in use
+    assert os.path.isdir(stick.mount_point)
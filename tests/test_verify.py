@@ -0,0 +1,62 @@
+# coding=utf-8
+
+"""Tests for verify - a temp folder plays the mounted stick."""
+
+import os
+import shutil
+
+import verify
+import manifest
+
+
+def _create_source(src):
+    content = {
+        'a.txt': b'hello',
+        'sub/b.bin': os.urandom(100000),
+        'sub/c.bin': os.urandom(1000),
+    }
+    for name, data in content.items():
+        path = os.path.join(src, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+    return content
+
+
+def test_verify_files(tmp_path):
+    src = str(tmp_path / "src")
+    _create_source(src)
+    source_manifest = manifest.SourceManifest(src)
+    digests = {
+        entry.name: verify.hash_file(source_manifest.get_src_path(entry))
+        for entry in source_manifest.files
+    }
+    dst = str(tmp_path / "stick")
+    shutil.copytree(src, dst)
+    assert verify.verify_files(source_manifest, digests, dst) == []
+    # O_DIRECT falls back if the filesystem does not support it
+    assert verify.verify_files(
+        source_manifest, digests, dst, direct=True
+    ) == []
+
+    with open(os.path.join(dst, 'sub', 'b.bin'), 'r+b') as f:
+        f.write(b'broken')
+    os.remove(os.path.join(dst, 'a.txt'))
+    with open(os.path.join(dst, 'sub', 'c.bin'), 'ab') as f:
+        f.write(b'more')
+    mismatches = dict(verify.verify_files(source_manifest, digests, dst))
+    assert sorted(mismatches) == [
+        os.path.join(dst, name) for name in ('a.txt', 'sub/b.bin', 'sub/c.bin')
+    ]
+    assert mismatches[os.path.join(dst, 'sub/b.bin')] == "content differs"
+    assert mismatches[os.path.join(dst, 'sub/c.bin')] == "size 1004 != 1000"
+
+
+def test_hash_file_uncached(tmp_path):
+    path = str(tmp_path / "file")
+    with open(path, 'wb') as f:
+        f.write(os.urandom(10000))
+    for direct in (False, True):
+        assert verify.hash_file_uncached(path, 'md5', direct) == (
+            verify.hash_file(path, 'md5')
+        )
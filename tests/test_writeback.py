@@ -0,0 +1,194 @@
+# coding=utf-8
+
+"""
+Tests for writeback.WritebackWindow and the backing device limits.
+
+the windows are written to temp files -
+the sysfs backing device is a temp folder.
+"""
+
+import os
+import threading
+
+import pytest
+
+import progress
+import writeback
+
+
+window_size = 64 * 1024
+
+
+def _write(fd, window, size, chunk_size=16 * 1024):
+    data = os.urandom(chunk_size)
+    for offset in range(0, size, chunk_size):
+        os.write(fd, data)
+        window.add(chunk_size)
+
+
+def _open(path):
+    return os.open(str(path), os.O_WRONLY | os.O_CREAT)
+
+
+def _record_calls(monkeypatch):
+    calls = []
+    monkeypatch.setattr(
+        writeback,
+        'sync_file_range',
+        lambda fd, offset, size, flags: calls.append(
+            ('sync', offset, size, flags)
+        )
+    )
+    monkeypatch.setattr(
+        writeback,
+        'drop_cache',
+        lambda fd, offset, size: calls.append(('drop', offset, size))
+    )
+    return calls
+
+
+def test_window_off_passes_bytes(tmp_path):
+    job_progress = progress.Progress(100, 1)
+    fd = _open(tmp_path / "file")
+    try:
+        window = writeback.WritebackWindow(0, job_progress)
+        window.open_file(fd)
+        window.add(60)
+        assert job_progress.bytes_done == 60
+        window.close_file()
+        window.finish()
+        assert job_progress.bytes_done == 60
+    finally:
+        os.close(fd)
+
+
+def test_window_reports_written_windows(tmp_path):
+    job_progress = progress.Progress(4 * window_size, 1)
+    fd = _open(tmp_path / "file")
+    try:
+        window = writeback.WritebackWindow(window_size, job_progress)
+        window.open_file(fd)
+        _write(fd, window, window_size)
+        # the first window is on the way - not yet counted
+        assert job_progress.bytes_done == 0
+        _write(fd, window, window_size + 16 * 1024)
+        # the first window had to be written before the second started
+        assert job_progress.bytes_done == window_size
+        window.close_file()
+        # the second window is on the stick - the end is only started
+        assert job_progress.bytes_done == 2 * window_size
+        window.finish()
+        assert job_progress.bytes_done == 2 * window_size + 16 * 1024
+    finally:
+        window.close()
+        os.close(fd)
+    assert os.path.getsize(str(tmp_path / "file")) == (
+        2 * window_size + 16 * 1024
+    )
+
+
+def test_tail_is_waited_and_dropped(tmp_path, monkeypatch):
+    calls = _record_calls(monkeypatch)
+    job_progress = progress.Progress(4 * window_size, 2)
+    window = writeback.WritebackWindow(window_size, job_progress)
+    first = _open(tmp_path / "first")
+    window.open_file(first)
+    _write(first, window, 16 * 1024)
+    window.close_file()
+    # the file can be closed while its end is on the way
+    os.close(first)
+    assert job_progress.bytes_done == 0
+    second = _open(tmp_path / "second")
+    try:
+        window.open_file(second)
+        _write(second, window, window_size)
+        # the end of the first file is on the stick now
+        assert job_progress.bytes_done == 16 * 1024
+        window.close_file()
+        window.finish()
+    finally:
+        window.close()
+        os.close(second)
+    assert job_progress.bytes_done == window_size + 16 * 1024
+    # every started range is waited for and dropped from the cache
+    started = [
+        call[1:3]
+        for call in calls
+        if call[0] == 'sync' and call[3] == writeback.SYNC_FILE_RANGE_WRITE
+    ]
+    waited = [
+        call[1:3]
+        for call in calls
+        if call[0] == 'sync' and call[3] == writeback.SYNC_FILE_RANGE_WAIT
+    ]
+    dropped = [call[1:3] for call in calls if call[0] == 'drop']
+    assert started == [(0, 16 * 1024), (0, window_size)]
+    assert waited == started
+    assert dropped == started
+
+
+def test_window_checks_cancel(tmp_path):
+    cancel_event = threading.Event()
+    cancel_event.set()
+    job_progress = progress.Progress(
+        4 * window_size,
+        1,
+        cancel_event=cancel_event
+    )
+    fd = _open(tmp_path / "file")
+    window = writeback.WritebackWindow(window_size, job_progress)
+    try:
+        window.open_file(fd)
+        with pytest.raises(progress.Cancelled):
+            _write(fd, window, window_size)
+    finally:
+        window.close()
+        os.close(fd)
+    # the window on the way is forgotten
+    assert window.previous is None
+
+
+def _create_bdi(tmp_path, monkeypatch):
+    bdi_path = tmp_path / "bdi"
+    bdi_path.mkdir()
+    # kernel defaults
+    (bdi_path / "max_bytes").write_text("1073741824\n")
+    (bdi_path / "max_ratio").write_text("100\n")
+    (bdi_path / "strict_limit").write_text("0\n")
+    monkeypatch.setattr(
+        writeback,
+        'get_bdi_path',
+        lambda node: str(bdi_path)
+    )
+    return bdi_path
+
+
+def test_limit_device(tmp_path, monkeypatch):
+    bdi_path = _create_bdi(tmp_path, monkeypatch)
+    previous = writeback.limit_device("/dev/sdb1", 64 * 1024 * 1024, 0, True)
+    assert (bdi_path / "max_bytes").read_text() == "67108864\n"
+    assert (bdi_path / "strict_limit").read_text() == "1\n"
+    # the kernel stores max_bytes as ratio
+    (bdi_path / "max_ratio").write_text("6\n")
+    writeback.restore_device(previous)
+    assert (bdi_path / "max_ratio").read_text() == "100\n"
+    assert (bdi_path / "strict_limit").read_text() == "0\n"
+
+
+def test_limit_device_without_limits(tmp_path, monkeypatch):
+    bdi_path = _create_bdi(tmp_path, monkeypatch)
+    assert writeback.limit_device("/dev/sdb1", 0, 0, True) == []
+    assert (bdi_path / "strict_limit").read_text() == "0\n"
+
+
+def test_limit_device_error(tmp_path, monkeypatch):
+    bdi_path = _create_bdi(tmp_path, monkeypatch)
+    (bdi_path / "max_ratio").write_text("20\n")
+    # max_bytes can not be written
+    (bdi_path / "max_bytes").unlink()
+    (bdi_path / "max_bytes").mkdir()
+    with pytest.raises(writeback.Error):
+        writeback.limit_device("/dev/sdb1", 64 * 1024 * 1024, 10, True)
+    # nothing is left changed
+    assert (bdi_path / "max_ratio").read_text() == "20\n"
+    assert (bdi_path / "strict_limit").read_text() == "0\n"
@@ -5,7 +5,7 @@
 USB-Stick.
 
 abstraction class for USB-Sticks handling.
-needs a pyudev Device Class object as input.
+needs a device path and a device source (devicesource.py) as input.
 this could eventually be used for fixing the label-permission problem:
 https://unix.stackexchange.com/questions/229987/udev-rule-to-match-any-usb-storage-device
 and hopefully someone posts a real solution:
@@ -19,14 +19,27 @@ http://pyudev.readthedocs.io/en/latest/guide.html
 """
 
 import os
-import shutil
+import time
+import errno
+import itertools
 import subprocess
 import threading
 # import readline
 
-import pyudev
-
 import configdict
+import devicesource
+import fatimage
+import broadcast
+import manifest
+import verify
+import progress
+import mountbackend
+import fatfs
+import fatwriter
+import writeback
+import probe
+import registry
+from copysession import CopySession
 
 
 class Error(Exception):
@@ -40,31 +53,152 @@ class USBStick(threading.Thread):
 
     default_config = {
         'source_folder': "~/StickDataToCopy/",
+        # glob rules for the paths in source_folder (see manifest.PathFilter)
+        # - checked once while scanning, excluded files are never copied.
+        # empty include means everything
+        'source_include': [],
+        'source_exclude': [],
         'mount_base': "~/ustick_copy/",
+        # 'syscall' mounts in-process with mount(2) / umount2(2)
+        # (falls back to 'command' if not available)
+        # 'command' runs the mount / umount binaries
+        'mount_backend': 'syscall',
+        'mount_fstype': 'vfat',
+        # FAT mount options - False / None means kernel default
+        # for example uid / gid, codepage / iocharset, flush
+        # for example async, noatime - or sync to write through
+        'mount_options': {
+            'noatime': True,
+            'uid': None,
+            'gid': None,
+            'flush': False,
+            'codepage': None,
+            'iocharset': None,
+        },
+        # write all cached data with syncfs before the unmount -
+        # so the flush time is measured on its own (step 'flush').
+        'flush_before_unmount': True,
+        # bytes of every written file that may wait for the stick -
+        # the copy waits for the window before and drops it from
+        # the page cache. progress counts what is on the stick.
+        # 0 leaves the writeback to the kernel
+        'writeback_window': 8*1024*1024,
+        # dirty page limit of the stick in bytes (sysfs bdi max_bytes)
+        # 0 leaves the kernel default
+        'writeback_max_bytes': 64*1024*1024,
+        # dirty page limit in percent of the global limit (bdi max_ratio)
+        # 0 leaves the kernel default
+        'writeback_max_ratio': 0,
+        # apply the limits even if the host has only a few dirty pages
+        'writeback_strict_limit': True,
         'disc_label': "SUN",
+        # 'builtin' patches the label in-process (fatfs.py)
+        # 'fatlabel' runs the fatlabel binary
+        'label_backend': 'builtin',
+        # 'builtin' quick formats in-process (fatfs.py) with the data
+        # region aligned to the flash erase blocks
+        # 'mkfs.fat' runs the mkfs.fat binary
+        'format_backend': 'builtin',
+        # bytes - 0 means automatic (largest allowed up to 32KiB)
+        'format_cluster_size': 0,
+        # bytes - 0 means from the sysfs hints (at least 4MiB)
+        'format_alignment': 0,
+        # 'files' copies file by file onto the mounted stick
+        # 'image' clones one prebuilt FAT32 image onto the partition
+        # 'raw' writes a new FAT32 filesystem with all files directly
+        # onto the partition - no mount (format and label are implied)
+        # 'sync' only writes new / changed files and deletes files
+        # that are not in source_folder anymore (format is skipped)
+        'copy_mode': 'files',
+        # 'sync' compares by 'mtime' (size and modification time)
+        # or by 'hash' (size and content)
+        'sync_compare': 'mtime',
+        # FAT stores modification times with 2 seconds resolution
+        'sync_mtime_tolerance': 2,
+        # entries in the stick root that sync never deletes
+        'sync_keep': [
+            'System Volume Information'
+        ],
+        'image_file': "~/ustick_copy_image.img",
+        # image (volume) size in MiB - 0 means the partition size
+        'image_size': 0,
+        # 'broadcast' reads every source file once for all sticks
+        # 'single' lets every stick read the source on its own
+        'copy_engine': 'broadcast',
+        'broadcast_chunk_size': 1024*1024,
+        'broadcast_buffer_count': 64,
+        # how the 'single' engine copies one file:
+        # 'copy2' (old behavior), 'buffered' or 'zerocopy'
+        # (copy_file_range / sendfile with buffered fallback)
+        'copy_backend': 'zerocopy',
+        'copy_buffer_size': 4*1024*1024,
+        # allocate the FAT clusters of every file in one run
+        'copy_preallocate': True,
+        # folder for the copy journals (relative to the config file).
+        # a stick that was not completed goes on where it stopped.
+        # "" disables the journal
+        'journal_folder': "copy_journal",
         'files_to_remove': [
             'example.file'
         ],
         'auto_run_steps': {
+            # write test before everything else - destroys the data.
+            # only runs if the stick is formatted / overwritten anyway
+            'probe': False,
             'format_as_fat32': False,
             'update_label': False,
             'copy_files_to_me': False,
             'remove_all_meta_files': False,
             'remove_files': False,
+            'verify_files': False,
         },
+        # sticks that write slower than this (MB/s) are rejected
+        'probe_min_speed': 5,
+        # bytes written to measure the write speed
+        'probe_size': 256*1024*1024,
+        # regions spread over the stick that are written and read back
+        'probe_sample_count': 16,
+        'probe_sample_size': 1024*1024,
+        # digest used to compare the source files with the read back files
+        'verify_algorithm': 'sha256',
+        # read back with O_DIRECT instead of dropping the page cache
+        'verify_direct': False,
+        # minimal seconds between two progress reports of one stick
+        'progress_interval': 0.25,
+        # source digests are cached in this file next to the config file
+        'hash_cache_file': "source_hashes.json",
+        # parallel hash threads - 0 means one per cpu
+        'hash_threads': 0,
+        # completed sticks are remembered in this sqlite file next to
+        # the config file - a re-plugged stick is shown as done (cached)
+        # without a look at its content. "" disables the registry
+        'registry_file': "",
     }
 
-    def __init__(self, device_path, config, queue=None):
+    # numbers the jobs of this process - every job gets its own
+    # mount point, so a cancelled job that still cleans up can not
+    # touch the mount of a re-plugged stick in the same port.
+    job_counter = itertools.count(1)
+    # steps that write the content - the scheduler measures their speed
+    write_steps = ('copy', 'sync', 'clone', 'raw')
+
+    def __init__(
+        self,
+        device_path,
+        config,
+        queue=None,
+        session=None,
+        device_source=None
+    ):
         """Create new USBStick Object."""
         # threading.Thread.__init__(self)
         super(USBStick, self).__init__()
         self.queue = queue
 
-        self.udev_context = pyudev.Context()
-        device = pyudev.Devices.from_path(
-            self.udev_context,
-            device_path
-        )
+        if device_source is None:
+            device_source = devicesource.UdevDeviceSource()
+        self.device_source = device_source
+        device = self.device_source.get_device(device_path)
         self.device = device
         self.path = self.device.device_path
         # device_path: /sys/devices/pci0000:00/0000:00:1d.0/usb2/
@@ -72,9 +206,41 @@ class USBStick(threading.Thread):
         # host7/target7:0:0/7:0:0:0/block/sdc/sdc1
         self.node = self.device.device_node
         # device_node: /dev/sdc1
-        self.label = self.device['ID_FS_LABEL']
+        self.label = self.device.properties.get('ID_FS_LABEL')
         self.mount_point = None
+        self.job_number = next(self.job_counter)
+        self.job_done_callback = None
+        # function(job) / function(job, bytes_written) around the
+        # write steps - set by the scheduler
+        self.write_started_callback = None
+        self.write_finished_callback = None
+        self.bytes_written = 0
+        self.step_bytes_start = 0
+        # set when copy, sync, clone or raw write completed -
+        # only then the stick is registered as completed.
+        self.content_written = False
+        # set when verify_files_on_me found no mismatch
+        self.verified = False
+        self.progress = None
+        # final port message - steps can replace it with an error status
+        self.result_message = "done"
+        # set when the stick is pulled - the job stops at the next chunk
+        self.cancel_event = threading.Event()
+        # seconds per step - like {'copy': 12.1, 'flush': 3.4}
+        self.step_times = {}
+        self.step_name = None
+        self.step_time_start = None
+        # function(command) -> output bytes used instead of subprocess
+        # raises subprocess.CalledProcessError like check_output.
+        self.command_runner = None
+        # journal.CopyJournal of the files copy (or None)
+        self.journal = None
+        # dirty page limits from before the job (writeback.limit_device)
+        self.writeback_limits = None
         self.config = configdict.merge_deep(self.default_config, config)
+        if session is None:
+            session = CopySession(self.config)
+        self.session = session
 
         self.usb_port_path = self.get_usb_port_path()
         self.usb_port_name = self.get_usb_port_name()
@@ -120,13 +286,19 @@ class USBStick(threading.Thread):
             tree = new_level
         return tree
 
+    def _run_command(self, command):
+        """Run shell command and return its output."""
+        if self.command_runner:
+            return self.command_runner(command)
+        return subprocess.check_output(command)
+
     # mount
     def _create_mount_point(self):
         """Create mount point for this Stick."""
         # print("create mount point:")
         rel_mount_point = os.path.join(
             self.config['mount_base'],
-            self.get_usb_port_name()
+            "{}_{}".format(self.get_usb_port_name(), self.job_number)
         )
         abs_mount_point = os.path.expanduser(rel_mount_point)
         self.mount_point = abs_mount_point
@@ -145,31 +317,70 @@ class USBStick(threading.Thread):
             os.rmdir(self.mount_point)
             self.mount_point = None
 
+    def _use_mount_syscall(self):
+        return (
+            self.config['mount_backend'] == 'syscall' and
+            mountbackend.is_available()
+        )
+
     def mount(self):
-        """Mount this Stick."""
+        """
+        Mount this Stick.
+
+        errors are raised as mountbackend.MountError -
+        also with the mount command.
+        """
         self._create_mount_point()
+        if self.mount_point and self._use_mount_syscall():
+            mountbackend.mount(
+                self.node,
+                self.mount_point,
+                self.config['mount_fstype'],
+                self.config['mount_options']
+            )
+            return ""
         if self.mount_point:
             # mount
             #   --source /dev/sdc1
             #   --target /home/stefan/ustick_copy/2-1_2_2_4
+            #   --types vfat
+            #   --options noatime
             # mount needs root / sudo
             command = [
                 "mount",
                 "--source={}".format(self.node),
                 "--target={}".format(self.mount_point),
+                "--types={}".format(self.config['mount_fstype']),
             ]
-            result_string = ""
+            options = mountbackend.format_options(
+                self.config['mount_options']
+            )
+            if options:
+                command.append("--options={}".format(options))
             try:
-                result_string += subprocess.check_output(command).decode()
-                # print("result_string", result_string)
+                return self._run_command(command).decode()
             except subprocess.CalledProcessError as e:
-                error_message = "failed: {}".format(e)
-                print(error_message)
-                result_string += error_message
-            return result_string
+                # the command only has its exit status - no errno
+                print("failed: {}".format(e))
+                raise mountbackend.MountError(
+                    'mount',
+                    errno.EIO,
+                    self.node,
+                    self.mount_point,
+                    options
+                )
 
     def unmount(self):
-        """Unmount this Stick."""
+        """
+        Unmount this Stick.
+
+        errors are raised as mountbackend.MountError -
+        also with the umount command.
+        """
+        if self.mount_point and self._use_mount_syscall():
+            mountbackend.umount(self.mount_point)
+            self._remove_mount_point()
+            return ""
         if self.mount_point:
             # umount
             #   /dev/sdc1
@@ -179,20 +390,51 @@ class USBStick(threading.Thread):
                 "umount",
                 "{}".format(self.mount_point),
             ]
-            result_string = ""
             try:
-                result_string += subprocess.check_output(command).decode()
-                # print("result_string", result_string)
+                result_string = self._run_command(command).decode()
             except subprocess.CalledProcessError as e:
-                error_message = "failed: {}".format(e)
-                print(error_message)
-                result_string += error_message
-            else:
-                self._remove_mount_point()
+                print("failed: {}".format(e))
+                raise mountbackend.MountError(
+                    'umount',
+                    errno.EIO,
+                    self.mount_point,
+                    self.mount_point
+                )
+            self._remove_mount_point()
             return result_string
         else:
             print("stick not mounted by this scirpt.")
 
+    def flush(self):
+        """Write all cached data of this Stick."""
+        if self.mount_point:
+            mountbackend.syncfs(self.mount_point)
+
+    def force_unmount(self):
+        """Lazy unmount - also works if the stick is already gone."""
+        if self.mount_point and self._use_mount_syscall():
+            try:
+                mountbackend.umount(self.mount_point, mountbackend.MNT_DETACH)
+            except mountbackend.MountError as e:
+                print(e)
+            else:
+                self._remove_mount_point()
+            return
+        if self.mount_point:
+            # umount --lazy /home/stefan/ustick_copy/2-1_2_2_4
+            # detaches now - the kernel cleans up when nothing is busy.
+            command = [
+                "umount",
+                "--lazy",
+                "{}".format(self.mount_point),
+            ]
+            try:
+                self._run_command(command)
+            except subprocess.CalledProcessError as e:
+                print("failed: {}".format(e))
+            else:
+                self._remove_mount_point()
+
     # mount with user rights
     def user_mount(self):
         """Mount this stick with user rights."""
@@ -207,7 +449,7 @@ class USBStick(threading.Thread):
             ]
             result_string = ""
             try:
-                result_string += subprocess.check_output(command).decode()
+                result_string += self._run_command(command).decode()
                 # print("result_string", result_string)
             except subprocess.CalledProcessError as e:
                 error_message = "failed: {}".format(e)
@@ -230,7 +472,7 @@ class USBStick(threading.Thread):
             ]
             result_string = ""
             try:
-                result_string += subprocess.check_output(command).decode()
+                result_string += self._run_command(command).decode()
                 # print("result_string", result_string)
             except subprocess.CalledProcessError as e:
                 error_message = "failed: {}".format(e)
@@ -245,9 +487,17 @@ class USBStick(threading.Thread):
     # label things
     def update_label(self, label=None):
         """Update the Filesystem Label."""
-        # fatlabel /dev/sda1 MyNewLabel
         if label is None:
             label = self.config['disc_label']
+        if self.config['label_backend'] == 'builtin':
+            try:
+                fatfs.write_label(self.node, label)
+            except (fatfs.Error, OSError) as e:
+                error_message = "failed: {}".format(e)
+                print(error_message)
+                return error_message
+            return ""
+        # fatlabel /dev/sda1 MyNewLabel
         command = [
             "fatlabel",
             "{}".format(self.node),
@@ -255,7 +505,7 @@ class USBStick(threading.Thread):
         ]
         result_string = ""
         try:
-            result_string += subprocess.check_output(command).decode()
+            result_string += self._run_command(command).decode()
             # print("result_string", result_string)
         except subprocess.CalledProcessError as e:
             error_message = "failed: {}".format(e)
@@ -268,18 +518,31 @@ class USBStick(threading.Thread):
         """Format as fat32 and set label."""
         if label is None:
             label = self.config['disc_label']
+        if self.config['format_backend'] == 'builtin':
+            try:
+                fatfs.format_fat32(
+                    self.node,
+                    label,
+                    self.config['format_cluster_size'],
+                    self.config['format_alignment']
+                )
+            except (fatfs.Error, OSError) as e:
+                error_message = "failed: {}".format(e)
+                print(error_message)
+                return error_message
+            return ""
         # mkfs -t fat -F 32 -n "world" /dev/sdb1
         # mkfs -t fat -F 32 -n "world" /dev/sdb1
         command = [
             "mkfs.fat",
             # "-t=fat",
-            "-F 32",
-            "-n {}".format(label),
-            "{}".format(self.mount_point),
+            "-F", "32",
+            "-n", "{}".format(label),
+            "{}".format(self.node),
         ]
         result_string = ""
         try:
-            result_string += subprocess.check_output(command).decode()
+            result_string += self._run_command(command).decode()
             # print("result_string", result_string)
         except subprocess.CalledProcessError as e:
             error_message = "failed: {}".format(e)
@@ -287,70 +550,550 @@ class USBStick(threading.Thread):
             result_string += error_message
         return result_string
 
+    # writeback
+    def limit_writeback(self):
+        """Limit the dirty pages the kernel holds back for this Stick."""
+        try:
+            self.writeback_limits = writeback.limit_device(
+                self.node,
+                self.config['writeback_max_bytes'],
+                self.config['writeback_max_ratio'],
+                self.config['writeback_strict_limit']
+            )
+        except writeback.Error as e:
+            # the copy works without - only the memory use is higher
+            print(e)
+
+    def restore_writeback(self):
+        """Set the dirty page limits from before the job again."""
+        previous, self.writeback_limits = self.writeback_limits, None
+        if not previous or self.cancel_event.is_set():
+            # a pulled stick took its limits with it -
+            # its device number may already belong to another stick.
+            return
+        try:
+            writeback.restore_device(previous)
+        except writeback.Error as e:
+            print(e)
+
+    # capacity
+    def _fits(self, available, cluster_size):
+        """Check if the source fits into available bytes."""
+        required = self.session.get_required_size(cluster_size)
+        if required > available:
+            print(
+                "stick '{}' too small: source needs {} bytes - "
+                "{} bytes available".format(
+                    self.get_usb_port_id(),
+                    required,
+                    available
+                )
+            )
+            return False
+        return True
+
+    def _uses_own_format(self):
+        """Check if the format step leaves the layout to mkfs.fat."""
+        return (
+            self.config['copy_mode'] not in ('image', 'raw') and
+            self.config['format_backend'] != 'builtin'
+        )
+
+    def _check_formatted_capacity(self):
+        # mkfs.fat picks its own cluster size - read it from the stick
+        try:
+            fd = os.open(self.node, os.O_RDONLY)
+            try:
+                boot = fatfs.read_boot_sector(fd)
+            finally:
+                os.close(fd)
+        except (fatfs.Error, OSError) as e:
+            # the mount step reports this
+            print(e)
+            return True
+        cluster_size = boot.sectors_per_cluster * boot.bytes_per_sector
+        return self._fits(boot.cluster_count * cluster_size, cluster_size)
+
+    def check_partition_capacity(self):
+        """
+        Check if the source fits onto this Stick once it is formatted.
+
+        the builtin format, the image and the raw write are checked
+        against the layout they will write -
+        a stick formatted by mkfs.fat against its formatted layout.
+        """
+        if self._uses_own_format():
+            return self._check_formatted_capacity()
+        geometry = fatfs.get_geometry(self.node)
+        if self.config['copy_mode'] == 'image':
+            image_geometry = self.get_image_geometry(geometry)
+            if image_geometry.size > geometry.size:
+                print(
+                    "stick '{}' too small: image has {} bytes - "
+                    "{} bytes available".format(
+                        self.get_usb_port_id(),
+                        image_geometry.size,
+                        geometry.size
+                    )
+                )
+                return False
+            geometry = image_geometry
+        try:
+            # the same cached layout the format / raw write / image uses
+            layout = fatfs.get_skeleton(
+                geometry,
+                self.config['disc_label'],
+                self.config['format_cluster_size'],
+                self.config['format_alignment']
+            ).layout
+        except fatfs.Error as e:
+            # the format step reports this
+            print(e)
+            return True
+        cluster_size = layout.sectors_per_cluster * fatfs.sector_size
+        return self._fits(layout.cluster_count * cluster_size, cluster_size)
+
+    def check_mounted_capacity(self):
+        """Check if the source fits onto the mounted Stick."""
+        st = os.statvfs(self.mount_point)
+        if (
+            self.config['copy_mode'] == 'sync' or
+            (self.journal and self.journal.done)
+        ):
+            # sync replaces the old content - resume keeps the copied files
+            available = st.f_blocks * st.f_frsize
+        else:
+            available = st.f_bavail * st.f_frsize
+        # vfat reports the cluster size as block size
+        return self._fits(available, st.f_bsize)
+
+    # registry
+    def get_identity(self):
+        """Get identity of this Stick from its udev properties."""
+        return registry.get_identity(
+            self.device.properties.get('ID_SERIAL'),
+            self.device.properties.get('ID_FS_UUID')
+        )
+
+    def is_done(self):
+        """Check if this Stick was already completed with this source."""
+        completion_registry = self.session.get_registry()
+        if completion_registry is None:
+            return False
+        return completion_registry.is_done(self.get_identity())
+
+    def _is_completed(self):
+        """Check if this job left the complete source on the Stick."""
+        if self.result_message != "done" or self.cancel_event.is_set():
+            return False
+        # label only / format only runs did not write the source
+        if not self.content_written:
+            return False
+        if self.config['auto_run_steps']['verify_files']:
+            return self.verified
+        return True
+
+    def _register_done(self):
+        completion_registry = self.session.get_registry()
+        if completion_registry is None:
+            return
+        # format and raw write give the stick a new volume id -
+        # the udev properties are from before the job.
+        try:
+            fs_uuid = fatfs.read_volume_id(self.node)
+        except (OSError, fatfs.Error):
+            fs_uuid = None
+        if fs_uuid is None:
+            fs_uuid = self.device.properties.get('ID_FS_UUID')
+        serial = self.device.properties.get('ID_SERIAL')
+        completion_registry.add(
+            registry.get_identity(serial, fs_uuid),
+            serial,
+            fs_uuid,
+            self.get_usb_port_id()
+        )
+
+    # probe
+    def probe_me(self):
+        """Write test - returns probe.ProbeResult."""
+        self._start_progress(
+            probe.get_probe_bytes(
+                fatimage.get_device_size(self.node),
+                self.config['probe_size'],
+                self.config['probe_sample_count'],
+                self.config['probe_sample_size']
+            ),
+            0
+        )
+        result = probe.probe_device(
+            self.node,
+            self.config['probe_size'],
+            self.config['probe_sample_count'],
+            self.config['probe_sample_size'],
+            self.progress,
+            self.config['writeback_window']
+        )
+        self.progress.finish()
+        return result
+
+    def _run_probe(self):
+        """Run the probe step - returns False if the stick is rejected."""
+        self._start_step("probe")
+        result = self.probe_me()
+        self._end_step()
+        speed = result.write_speed / 1e6
+        if result.bad_offsets:
+            print(
+                "stick '{}' has fake capacity: reports {} bytes - "
+                "samples not read back at {}".format(
+                    self.get_usb_port_id(),
+                    result.size,
+                    result.bad_offsets
+                )
+            )
+            self.result_message = "fake!"
+            self.show_port_message(self.result_message)
+            return False
+        if speed < self.config['probe_min_speed']:
+            print("stick '{}' too slow: {:.1f} MB/s".format(
+                self.get_usb_port_id(),
+                speed
+            ))
+            self.result_message = "slow {:.1f}MB/s".format(speed)
+            self.show_port_message(self.result_message)
+            return False
+        self.show_port_message("probe {:.1f}MB/s".format(speed))
+        return True
+
+    # clone image
+    def get_image_geometry(self, geometry=None):
+        """Get the partition geometry the image for this Stick is built for."""
+        if geometry is None:
+            geometry = fatfs.get_geometry(self.node)
+        if self.config['image_size']:
+            # a smaller volume than the partition
+            geometry = geometry._replace(
+                size=self.config['image_size'] * 1024 * 1024
+            )
+        return geometry
+
+    def clone_image_to_me(self):
+        """Write the session FAT32 image directly onto this Stick."""
+        image_file = self.session.get_image(self.get_image_geometry())
+        self._start_progress(fatimage.get_image_bytes(image_file), 0)
+        written = fatimage.write_image(
+            image_file,
+            self.node,
+            progress=self.progress,
+            writeback_window=self.config['writeback_window']
+        )
+        self.progress.finish()
+        self.bytes_written += written
+        self.content_written = True
+        return written
+
+    # raw write
+    def write_raw_to_me(self):
+        """Write new FAT32 filesystem with all source files onto this Stick."""
+        fat_writer = self.session.get_fat_writer()
+        plan = fat_writer.get_plan(
+            fatfs.get_geometry(self.node),
+            self.config['disc_label'],
+            self.config['format_cluster_size'],
+            self.config['format_alignment']
+        )
+        # the stream includes the padding of every last cluster
+        self._start_progress(plan.files_size, len(plan.files))
+        written = fat_writer.write(
+            self.node,
+            self.config['disc_label'],
+            self.config['format_cluster_size'],
+            self.config['format_alignment'],
+            self.progress
+        )
+        self.progress.finish()
+        self.bytes_written += written
+        self.content_written = True
+        return written
+
     # copy files
     def copy_files_to_me(self, src=None):
         """Copy Files from source_folder to this Stick."""
         # based on
         # https://docs.python.org/3/library/shutil.html#shutil.copy2
         dst = self.mount_point
+        copy_journal = None
         if src is None:
-            src = self.config['source_folder']
-        src_abs = os.path.expanduser(src)
+            # the session manifest is scanned only once for all sticks
+            source_manifest = self.session.get_manifest()
+            copy_journal = self.journal
+        else:
+            source_manifest = manifest.SourceManifest(
+                os.path.expanduser(src),
+                self.session.get_path_filter()
+            )
         # first check if device is mounted.
         if os.path.exists(dst):
-            self._copy_files(src_abs, dst)
+            if copy_journal:
+                copy_journal.open(self._get_files_on_me(
+                    source_manifest,
+                    copy_journal.done
+                ))
+                source_manifest = source_manifest.subset(
+                    entry
+                    for entry in source_manifest.files
+                    if entry.name not in copy_journal.done
+                )
+            self._start_progress(
+                source_manifest.total_size,
+                len(source_manifest.files)
+            )
+            try:
+                if (
+                    src is None and
+                    self.config['copy_engine'] == 'broadcast'
+                ):
+                    try:
+                        self.session.get_broadcast().copy_to(
+                            dst,
+                            self.progress,
+                            copy_journal
+                        )
+                    except broadcast.Error as err:
+                        raise Error(err.args[0])
+                else:
+                    self._copy_files(source_manifest, dst, copy_journal)
+            except BaseException:
+                if copy_journal:
+                    # the next try goes on from here
+                    copy_journal.close()
+                raise
+            if copy_journal:
+                copy_journal.remove()
+            self.progress.finish()
+            self.bytes_written += source_manifest.total_size
+            self.content_written = True
         else:
             print(
                 "error: destination '{}' does not exist! "
                 "check if Stick is mounted!".format(dst)
             )
 
-    def _copy_files(self, src, dst):
-        errors = []
-        names = os.listdir(src)
+    def _get_journal(self):
+        """Get the CopyJournal for this Stick (or None)."""
+        if (
+            self.config['copy_mode'] != 'files' or
+            not self.config['auto_run_steps']['copy_files_to_me']
+        ):
+            return None
+        serial = self.device.properties.get('ID_SERIAL')
+        if not serial:
+            # without serial a different stick could continue the journal
+            return None
+        return self.session.get_journal(serial, self.get_usb_port_id())
+
+    def _get_files_on_me(self, source_manifest, names):
+        """Get the names that are on this Stick with the source size."""
+        sizes = {entry.name: entry.size for entry in source_manifest.files}
+        result = set()
         for name in names:
-            self._copy_file(src, dst, name, errors)
+            try:
+                st = os.stat(os.path.join(self.mount_point, name))
+            except OSError:
+                continue
+            if sizes.get(name) == st.st_size:
+                result.add(name)
+        return result
+
+    def _copy_files(self, source_manifest, dst, copy_journal=None):
+        errors = []
+        # directories come parents first - so they can be created in order.
+        for entry in source_manifest.dirs:
+            dstname = os.path.join(dst, entry.name)
+            try:
+                os.makedirs(dstname, exist_ok=True)
+            except OSError as why:
+                errors.append((
+                    source_manifest.get_src_path(entry), dstname, str(why)
+                ))
+        for entry in source_manifest.links:
+            dstname = os.path.join(dst, entry.name)
+            try:
+                os.symlink(entry.link_target, dstname)
+            except OSError as why:
+                errors.append((
+                    source_manifest.get_src_path(entry), dstname, str(why)
+                ))
+        # one window for all files - the end of every file goes to
+        # the stick while the next file is copied.
+        window = writeback.WritebackWindow(
+            self.config['writeback_window'],
+            self.progress
+        )
         try:
-            shutil.copystat(src, dst)
-        except OSError as why:
-            # can't copy file access times on Windows
-            if why.winerror is None:
-                errors.extend((src, dst, str(why)))
+            for entry in source_manifest.files:
+                self._copy_file(
+                    source_manifest,
+                    dst,
+                    entry,
+                    errors,
+                    window,
+                    copy_journal
+                )
+            try:
+                window.finish()
+            except OSError as why:
+                # the end of the last file did not get onto the stick
+                errors.append((source_manifest.src, dst, str(why)))
+        finally:
+            window.close()
+        # deepest directories last created - so first to get their stat
+        for entry in reversed((source_manifest.root,) + source_manifest.dirs):
+            dstname = os.path.join(dst, entry.name)
+            try:
+                manifest.copy_stat(entry, dstname)
+            except OSError as why:
+                errors.append((
+                    source_manifest.get_src_path(entry), dstname, str(why)
+                ))
         if errors:
             raise Error(errors)
 
-    def _copy_file(self, src, dst, name, errors):
-        srcname = os.path.join(src, name)
-        dstname = os.path.join(dst, name)
+    def _copy_file(
+        self,
+        source_manifest,
+        dst,
+        entry,
+        errors,
+        window=None,
+        copy_journal=None
+    ):
+        srcname = source_manifest.get_src_path(entry)
+        dstname = os.path.join(dst, entry.name)
         try:
-            if os.path.islink(srcname):
-                linkto = os.readlink(srcname)
-                os.symlink(linkto, dstname)
-            elif os.path.isdir(srcname):
-                os.makedirs(dstname)
-                self._copy_files(srcname, dstname)
-            else:
-                shutil.copy2(srcname, dstname)
+            self.session.get_copy_backend().copy_file(
+                srcname, dstname, entry.size, self.progress, window
+            )
+            manifest.copy_stat(entry, dstname)
+            if copy_journal:
+                copy_journal.add(entry)
         except OSError as why:
             errors.append((srcname, dstname, str(why)))
-        # catch the Error from the recursive copytree so that we can
-        # continue with other files
-        except Error as err:
-            errors.extend(err.args[0])
+        if self.progress:
+            self.progress.add(files_done=1)
+
+    # sync files
+    def sync_files_to_me(self):
+        """Only copy new or changed files and delete removed ones."""
+        dst = self.mount_point
+        if not os.path.exists(dst):
+            print(
+                "error: destination '{}' does not exist! "
+                "check if Stick is mounted!".format(dst)
+            )
+            return
+        source_manifest = self.session.get_manifest()
+        dst_manifest = manifest.SourceManifest(dst)
+        self._sync_remove(source_manifest, dst_manifest)
+        dst_files = {entry.name: entry for entry in dst_manifest.files}
+        changed = [
+            entry
+            for entry in source_manifest.files
+            if self._sync_is_changed(entry, dst_files.get(entry.name))
+        ]
+        print("sync: {} of {} files changed".format(
+            len(changed),
+            len(source_manifest.files)
+        ))
+        dst_links = set(entry.name for entry in dst_manifest.links)
+        changed_manifest = source_manifest.subset(
+            changed,
+            [
+                entry
+                for entry in source_manifest.links
+                if entry.name not in dst_links
+            ]
+        )
+        self._start_progress(
+            changed_manifest.total_size,
+            len(changed_manifest.files)
+        )
+        self._copy_files(changed_manifest, dst)
+        self.progress.finish()
+        self.bytes_written += changed_manifest.total_size
+        self.content_written = True
+
+    def _sync_is_changed(self, entry, dst_entry):
+        if dst_entry is None or dst_entry.size != entry.size:
+            return True
+        if self.config['sync_compare'] == 'hash':
+            digest = verify.hash_file_uncached(
+                os.path.join(self.mount_point, entry.name),
+                self.config['verify_algorithm']
+            )
+            return digest != self.session.get_source_digests()[entry.name]
+        tolerance_ns = self.config['sync_mtime_tolerance'] * 1000000000
+        return abs(dst_entry.mtime_ns - entry.mtime_ns) > tolerance_ns
+
+    def _sync_remove(self, source_manifest, dst_manifest):
+        source_kinds = {
+            entry.name: entry.kind
+            for entry in (
+                source_manifest.dirs +
+                source_manifest.files +
+                source_manifest.links
+            )
+        }
+        keep = self.config['sync_keep']
+        errors = []
+        # files first - than directories deepest first
+        for entry in (
+            dst_manifest.files +
+            dst_manifest.links +
+            tuple(reversed(dst_manifest.dirs))
+        ):
+            top_level = entry.name.split(os.sep)[0]
+            if top_level in keep:
+                continue
+            if source_kinds.get(entry.name) == entry.kind:
+                continue
+            full_path = os.path.join(self.mount_point, entry.name)
+            try:
+                if entry.kind == 'dir':
+                    os.rmdir(full_path)
+                else:
+                    os.remove(full_path)
+                print("removed: {}".format(full_path))
+            except OSError as why:
+                errors.append((full_path, str(why)))
         if errors:
             raise Error(errors)
 
+    # verify
+    def verify_files_on_me(self):
+        """Read back all files and compare them with the source digests."""
+        source_manifest = self.session.get_manifest()
+        digests = self.session.get_source_digests()
+        mismatches = verify.verify_files(
+            source_manifest,
+            digests,
+            self.mount_point,
+            self.config['verify_algorithm'],
+            self.config['verify_direct']
+        )
+        for dstname, reason in mismatches:
+            print("verify failed: {} ({})".format(dstname, reason))
+        self.verified = not mismatches
+        return mismatches
+
     # remove files
     def remove_all_meta_files(self):
         """Remove all meta files from this Stick."""
         # based on
         # https://docs.python.org/3/library/os.html#os.walk
-        meta_files = [
-            '.DS_Store'
-        ]
         for root, dirs, files in os.walk(self.mount_point, topdown=False):
             for name in files:
-                if name in meta_files:
+                if name in manifest.meta_files:
                     full_path = os.path.join(root, name)
                     print("remove: {}".format(full_path))
                     os.remove(full_path)
@@ -374,7 +1117,7 @@ class USBStick(threading.Thread):
                 os.remove(full_path)
                 print("removed: {}".format(full_path))
             except FileNotFoundError as why:
-                infos.extend(why)
+                infos.append(str(why))
             except Exception as why:
                 info = {
                     'mount_point': self.mount_point,
@@ -392,7 +1135,7 @@ class USBStick(threading.Thread):
         for prop in self.device.properties:
             print("{}:{}".format(
                 prop,
-                self.device[prop]
+                self.device.properties[prop]
             ))
 
     def prettyprint(self):
@@ -410,55 +1153,309 @@ class USBStick(threading.Thread):
             )
         )
 
+    def _start_progress(self, bytes_total, files_total):
+        self.progress = progress.Progress(
+            bytes_total,
+            files_total,
+            self.show_port_message,
+            self.config['progress_interval'],
+            self.cancel_event
+        )
+
+    # cancel
+    def cancel(self):
+        """Let the job stop as soon as possible - does not wait."""
+        self.cancel_event.set()
+
+    def is_cancelled(self):
+        """Check if the job was cancelled."""
+        return self.cancel_event.is_set()
+
+    def _start_step(self, message):
+        """Check for cancel and start the next step."""
+        if self.cancel_event.is_set():
+            raise progress.Cancelled()
+        self._begin_step(message)
+
+    def _begin_step(self, message):
+        """Show the step message and start its timer."""
+        self._end_step()
+        self.step_name = message
+        self.step_time_start = time.monotonic()
+        self.step_bytes_start = self.bytes_written
+        if message in self.write_steps and self.write_started_callback:
+            self.write_started_callback(self)
+        self.show_port_message(message)
+
+    def _end_step(self):
+        """Stop the timer of the current step."""
+        if self.step_name:
+            self.step_times[self.step_name] = (
+                time.monotonic() - self.step_time_start
+            )
+            if (
+                self.step_name in self.write_steps and
+                self.write_finished_callback
+            ):
+                self.write_finished_callback(
+                    self,
+                    self.bytes_written - self.step_bytes_start
+                )
+            self.step_name = None
+
     def show_port_message(self, message):
-        """Show message for a device with port_path."""
+        """
+        Show message for a device with port_path.
+
+        message is a status text or a progress.ProgressInfo.
+        """
+        if self.cancel_event.is_set():
+            # the port already shows that the stick is gone
+            return
         if self.queue:
             # queue_item = (self.port_path, message)
             # print(queue_item)
             # self.queue.put(queue_item)
             self.queue.put((self.usb_port_path, message))
         else:
+            if isinstance(message, progress.ProgressInfo):
+                message = progress.format_progress(message)
             print("Port {}: {}".format(
                 self.usb_port_name,
                 message
             ))
 
-    def _run_mounted(self):
+    def _run_mounted(self, capacity_checked=False):
         auto_run_steps = self.config['auto_run_steps']
         # ******************************************
         # real work to do:
 
         if auto_run_steps['copy_files_to_me']:
-            # copy files
-            self.show_port_message("copy")
-            self.copy_files_to_me()
+            if not capacity_checked and not self.check_mounted_capacity():
+                self.result_message = "too small"
+                return
+            if self.config['copy_mode'] == 'sync':
+                # only update what has changed
+                self._start_step("sync")
+                self.sync_files_to_me()
+            else:
+                # copy files
+                self._start_step("copy")
+                self.copy_files_to_me()
+
+        if auto_run_steps['verify_files']:
+            # read back and compare with source
+            self._start_step("verify")
+            if self.verify_files_on_me():
+                self.result_message = "verify!"
 
-        if auto_run_steps['remove_all_meta_files']:
+        # the source filter keeps these files off the copy -
+        # only old content on the stick still needs the clean up.
+        only_copied_content = self._has_only_copied_content()
+
+        if (
+            auto_run_steps['remove_all_meta_files'] and
+            not only_copied_content
+        ):
             # remove meta files
-            self.show_port_message("rm meta")
+            self._start_step("rm meta")
             self.remove_all_meta_files()
 
-        if auto_run_steps['remove_files']:
+        if auto_run_steps['remove_files'] and not only_copied_content:
             # remove files in rm_files_list
-            self.show_port_message("rm files")
+            self._start_step("rm files")
             self.remove_files()
 
         # ******************************************
 
+    def _run_image(self):
+        # the image contains filesystem, label and files.
+        # so no format, label, mount or copy needed.
+        self._start_step("clone")
+        try:
+            self.clone_image_to_me()
+        except (fatimage.Error, fatwriter.Error, fatfs.Error) as e:
+            # source does not fit or image larger than the partition
+            print(e)
+            self.result_message = "image!"
+            return
+        self._verify_unmounted()
+
+    def _has_only_copied_content(self):
+        """Check if the stick holds nothing but the filtered source."""
+        auto_run_steps = self.config['auto_run_steps']
+        if not auto_run_steps['copy_files_to_me']:
+            return False
+        if self.config['copy_mode'] == 'sync':
+            # sync deletes everything that is not in the manifest
+            return True
+        return auto_run_steps['format_as_fat32']
+
+    def _run_raw(self):
+        # filesystem, label and files are written in one pass.
+        # meta files and files_to_remove are left out by the source filter.
+        self._start_step("raw")
+        try:
+            self.write_raw_to_me()
+        except (fatwriter.Error, fatfs.Error) as e:
+            # source does not fit or can not be stored as FAT32
+            print(e)
+            self.result_message = "raw!"
+            return
+        self._verify_unmounted()
+
+    def _verify_unmounted(self):
+        # image and raw write the stick without a mount -
+        # it is only mounted to read the files back.
+        if not self.config['auto_run_steps']['verify_files']:
+            return
+        try:
+            self.mount()
+        except mountbackend.MountError as e:
+            self.show_port_message("mount!")
+            print(e)
+            self._remove_mount_point()
+            self.result_message = "verify!"
+            return
+        try:
+            self._start_step("verify")
+            if self.verify_files_on_me():
+                self.result_message = "verify!"
+        finally:
+            self._unmount_after_steps(flush=False)
+
+    def _set_error(self, message):
+        # the first error is the one the user has to see
+        if self.result_message == "done":
+            self.result_message = message
+
+    def _unmount_after_steps(self, flush=True):
+        """
+        Flush and unmount - never raises.
+
+        a failed flush or unmount sets the result message and
+        falls back to a lazy unmount - the port still gets its message.
+        """
+        if self.cancel_event.is_set():
+            self.force_unmount()
+            return
+        if flush:
+            # the writeback of the copy is done here -
+            # not hidden in the copy or umount time.
+            self._begin_step("flush")
+            try:
+                self.flush()
+            except (mountbackend.MountError, OSError) as e:
+                print("flush '{}' failed: {}".format(self.mount_point, e))
+                self._end_step()
+                self._set_error("flush!")
+                self.force_unmount()
+                return
+            self._end_step()
+            self.show_port_message(
+                "flush {:.1f}s".format(self.step_times['flush'])
+            )
+        self._begin_step("unmount")
+        try:
+            self.unmount()
+        except (mountbackend.MountError, OSError) as e:
+            print("unmount '{}' failed: {}".format(self.mount_point, e))
+            self._set_error("umount!")
+            self.force_unmount()
+        self._end_step()
+
     # thread runner
     def run(self):
         """Auto perform Stick programming."""
+        try:
+            self._run_steps()
+            if self._is_completed():
+                self._register_done()
+        except Exception:
+            # errors of a pulled stick are expected - nothing to report
+            if not self.cancel_event.is_set():
+                raise
+        finally:
+            self.restore_writeback()
+            # let the scheduler start the next waiting stick
+            if self.job_done_callback:
+                self.job_done_callback(self)
+
+    def _run_steps(self):
         auto_run_steps = self.config['auto_run_steps']
-        self.show_port_message("start")
+        self._start_step("start")
+        self.limit_writeback()
+        self.journal = self._get_journal()
+        resume = bool(self.journal and self.journal.load())
+        if resume:
+            print("stick '{}': resume copy - {} files in the journal".format(
+                self.get_usb_port_id(),
+                len(self.journal.done)
+            ))
+            self.show_port_message("resume")
+        # format and probe would destroy what the journal has recorded
+        rewrite = (
+            self.config['copy_mode'] in ('image', 'raw') or (
+                auto_run_steps['format_as_fat32'] and
+                self.config['copy_mode'] != 'sync' and
+                not resume
+            )
+        )
+        # reject sticks that are too small before anything is written
+        capacity_checked = (
+            self.config['copy_mode'] in ('image', 'raw') or (
+                auto_run_steps['copy_files_to_me'] and rewrite
+            )
+        )
+        # a stick formatted by mkfs.fat is checked after the format
+        if (
+            capacity_checked and
+            not self._uses_own_format() and
+            not self.check_partition_capacity()
+        ):
+            self._end_step()
+            self.result_message = "too small"
+            self.show_port_message(self.result_message)
+            return
+        if auto_run_steps['probe']:
+            # the probe overwrites the stick - only if it is rewritten.
+            if rewrite:
+                if not self._run_probe():
+                    return
+            else:
+                print(
+                    "probe skipped - it would destroy the data "
+                    "on '{}'".format(self.get_usb_port_id())
+                )
+        if self.config['copy_mode'] == 'image':
+            self._run_image()
+            self._end_step()
+            self.show_port_message(self.result_message)
+            return
+        if self.config['copy_mode'] == 'raw':
+            self._run_raw()
+            self._end_step()
+            self.show_port_message(self.result_message)
+            return
         try:
-            if auto_run_steps['format_as_fat32']:
+            # formatting would remove what sync / resume wants to keep
+            if rewrite:
                 # format_as_fat32
-                self.show_port_message("fat32")
+                self._start_step("fat32")
                 self.format_as_fat32()
+                if (
+                    capacity_checked and
+                    self._uses_own_format() and
+                    not self.check_partition_capacity()
+                ):
+                    self._end_step()
+                    self.result_message = "too small"
+                    self.show_port_message(self.result_message)
+                    return
 
             if auto_run_steps['update_label']:
                 # update label
-                self.show_port_message("label")
+                self._start_step("label")
                 self.update_label()
         except Exception as e:
             raise e
@@ -467,42 +1464,44 @@ class USBStick(threading.Thread):
                 # mount
                 self.mount()
                 # self.user_mount()
+            except mountbackend.MountError as e:
+                # nothing to copy - the mount point is an empty folder
+                self.result_message = "mount!"
+                self.show_port_message(self.result_message)
+                print(e)
+                self._remove_mount_point()
+                return
             except Exception as e:
                 raise e
             else:
                 try:
-                    self._run_mounted()
+                    self._run_mounted(capacity_checked)
                 except Exception as e:
                     raise e
                 finally:
-                    try:
-                        # un-mount
-                        self.unmount()
-                        # self.user_unmount()
-                    except Exception as e:
-                        raise e
+                    # un-mount
+                    self._unmount_after_steps(
+                        self.config['flush_before_unmount']
+                    )
+                    # self.user_unmount()
+        self._end_step()
         # done :-)
         # now we have to let the user know
         # print("stick '{}' done".format(self.get_usb_port_id()))
-        self.show_port_message("done")
+        self.show_port_message(self.result_message)
 
 
 ##########################################
 if __name__ == '__main__':
 
-    context = pyudev.Context()
+    device_source = devicesource.UdevDeviceSource()
 
     usbstick_list = []
 
-    for device in context.list_devices(
-        subsystem='block',
-        DEVTYPE='partition'
-    ):
-        if 'ID_BUS' in device:
-            if device['ID_BUS'] == 'usb':
-                usbstick_list.append(
-                    USBStick(device.device_path, {})
-                )
+    for device in device_source.list_usb_partitions():
+        usbstick_list.append(
+            USBStick(device.device_path, {}, device_source=device_source)
+        )
 
     print("Sticks", "-"*42)
     for stick in usbstick_list:
@@ -18,10 +18,13 @@ import queue
 import json
 # import readline
 
-import pyudev
-
 import configdict
+import devicesource
+import fatfs
 from usbstick import USBStick
+from copysession import CopySession
+from scheduler import TopologyScheduler
+import progress
 
 
 ##########################################
@@ -33,12 +36,38 @@ class SystemManager(object):
         'stick_config': {},
         'port_map': {},
         'only_copy_to_mapped_ports': False,
+        # maximum number of sticks copied at the same time - 0 means no limit
+        'max_concurrent_jobs': 0,
+        # port numbers that are served first if sticks have to wait
+        'port_priority': [],
+        # maximum concurrent writers per hub ('2-1.2') and root bus ('usb2')
+        # 'default' is used for all not listed - 0 means no limit
+        'hub_limits': {
+            'default': 0,
+        },
+        'bus_limits': {
+            'default': 0,
+        },
+        # lower the hub limits to the measured throughput ceiling
+        'learn_hub_limits': False,
+        # minimal seconds between two redraws for progress reports
+        'progress_show_interval': 1.0,
+        # asyncio core (--asyncio): threads for the stick jobs
+        'async_max_workers': 32,
     }
 
     path_script = os.path.dirname(os.path.abspath(__file__))
 
-    def __init__(self, filename, verbose=False):
-        """Init SystemManager things."""
+    # class used for new sticks - tests can use a subclass
+    stick_class = USBStick
+
+    def __init__(self, filename, verbose=False, device_source=None):
+        """
+        Init SystemManager things.
+
+        device_source: where partition events come from -
+            defaults to udev (devicesource.UdevDeviceSource).
+        """
         super(SystemManager, self).__init__()
 
         # check for filename
@@ -75,17 +104,19 @@ class SystemManager(object):
         path_to_config = os.path.dirname(filename)
         self.config["path_to_config"] = path_to_config
 
-        self.context = pyudev.Context()
-        self.monitor = pyudev.Monitor.from_netlink(self.context)
-        self.monitor.filter_by('block', device_type="partition")
-        self.observer = pyudev.MonitorObserver(
-            self.monitor,
-            self._even_partition
-        )
+        if device_source is None:
+            device_source = devicesource.UdevDeviceSource()
+        self.device_source = device_source
+        # record all partition events to this file (json lines)
+        self.record_filename = None
 
         self.mode = None
+        self.session = None
+        self.scheduler = None
 
         self.stick_dict = {}
+        # pulled sticks whose jobs are still cleaning up
+        self.sticks_cancelled = []
 
         self.queue_devices = queue.Queue()
         self.device_handler_thread = threading.Thread(
@@ -94,6 +125,8 @@ class SystemManager(object):
 
         self.queue_sticks = queue.Queue()
         self.stick_messages = {}
+        self.stick_progress = {}
+        self.stick_progress_shown = 0
         # init stick_messages with '?'
         for device_path, port_number in self.config['port_map'].items():
             self.stick_messages[port_number] = '?'
@@ -113,32 +146,43 @@ class SystemManager(object):
         """Start things."""
         self.device_handler_thread.start()
         self.stick_messages_thread.start()
-        self.observer.start()
+        self.device_source.start(self._even_partition, self.record_filename)
         print("started system in {} mode".format(self.mode))
 
     def stop(self):
         """Stop things."""
-        # if self.observer.is_alive():
-        self.observer.stop()
+        self.device_source.stop()
         self.queue_devices.put(None)
         if self.device_handler_thread.is_alive():
             self.device_handler_thread.join()
+        if self.scheduler:
+            # waiting sticks are not started anymore
+            self.scheduler.clear()
         self.queue_sticks.put(None)
         if self.stick_messages_thread.is_alive():
             self.stick_messages_thread.join()
         for device_path, stick in self.stick_dict.items():
             if stick.is_alive():
                 stick.join()
+        for stick in self.sticks_cancelled:
+            stick.join()
+        self.sticks_cancelled = []
         print("stopped system from {} mode".format(self.mode))
         if self.mode == 'mapping':
             self.show_mapping()
+        if self.mode == 'copy':
+            self.show_registry()
         self.mode = None
 
+    def wait_for_events(self):
+        """Block until all received partition events are handled."""
+        self.queue_devices.join()
+
     def _even_partition(self, action, device):
         """Print partition event."""
         # print('background event {0.action}: {0.device_path}'.format(device))
-        if 'ID_BUS' in device:
-            if device['ID_BUS'] == 'usb':
+        if 'ID_BUS' in device.properties:
+            if device.properties['ID_BUS'] == 'usb':
                 # print("-"*42)
                 # print("event: {} '{}'".format(
                 #     device.action,
@@ -158,52 +202,99 @@ class SystemManager(object):
                 break
             # queue_item is valid so we handle it:
             action, device_path = queue_item
-            if action == 'add':
-                config = {}
-                config = self.config['stick_config']
-                new_stick = USBStick(device_path, config, self.queue_sticks)
-                self.stick_dict[device_path] = new_stick
-                if self.mode == 'copy':
-                    new_stick.start()
-                elif self.mode == 'mapping':
-                    port_path = new_stick.get_usb_port_path()
-                    port_map = self.config['port_map']
-                    if port_path not in self.config['port_map']:
-                        port_map[port_path] = len(port_map)
-                        print("new port: {}".format(port_map[port_path]))
-                        self.queue_sticks.put(
-                            (self.stick_dict[device_path].usb_port_path, ':-)')
-                        )
-                else:
-                    print("unknown mode: {}".format(self.mode))
-            elif action == 'remove':
-                if device_path in self.stick_dict:
+            self.handle_device_event(action, device_path)
+            self.queue_devices.task_done()
+
+    def handle_device_event(self, action, device_path):
+        """Handle one add / remove event."""
+        if action == 'add':
+            config = {}
+            config = self.config['stick_config']
+            new_stick = self.stick_class(
+                device_path,
+                config,
+                self.queue_sticks,
+                self.session,
+                self.device_source
+            )
+            self.stick_dict[device_path] = new_stick
+            if self.mode == 'copy':
+                if new_stick.is_done():
+                    # re-plugged by mistake - nothing to do.
                     self.queue_sticks.put(
-                        (self.stick_dict[device_path].usb_port_path, '-')
+                        (new_stick.usb_port_path, "done (cached)")
                     )
-                    if self.stick_dict[device_path].is_alive():
-                        print(
-                            "attention we have to wait "
-                            "for a device after remove!\n"
-                            "THIS SHOULD NEVER HAPPEN!!!! "
-                            "YOU HAVE UNPLUGGED THE STICK "
-                            "BEFORE IT WAS UNMOUNTED\n"
-                            "device_path: {}".format(device_path)
-                        )
-                        self.stick_dict[device_path].join()
-                    del self.stick_dict[device_path]
                 else:
+                    self.scheduler.submit(
+                        new_stick,
+                        self.config['port_map'].get(new_stick.usb_port_path)
+                    )
+            elif self.mode == 'mapping':
+                port_path = new_stick.get_usb_port_path()
+                port_map = self.config['port_map']
+                if port_path not in self.config['port_map']:
+                    port_map[port_path] = len(port_map)
+                    print("new port: {}".format(port_map[port_path]))
+                    self.queue_sticks.put(
+                        (self.stick_dict[device_path].usb_port_path, ':-)')
+                    )
+            else:
+                print("unknown mode: {}".format(self.mode))
+        elif action == 'remove':
+            if device_path in self.stick_dict:
+                stick = self.stick_dict.pop(device_path)
+                if self.scheduler:
+                    self.scheduler.remove(stick)
+                # no more messages from this stick after this one
+                stick.cancel()
+                self.queue_sticks.put((stick.usb_port_path, '-'))
+                self.sticks_cancelled = [
+                    stick_cancelled
+                    for stick_cancelled in self.sticks_cancelled
+                    if self._job_is_running(stick_cancelled)
+                ]
+                if self._job_is_running(stick):
+                    # the job stops at its next chunk and
+                    # lazy unmounts in its own thread -
+                    # so we do not wait here.
                     print(
-                        "remove event - "
-                        "but we have no device for this in our database. "
-                        ""
-                        "device_path: {}".format(device_path)
+                        "stick pulled before it was unmounted - "
+                        "cancel job. device_path: {}".format(device_path)
                     )
-            self.queue_devices.task_done()
+                    self.sticks_cancelled.append(stick)
+            else:
+                print(
+                    "remove event - "
+                    "but we have no device for this in our database. "
+                    ""
+                    "device_path: {}".format(device_path)
+                )
+
+    def _job_is_running(self, stick):
+        """Check if the job of stick is running."""
+        return stick.is_alive()
 
     def start_copy(self):
         """Start automatic copy mode."""
         if self.mode is None:
+            # everything that is the same for all sticks
+            # is only computed once for this session.
+            stick_config = configdict.merge_deep(
+                USBStick.default_config,
+                self.config['stick_config']
+            )
+            self.session = CopySession(
+                stick_config,
+                self.config['path_to_config']
+            )
+            self.session.prepare()
+            self.scheduler = TopologyScheduler(
+                self.config['max_concurrent_jobs'],
+                self.config['port_priority'],
+                self.config['hub_limits'],
+                self.config['bus_limits'],
+                self.config['learn_hub_limits']
+            )
             self.mode = 'copy'
             self.start()
         else:
@@ -241,16 +332,54 @@ class SystemManager(object):
         print("~"*42)
         self.stick_messages_show()
 
+    def show_registry(self):
+        """Show count of unique completed sticks."""
+        completion_registry = None
+        if self.session:
+            completion_registry = self.session.get_registry()
+        if completion_registry:
+            count_all, count_session = completion_registry.get_counts()
+            print(
+                "unique sticks done with this source: {} "
+                "({} in this session)".format(count_all, count_session)
+            )
+
+    def show_hubs(self):
+        """Show writer limits and measured throughput per hub."""
+        if self.scheduler:
+            print("hubs:")
+            print(self.scheduler.get_hub_report())
+            print("~"*42)
+        else:
+            print("no hub data. start copy mode first.")
+
     def stick_messages_show(self):
         """Show messages for all sticks."""
         # print all messages
         text_header = "|"
         text_messages = "|"
+        text_percent = "|"
+        text_speed = "|"
+        text_eta = "|"
         for port_number, message in sorted(self.stick_messages.items()):
             text_header += "{:^10}|".format(port_number)
             text_messages += "{:^10}|".format(message)
-
-        print("\n" + text_header + "\n" + text_messages + "\n")
+            info = self.stick_progress.get(port_number)
+            if info:
+                text_percent += "{:^10}|".format(
+                    "{:.0f}%".format(progress.get_percent(info))
+                )
+                text_speed += "{:^10}|".format(progress.format_speed(info))
+                text_eta += "{:^10}|".format(progress.format_eta(info))
+            else:
+                text_percent += "{:^10}|".format("")
+                text_speed += "{:^10}|".format("")
+                text_eta += "{:^10}|".format("")
+
+        text = "\n" + text_header + "\n" + text_messages + "\n"
+        if self.stick_progress:
+            text += text_percent + "\n" + text_speed + "\n" + text_eta + "\n"
+        print(text)
 
     def stick_messages_handler(self):
         """Handle queued message from sticks."""
@@ -261,16 +390,34 @@ class SystemManager(object):
             # print("queue_item received: '{}'".format(queue_item))
             if queue_item is None:
                 break
-            elif isinstance(queue_item, tuple):
-                # queue_item is valid so we handle it:
-                port_path, message = queue_item
-                if port_path:
-                    if port_path in self.config['port_map']:
-                        port_number = self.config['port_map'][port_path]
-                        self.stick_messages[port_number] = message
-            self.stick_messages_show()
+            self.handle_stick_message(queue_item)
         print("stick_messages_handler thread stopped.")
 
+    def handle_stick_message(self, queue_item):
+        """Handle one message from a stick and redraw the status table."""
+        if isinstance(queue_item, tuple):
+            # queue_item is valid so we handle it:
+            port_path, message = queue_item
+            if port_path:
+                if port_path in self.config['port_map']:
+                    port_number = self.config['port_map'][port_path]
+                    if isinstance(message, progress.ProgressInfo):
+                        self.stick_progress[port_number] = message
+                        # progress comes often -
+                        # so we do not redraw for every report.
+                        now = time.monotonic()
+                        if (
+                            now - self.stick_progress_shown <
+                            self.config['progress_show_interval']
+                        ):
+                            return
+                        self.stick_progress_shown = now
+                    else:
+                        self.stick_messages[port_number] = message
+                        if message in ('start', '-'):
+                            self.stick_progress.pop(port_number, None)
+        self.stick_messages_show()
+
 
 ##########################################
 
@@ -296,15 +443,18 @@ def get_label(user_input):
     start_index = user_input.find(':')
     if start_index > -1:
         disc_label_new = user_input[start_index+1:]
-        if 1 < len(disc_label_new) <= 11:
+        # same rules as for writing the label onto the sticks
+        try:
+            fatfs.check_label(disc_label_new)
+        except fatfs.Error as e:
+            print("input not a valid label: {}".format(e))
+        else:
             my_systemmanager.config['stick_config']['disc_label'] = (
                 disc_label_new
             )
             print("set disc label to '{}'.".format(
                 my_systemmanager.config['stick_config']['disc_label']
             ))
-        else:
-            print("input not a valid label.")
 
 
 def handle_userinput(user_input):
@@ -321,6 +471,8 @@ def handle_userinput(user_input):
         my_systemmanager.stop()
     elif user_input.startswith("show"):
         my_systemmanager.show_port_mapping()
+    elif user_input.startswith("hubs"):
+        my_systemmanager.show_hubs()
     elif user_input.startswith("source"):
         get_source(user_input)
     elif user_input.startswith("label"):
@@ -345,6 +497,7 @@ def handle_interactive():
         "  'copy': start copy mode \n"
         "  'done': stop current mode \n"
         "  'show': show port mapping \n"
+        "  'hubs': show hub limits and throughput \n"
         "  'source': update source folder "
         "'source:{source_default}'\n"
         "  'label': update label name in config "
@@ -431,6 +584,20 @@ def setup_config_parser():
         help="run in interactive mode",
         action="store_true"
     )
+    parser.add_argument(
+        "-r",
+        "--record-events",
+        help="append all partition events as json lines to this file "
+        "(can be replayed with devicesource.FakeDeviceSource)",
+        metavar='EVENTS_FILE',
+        default=None
+    )
+    parser.add_argument(
+        "-a",
+        "--asyncio",
+        help="use the asyncio core (asynccore.AsyncSystemManager)",
+        action="store_true"
+    )
     parser.add_argument(
         "-v",
         "--verbose",
@@ -469,7 +636,12 @@ if __name__ == '__main__':
     signal.signal(signal.SIGINT, _exit_helper)
     signal.signal(signal.SIGTERM, _exit_helper)
 
-    my_systemmanager = SystemManager(args.config, args.verbose)
+    manager_class = SystemManager
+    if args.asyncio:
+        import asynccore
+        manager_class = asynccore.AsyncSystemManager
+    my_systemmanager = manager_class(args.config, args.verbose)
+    my_systemmanager.record_filename = args.record_events
 
     # overwritte with pattern name from comandline
     if "source" in args:
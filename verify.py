@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+Verify.
+
+read back the files written to a stick and compare them
+with the digests of the source files.
+the source digests are computed once per session (see hashcache).
+the read back has to bypass the page cache - otherwise we would only
+compare what is still in memory and not what is on the flash.
+"""
+
+import os
+import mmap
+import errno
+import hashlib
+
+
+class Error(Exception):
+    """Base class for exceptions in this module."""
+
+    pass
+
+
+chunk_size_default = 4 * 1024 * 1024
+
+
+def hash_file(filename, algorithm='sha256', chunk_size=chunk_size_default):
+    """Get hex digest of file content."""
+    digest = hashlib.new(algorithm)
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    with open(filename, 'rb', buffering=0) as f:
+        while True:
+            size = f.readinto(buffer)
+            if not size:
+                break
+            digest.update(view[:size])
+    return digest.hexdigest()
+
+
+def _drop_cache(fd):
+    # dirty pages can not be dropped - so write them first.
+    os.fsync(fd)
+    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def _read_digest(fd, digest, buffer):
+    view = memoryview(buffer)
+    while True:
+        size = os.readv(fd, [buffer])
+        if not size:
+            break
+        digest.update(view[:size])
+
+
+def hash_file_uncached(
+    filename,
+    algorithm='sha256',
+    direct=False,
+    chunk_size=chunk_size_default
+):
+    """
+    Get hex digest of file content as it is on the media.
+
+    direct: use O_DIRECT - else the cached pages are dropped
+        with posix_fadvise(DONTNEED) before reading.
+    """
+    digest = hashlib.new(algorithm)
+    if direct and hasattr(os, 'O_DIRECT'):
+        try:
+            fd = os.open(filename, os.O_RDONLY | os.O_DIRECT)
+        except OSError as why:
+            if why.errno != errno.EINVAL:
+                raise
+            # filesystem does not support O_DIRECT
+        else:
+            try:
+                # O_DIRECT needs an aligned buffer - mmap is page aligned.
+                buffer = mmap.mmap(-1, chunk_size)
+                try:
+                    _read_digest(fd, digest, buffer)
+                finally:
+                    buffer.close()
+            finally:
+                os.close(fd)
+            return digest.hexdigest()
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        _drop_cache(fd)
+        _read_digest(fd, digest, bytearray(chunk_size))
+        # do not keep the read back data in the cache
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+    return digest.hexdigest()
+
+
+def verify_files(
+    source_manifest,
+    digests,
+    dst,
+    algorithm='sha256',
+    direct=False
+):
+    """
+    Compare all manifest files in dst with digests.
+
+    returns list of (dstname, reason) for all mismatches.
+    """
+    mismatches = []
+    for entry in source_manifest.files:
+        dstname = os.path.join(dst, entry.name)
+        try:
+            size = os.path.getsize(dstname)
+            if size != entry.size:
+                mismatches.append((
+                    dstname,
+                    "size {} != {}".format(size, entry.size)
+                ))
+                continue
+            digest = hash_file_uncached(dstname, algorithm, direct)
+        except OSError as why:
+            mismatches.append((dstname, str(why)))
+            continue
+        if digest != digests[entry.name]:
+            mismatches.append((dstname, "content differs"))
+    return mismatches
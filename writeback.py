@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+Writeback control.
+
+keeps the dirty pages for slow sticks bounded:
+    limit_device sets the dirty page limit of the stick
+        (sysfs bdi max_bytes / max_ratio / strict_limit) -
+        restore_device sets the previous values again at job end.
+    WritebackWindow pushes the written files of one stick to the
+        device in windows of some MiB while they are written
+        (sync_file_range) and drops the written pages from the
+        page cache (posix_fadvise DONTNEED).
+        the progress gets the bytes of a window only after
+        the window is on the device.
+"""
+
+import os
+import ctypes
+import ctypes.util
+
+
+class Error(Exception):
+    """Base class for exceptions in this module."""
+
+    pass
+
+
+# sync_file_range flags from <fcntl.h>
+SYNC_FILE_RANGE_WAIT_BEFORE = 1
+SYNC_FILE_RANGE_WRITE = 2
+SYNC_FILE_RANGE_WAIT_AFTER = 4
+SYNC_FILE_RANGE_WAIT = (
+    SYNC_FILE_RANGE_WAIT_BEFORE |
+    SYNC_FILE_RANGE_WRITE |
+    SYNC_FILE_RANGE_WAIT_AFTER
+)
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        name = ctypes.util.find_library('c')
+        if name is None:
+            raise Error("libc not found.")
+        libc = ctypes.CDLL(name, use_errno=True)
+        libc.sync_file_range.argtypes = [
+            ctypes.c_int,
+            ctypes.c_longlong,
+            ctypes.c_longlong,
+            ctypes.c_uint,
+        ]
+        _libc = libc
+    return _libc
+
+
+def sync_file_range(fd, offset, size, flags):
+    """
+    Write the range of fd to the device.
+
+    without sync_file_range the whole file is written with fdatasync
+    when flags waits for the data - starting only is skipped.
+    """
+    try:
+        libc = _get_libc()
+    except (Error, OSError, AttributeError):
+        if flags & SYNC_FILE_RANGE_WAIT_AFTER:
+            os.fdatasync(fd)
+        return
+    if libc.sync_file_range(fd, offset, size, flags) != 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error))
+
+
+def drop_cache(fd, offset, size):
+    """Drop the written range of fd from the page cache."""
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, offset, size, os.POSIX_FADV_DONTNEED)
+
+
+class WritebackWindow(object):
+    """
+    Write back the sequentially written files of one stick in windows.
+
+    use like a Progress object: add() every written chunk.
+    open_file() / close_file() around every file and finish()
+    after the last one - the end of a file goes to the device
+    while the next file is written and is waited for after that.
+    """
+
+    def __init__(self, window_size, progress=None):
+        """
+        Create new WritebackWindow.
+
+        window_size: bytes - 0 passes everything directly to progress.
+        """
+        super(WritebackWindow, self).__init__()
+        self.window_size = window_size
+        self.progress = progress
+        # file that is written - None passes the bytes directly
+        self.fd = None
+        # start of the bytes that are not on the way to the device
+        self.offset = 0
+        self.pending = 0
+        # (fd, offset, size) of the window that is on the way.
+        # fd is a duplicate - so the file can be closed meanwhile.
+        self.previous = None
+
+    def open_file(self, fd, offset=0):
+        """Start the next file - offset: position of its first byte."""
+        self.fd = fd
+        self.offset = offset
+        self.pending = 0
+
+    def add(self, bytes_done):
+        """Add written bytes - blocks while the device is behind."""
+        if not self.window_size or self.fd is None:
+            if self.progress:
+                self.progress.add(bytes_done)
+            return
+        self.pending += bytes_done
+        synced = 0
+        if self.pending >= self.window_size:
+            synced = self._start_pending()
+        if self.progress:
+            # also checks for cancel
+            self.progress.add(synced)
+
+    def close_file(self):
+        """Start writeback of the end of the file - before it is closed."""
+        synced = 0
+        if self.window_size and self.fd is not None and self.pending:
+            # not waited for - the next file is written meanwhile.
+            synced = self._start_pending()
+        self.fd = None
+        if self.progress:
+            self.progress.add(synced)
+
+    def drop_file(self):
+        """Forget the rest of a failed file - before it is closed."""
+        self.fd = None
+        self.pending = 0
+
+    def finish(self):
+        """Wait for the last window and report it - after the last file."""
+        synced = self._wait_previous()
+        if self.progress:
+            self.progress.add(synced)
+
+    def close(self):
+        """Forget the window on the way - on errors and cancel."""
+        self.drop_file()
+        if self.previous is not None:
+            os.close(self.previous[0])
+            self.previous = None
+
+    def _start_pending(self):
+        # this window goes to the device while the next is written.
+        # the one before has to be there now.
+        sync_file_range(
+            self.fd,
+            self.offset,
+            self.pending,
+            SYNC_FILE_RANGE_WRITE
+        )
+        synced = self._wait_previous()
+        self.previous = (os.dup(self.fd), self.offset, self.pending)
+        self.offset += self.pending
+        self.pending = 0
+        return synced
+
+    def _wait_previous(self):
+        if self.previous is None:
+            return 0
+        fd, offset, size = self.previous
+        self.previous = None
+        try:
+            sync_file_range(fd, offset, size, SYNC_FILE_RANGE_WAIT)
+            drop_cache(fd, offset, size)
+        finally:
+            os.close(fd)
+        return size
+
+
+##########################################
+# backing device limits
+
+def get_bdi_path(node):
+    """Get sysfs folder of the backing device of node (or None)."""
+    sys_path = os.path.join(
+        "/sys/class/block",
+        os.path.basename(os.path.realpath(node))
+    )
+    if os.path.exists(os.path.join(sys_path, "partition")):
+        # partitions share the backing device of their disk
+        sys_path = os.path.join(sys_path, "..")
+    bdi_path = os.path.join(sys_path, "bdi")
+    if not os.path.exists(bdi_path):
+        return None
+    return os.path.realpath(bdi_path)
+
+
+def limit_device(node, max_bytes=0, max_ratio=0, strict_limit=False):
+    """
+    Limit the dirty pages of the device of node.
+
+    max_bytes: 0 leaves it unchanged (needs linux 6.2+)
+    max_ratio: percent of the global dirty limit - 0 leaves it unchanged
+    strict_limit: apply the limit even if the system is below
+        the global background threshold
+    returns the previous settings for restore_device.
+    raises Error if the settings can not be written.
+    """
+    bdi_path = get_bdi_path(node)
+    if bdi_path is None:
+        raise Error("no backing device for '{}'".format(node))
+    settings = []
+    if max_bytes:
+        settings.append(('max_bytes', max_bytes))
+    if max_ratio:
+        settings.append(('max_ratio', max_ratio))
+    if not settings:
+        return []
+    settings.append(('strict_limit', int(bool(strict_limit))))
+    names = [name for name, value in settings]
+    if 'max_bytes' in names:
+        # the kernel keeps max_bytes as ratio -
+        # the ratio is what has to be restored.
+        names.remove('max_bytes')
+        if 'max_ratio' not in names:
+            names.append('max_ratio')
+    previous = []
+    try:
+        for name in names:
+            path = os.path.join(bdi_path, name)
+            with open(path, 'r') as f:
+                previous.append((path, f.read().strip()))
+        for name, value in settings:
+            with open(os.path.join(bdi_path, name), 'w') as f:
+                f.write("{}\n".format(value))
+    except OSError as why:
+        try:
+            restore_device(previous)
+        except Error:
+            pass
+        raise Error("can not set {} of '{}': {}".format(
+            name,
+            bdi_path,
+            why
+        ))
+    return previous
+
+
+def restore_device(previous):
+    """
+    Write back the settings limit_device returned.
+
+    raises Error if a setting can not be written.
+    """
+    errors = []
+    for path, value in previous:
+        try:
+            with open(path, 'w') as f:
+                f.write("{}\n".format(value))
+        except OSError as why:
+            errors.append("can not restore '{}': {}".format(path, why))
+    if errors:
+        raise Error("\n".join(errors))